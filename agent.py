@@ -0,0 +1,445 @@
+import hmac
+import itertools
+import os
+import re
+import threading
+import zlib
+from collections import deque, OrderedDict
+
+import simplejson
+from twisted.internet import defer, protocol, reactor, threads
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.python import log, threadable
+
+from stats import Stat, safe_name
+
+
+def encode(message):
+    """Return a message as compressed JSON
+    """
+    return zlib.compress(simplejson.dumps(message))
+
+
+def decode(data):
+    """Return a message from compressed JSON
+    """
+    return simplejson.loads(zlib.decompress(data))
+
+
+def definition(s):
+    """Return what an aggregator needs to store and graph a stat
+
+    Arguments:
+    s - Stat
+
+    Return:
+    dictionary of rrd file name, step, data sources, archives, and graph
+    arguments by image prefix and period
+
+    """
+    return {
+        'file': s.rrd_file_name,
+        'step': s.step,
+        'sources': s.rrd_data_source,
+        'archives': s.averages,
+        'graphs': dict((prefix, dict((period, s.graph_args(prefix, period))
+                                     for period in Stat.IMAGE_PERIODS))
+                       for prefix in s.IMAGE_PREFIXES),
+    }
+
+
+class Shipper(object):
+    """Ships samples to an aggregator in batches. The agent side of a link
+
+    Takes the place of the write buffer: update_stat hands it samples, and
+    every flush turns the samples since the last one into a batch, grouped
+    by rrd file. Batches wait in a bounded spool until the aggregator acks
+    them, and at most window of them are in flight, so a slow aggregator
+    holds batches back instead of them piling up in socket buffers. Once
+    the spool is full the oldest batch is dropped. Batches that weren't
+    acked are sent again after a reconnect, and the spool is saved to a
+    file on the way out and loaded on the next start.
+    """
+
+    def __init__(self, host, max_batches=1000, window=4, spool=None,
+                 secret=None):
+        """
+        Arguments:
+        host - name of this host at the aggregator
+
+        Keyword Arguments:
+        max_batches - max number of batches kept, default: 1000
+        window - max number of batches sent and not yet acked, default: 4
+        spool - path of the file unsent batches are saved to, default: none
+        secret - shared secret the aggregator asks for, default: none
+
+        """
+        self.host = host
+        self.secret = secret
+        self.max_batches = max_batches
+        self.window = window
+        self.spool_path = spool
+        # rrd file name -> definition, sent on every connect
+        self.definitions = OrderedDict()
+        # rrd file name -> [fields, list of [timestamp] + values]
+        self.pending = OrderedDict()
+        # [sequence, batch] waiting to be acked, the first in_flight sent
+        self.spool = deque()
+        self.in_flight = 0
+        self.sequence = itertools.count()
+        self.protocol = None
+        self.sent = 0
+        self.acked = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def open(self):
+        """Load the batches left in the spool file
+        """
+        if self.spool_path is None or not os.path.isfile(self.spool_path):
+            return
+        with open(self.spool_path, 'r') as spool:
+            for line in spool:
+                self.spool.append(simplejson.loads(line))
+        if self.spool:
+            self.sequence = itertools.count(self.spool[-1][0] + 1)
+        os.remove(self.spool_path)
+
+    def close(self):
+        """Batch the pending samples and save the unsent batches
+        """
+        self.flush()
+        if self.spool_path is not None and self.spool:
+            with open(self.spool_path, 'w') as spool:
+                for batch in self.spool:
+                    spool.write(simplejson.dumps(batch) + '\n')
+
+    def define(self, s):
+        """Tell the aggregator about a stat, now and on every connect
+
+        Arguments:
+        s - Stat whose samples are shipped
+
+        """
+        self.definitions[s.rrd_file_name] = definition(s)
+        if self.protocol is not None:
+            self.protocol.send({'type': 'define',
+                                'stats': [self.definitions[s.rrd_file_name]]})
+
+    def add(self, file_name, template, timestamp, values):
+        """Queue one sample for the next batch. Safe to call from threads
+
+        Arguments:
+        file_name - rrd file name
+        template - ':' separated data source names
+        timestamp - unix time of the sample
+        values - list of values in template order
+
+        """
+        fields = template.split(':')
+        with self.lock:
+            entry = self.pending.get(file_name)
+            if entry is None or entry[0] != fields:
+                entry = self.pending[file_name] = [fields, []]
+            entry[1].append([timestamp] + list(values))
+        return True
+
+    def flush(self, file_name=None):
+        """Turn the pending samples into a batch and send what fits
+
+        Safe to call from threads, the batch is queued in the reactor
+        thread. file_name is only there to match writeback.WriteBuffer,
+        all files go in one batch.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, OrderedDict()
+        if threadable.isInIOThread():
+            self._queue(pending)
+        else:
+            reactor.callFromThread(self._queue, pending)
+
+    def _queue(self, pending):
+        if pending:
+            batch = dict((name, {'fields': fields, 'samples': samples})
+                         for name, (fields, samples) in pending.iteritems())
+            self.spool.append([next(self.sequence), batch])
+            while len(self.spool) > self.max_batches:
+                self.spool.popleft()
+                self.dropped += 1
+                # An acked batch is gone already, a dropped one was in flight
+                self.in_flight = max(0, self.in_flight - 1)
+        self._send()
+
+    def connected(self, p):
+        self.protocol = p
+        self.in_flight = 0
+        p.send({'type': 'hello', 'host': self.host, 'secret': self.secret,
+                'stats': self.definitions.values()})
+        self._send()
+
+    def disconnected(self, p):
+        if self.protocol is p:
+            self.protocol = None
+            # Everything in flight is sent again on the next connect
+            self.in_flight = 0
+
+    def ack(self, sequence):
+        """Forget the batches up to sequence, and send more
+        """
+        while self.spool and self.spool[0][0] <= sequence:
+            self.spool.popleft()
+            self.in_flight = max(0, self.in_flight - 1)
+            self.acked += 1
+        self._send()
+
+    def status(self):
+        """Return a dictionary of link and spool counts
+        """
+        return {
+            'connected': self.protocol is not None,
+            'spooled': len(self.spool),
+            'in_flight': self.in_flight,
+            'sent': self.sent,
+            'acked': self.acked,
+            'dropped': self.dropped,
+        }
+
+    def _send(self):
+        while self.protocol is not None and self.in_flight < self.window and \
+                self.in_flight < len(self.spool):
+            sequence, batch = self.spool[self.in_flight]
+            self.protocol.send({'type': 'batch', 'seq': sequence,
+                                'stats': batch})
+            self.in_flight += 1
+            self.sent += 1
+
+
+class AgentProtocol(Int32StringReceiver):
+    """Agent end of the connection to an aggregator
+    """
+    MAX_LENGTH = 64 * 1024 * 1024
+
+    def connectionMade(self):
+        self.factory.resetDelay()
+        self.factory.shipper.connected(self)
+
+    def connectionLost(self, reason):
+        self.factory.shipper.disconnected(self)
+
+    def stringReceived(self, data):
+        message = decode(data)
+        if message.get('type') == 'ack':
+            self.factory.shipper.ack(message['seq'])
+
+    def send(self, message):
+        self.sendString(encode(message))
+
+
+class AgentFactory(protocol.ReconnectingClientFactory):
+    """Keeps an agent connected to its aggregator, backing off on failures
+    """
+    protocol = AgentProtocol
+    maxDelay = 60
+
+    def __init__(self, shipper):
+        self.shipper = shipper
+
+
+class RemoteStat(Stat):
+    """A stat collected by an agent on another host
+
+    Its rrd lives in the host's directory, and it is only ever updated
+    with samples the agent shipped, never read here.
+    """
+
+    def __init__(self, host, directory, stat):
+        """
+        Arguments:
+        host - host name, safe to use in file names
+        directory - directory of the host's rrds
+        stat - definition from the agent
+
+        """
+        file_name = os.path.join(directory, os.path.basename(stat['file']))
+        super(RemoteStat, self).__init__(file_name, stat['sources'],
+                                         stat['archives'])
+        self.step = stat['step']
+        self.rrd_data_source = stat['sources']
+        self.host = host
+        self.IMAGE_PREFIXES = []
+        self.graphs = {}
+        for prefix, periods in stat['graphs'].iteritems():
+            self.IMAGE_PREFIXES.append('%s_%s' % (host, prefix))
+            # Point the graph at the rrd in the host's directory
+            self.graphs[self.IMAGE_PREFIXES[-1]] = dict(
+                (period, [re.sub(r'^(DEF:[^=]+=)([^:]+)',
+                                 lambda m: m.group(1) + os.path.join(
+                                     directory, os.path.basename(m.group(2))),
+                                 arg) for arg in args])
+                for period, args in periods.iteritems())
+        self.IMAGE_PREFIXES.sort()
+        # Timestamp of the newest sample in the rrd
+        self.last = 0
+
+    def create_rrd(self):
+        directory = os.path.dirname(self.rrd_file_name)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        super(RemoteStat, self).create_rrd()
+        self.last = self.last_update()
+
+    def read_stat(self, snapshot):
+        raise NotImplementedError("Remote stats are shipped by their agent")
+
+    def add_samples(self, fields, samples):
+        """Write shipped samples, skipping ones the rrd has. Runs in a thread
+
+        Arguments:
+        fields - data source names
+        samples - list of [timestamp] + values in fields order
+
+        """
+        for sample in samples:
+            if int(round(sample[0])) <= self.last:
+                continue
+            self.stats = OrderedDict(zip(fields, sample[1:]))
+            self.update_stat(sample[0])
+            self.last = int(round(sample[0]))
+
+    def graph_args(self, prefix, period):
+        super(RemoteStat, self).graph_args(prefix, period)
+        return list(self.graphs[prefix][period])
+
+
+class AggregatorProtocol(Int32StringReceiver):
+    """Aggregator end of the connection from an agent
+
+    Messages of a connection are handled one after the other, and a batch
+    is acked once it is written, so the agent's window keeps a slow
+    aggregator from being flooded.
+    """
+    MAX_LENGTH = 64 * 1024 * 1024
+
+    def connectionMade(self):
+        self.host = None
+        self.queue = defer.succeed(None)
+
+    def stringReceived(self, data):
+        message = decode(data)
+        kind = message.get('type')
+        if kind == 'hello':
+            if not self.factory.allowed(message.get('secret')):
+                log.msg('Agent %r sent the wrong secret' %
+                        message.get('host'))
+                self.factory.rejected += 1
+                self.transport.loseConnection()
+                return
+            self.host = safe_name(message['host'])
+            log.msg('Agent %s connected' % self.host)
+        if self.host is None:
+            log.msg('Dropping %s message from unknown agent' % kind)
+            return
+        if kind in ['hello', 'define']:
+            self.queue.addCallback(lambda _: self.factory.define(
+                self.host, message['stats']))
+        elif kind == 'batch':
+            self.queue.addCallback(lambda _: self.factory.write(
+                self.host, message['stats']))
+            # A batch that fails to write is logged and acked anyway, so it
+            # isn't sent forever
+            self.queue.addErrback(log.err, 'Failed to write batch of %s' %
+                                  self.host)
+            self.queue.addCallback(lambda _: self.send(
+                {'type': 'ack', 'seq': message['seq']}))
+        self.queue.addErrback(log.err, 'Failed to handle %s message of %s' %
+                              (kind, self.host))
+
+    def send(self, message):
+        if self.transport.connected:
+            self.sendString(encode(message))
+
+
+class AggregatorFactory(protocol.ServerFactory):
+    """Writes the samples agents ship into an rrd directory per host
+    """
+    protocol = AggregatorProtocol
+
+    def __init__(self, directory, pool, added, secret=None):
+        """
+        Arguments:
+        directory - directory the host directories are made in
+        pool - thread pool rrds are created and written in
+        added - function called with every new RemoteStat, once its rrd
+        exists
+
+        Keyword Arguments:
+        secret - shared secret agents have to send, default: none asked for
+
+        """
+        self.directory = directory
+        self.pool = pool
+        self.added = added
+        self.secret = secret
+        self.rejected = 0
+        # (host, rrd file name from the agent) -> RemoteStat
+        self.stats = {}
+        self.samples = 0
+        self.unknown = 0
+
+    def define(self, host, stats):
+        """Create the rrds of stats an agent has that are new here
+
+        Return:
+        deferred that fires once they exist
+
+        """
+        created = []
+        for stat in stats:
+            key = (host, stat['file'])
+            if key in self.stats or not stat['file'].endswith('.rrd'):
+                continue
+            s = self.stats[key] = RemoteStat(
+                host, os.path.join(self.directory, host), stat)
+            d = threads.deferToThreadPool(reactor, self.pool, s.create_rrd)
+            d.addCallback(lambda _, s=s: self.added(s))
+            d.addErrback(log.err, 'Failed to create %s' % s.rrd_file_name)
+            created.append(d)
+        return defer.DeferredList(created)
+
+    def write(self, host, batch):
+        """Write a batch of samples of a host in the thread pool
+
+        Return:
+        deferred that fires once they are written
+
+        """
+        return threads.deferToThreadPool(reactor, self.pool, self._write,
+                                         host, batch)
+
+    def status(self):
+        """Return a dictionary of hosts and sample counts
+        """
+        return {
+            'hosts': len(set(host for host, name in self.stats)),
+            'stats': len(self.stats),
+            'samples': self.samples,
+            'unknown': self.unknown,
+            'rejected': self.rejected,
+        }
+
+    def allowed(self, secret):
+        """Return whether an agent that sent secret may ship samples
+        """
+        if self.secret is None:
+            return True
+        return isinstance(secret, basestring) and hmac.compare_digest(
+            secret.encode('utf-8'), self.secret.encode('utf-8'))
+
+    def _write(self, host, batch):
+        for name, entry in batch.iteritems():
+            s = self.stats.get((host, name))
+            if s is None:
+                self.unknown += len(entry['samples'])
+                continue
+            s.add_samples(entry['fields'], entry['samples'])
+            self.samples += len(entry['samples'])
@@ -0,0 +1,686 @@
+"""Benchmarks of collection, rrd updates, graph rendering and serving
+
+Usage: python bench.py [--devices 1,10,100,500] [--output bench.json]
+
+Stats read synthetic procfs trees with N disks, network interfaces,
+mounts and cpu cores, N status pages of a local fake nginx and N
+instances of a local fake redis, and the per-process collector reads
+trees of thousands of processes coming and going, so the numbers only
+depend on the code and the machine. Results are written as JSON;
+pass --compare with the results of another version to print how each
+number changed.
+"""
+import argparse
+import BaseHTTPServer
+import SocketServer
+import httplib
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import rrdtool
+from twisted.internet import defer, reactor, threads
+
+from procfs import Snapshot
+from stats import Stat, CPUStat, CPUCoreStat, HDDIO, HDDUsage, RAMStat, \
+    SwapStat, NetworkStat, NginxStat, RedisStat, ProcessStat
+from store import Store
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def summary(values):
+    """Return a dictionary of avg, p50, p95 and max of a list of seconds
+    """
+    values = sorted(values)
+    if not values:
+        return {'avg': None, 'p50': None, 'p95': None, 'max': None}
+    return {
+        'avg': sum(values) / len(values),
+        'p50': values[len(values) // 2],
+        'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+        'max': values[-1],
+    }
+
+
+def write_fixture(root, devices, tick):
+    """Write the procfs files of a machine with devices of each kind
+
+    Counters grow with tick, so rates come out known and nonzero.
+
+    Arguments:
+    root - directory to write the tree in
+    devices - number of disks, interfaces, mounts and cpu cores
+    tick - sample number
+
+    """
+    for directory in ['net', 'self', 'mnt']:
+        path = os.path.join(root, directory)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    lines = ['cpu  %d %d %d %d %d %d %d 0 0 0' % (
+        devices * tick * 30, tick, devices * tick * 10, devices * tick * 55,
+        tick * 3, tick, tick)]
+    for i in xrange(devices):
+        lines.append('cpu%d %d %d %d %d %d %d %d 0 0 0' % (
+            i, tick * (30 + i % 40), tick, tick * 10, tick * (55 - i % 40),
+            tick * 3, tick, tick))
+    lines += ['intr %d' % (tick * 1000), 'ctxt %d' % (tick * 5000)]
+    with open(os.path.join(root, 'stat'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    with open(os.path.join(root, 'meminfo'), 'w') as f:
+        f.write('MemTotal:       16384000 kB\n'
+                'MemFree:         %8d kB\n'
+                'Buffers:          512000 kB\n'
+                'Cached:          4096000 kB\n'
+                'SwapCached:         1024 kB\n'
+                'SwapTotal:       2048000 kB\n'
+                'SwapFree:        2000000 kB\n' % (8000000 + tick % 100))
+    with open(os.path.join(root, 'diskstats'), 'w') as f:
+        for i in xrange(devices):
+            f.write('   8 %7d bench%d %d 0 %d %d %d 0 %d %d %d %d %d\n' % (
+                i, i, tick * 100, tick * 800, tick * 40, tick * 50,
+                tick * 400, tick * 20, i % 4, tick * 60, tick * 70))
+    with open(os.path.join(root, 'net/dev'), 'w') as f:
+        f.write('Inter-|   Receive                                                |  Transmit\n'
+                ' face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed\n')
+        for i in xrange(devices):
+            f.write('bench%d: %d %d 0 0 0 0 0 0 %d %d 0 0 0 0 0 0\n' % (
+                i, tick * 150000, tick * 100, tick * 50000, tick * 80))
+    mounts = []
+    for i in xrange(devices):
+        mount_point = os.path.join(root, 'mnt', str(i))
+        if not os.path.isdir(mount_point):
+            os.makedirs(mount_point)
+        mounts.append('%d 1 8:%d / %s rw,relatime - ext4 /dev/bench%d rw' %
+                      (i + 20, i, mount_point, i))
+    path = os.path.join(root, 'self/mountinfo')
+    if not os.path.isfile(path):
+        with open(path, 'w') as f:
+            f.write('\n'.join(mounts) + '\n')
+
+
+# Process names of the fixture, some with spaces as in real comms
+PROCESS_NAMES = ['python', 'nginx', 'postgres', 'bash', 'Web Content',
+                 'kworker/0:1', 'redis-server', 'sshd']
+
+
+def write_processes(root, count, tick, churn):
+    """Write /proc/<pid>/stat of count processes
+
+    Pids are a window that moves by churn every tick: the oldest processes
+    exit, and new ones start with pids not seen before.
+
+    Arguments:
+    root - directory to write the tree in
+    count - number of processes
+    tick - sample number
+    churn - processes replaced per tick
+
+    """
+    first = tick * churn + 1
+    for pid in xrange(first - churn, first):
+        path = os.path.join(root, str(pid))
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+    for pid in xrange(first, first + count):
+        path = os.path.join(root, str(pid))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        born = max(0, (pid - count - 1) // churn + 1) if churn else 0
+        used = (tick - born) * (pid % 50)
+        with open(os.path.join(path, 'stat'), 'w') as f:
+            f.write('%d (%s) S 1 %d %d 0 -1 4194560 100 0 0 0 %d %d 0 0 20 0 '
+                    '1 0 %d %d %d 18446744073709551615 1 1 0 0 0 0 0 0 0 0 '
+                    '0 0 17 0 0 0 0 0 0\n' % (
+                        pid, PROCESS_NAMES[pid % len(PROCESS_NAMES)], pid,
+                        pid, used * 3 // 4, used // 4, born,
+                        (pid % 1000) * 4096 * 1024, pid % 1000 * 256))
+
+
+class FakeNginx(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves an nginx stub_status page with growing counters, over
+    keep-alive connections
+    """
+    protocol_version = 'HTTP/1.1'
+    # Without these, headers and body go out in separate packets, and
+    # delayed acks make every request take 40ms
+    disable_nagle_algorithm = True
+    wbufsize = -1
+    requests = 0
+
+    def do_GET(self):
+        FakeNginx.requests += 1
+        body = ('Active connections: %d \n'
+                'server accepts handled requests\n'
+                ' %d %d %d \n'
+                'Reading: 1 Writing: 3 Waiting: %d \n' % (
+                    10 + self.requests % 7, self.requests, self.requests,
+                    self.requests * 4, 6 + self.requests % 5))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_nginx():
+    """Start a FakeNginx server in a thread
+
+    Return:
+    url of its status page
+
+    """
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+        # All endpoints connect at once
+        request_queue_size = 128
+    httpd = Server(('127.0.0.1', 0), FakeNginx)
+    thread = threading.Thread(target=httpd.serve_forever, name='fake nginx')
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:%d/nginx_status' % httpd.server_address[1]
+
+
+class FakeRedis(SocketServer.StreamRequestHandler):
+    """Answers INFO, PING, AUTH and SELECT like a Redis server, with
+    growing counters
+    """
+    disable_nagle_algorithm = True
+    commands = 0
+    INFO = ('# Clients\r\n'
+            'connected_clients:%(clients)d\r\n'
+            'blocked_clients:0\r\n'
+            '\r\n# Memory\r\n'
+            'used_memory:%(memory)d\r\n'
+            'used_memory_human:1.00M\r\n'
+            'used_memory_rss:%(rss)d\r\n'
+            '\r\n# Persistence\r\n'
+            'rdb_changes_since_last_save:%(commands)d\r\n'
+            '\r\n# Stats\r\n'
+            'total_commands_processed:%(commands)d\r\n'
+            'total_net_input_bytes:%(net_in)d\r\n'
+            'total_net_output_bytes:%(net_out)d\r\n'
+            'expired_keys:%(expired)d\r\n'
+            'evicted_keys:0\r\n'
+            'keyspace_hits:%(hits)d\r\n'
+            'keyspace_misses:%(misses)d\r\n'
+            '\r\n# Keyspace\r\n'
+            'db0:keys=%(keys)d,expires=10,avg_ttl=3600\r\n'
+            'db1:keys=5,expires=0,avg_ttl=0\r\n')
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line.startswith('*'):
+                return
+            args = []
+            for _ in xrange(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2])
+            FakeRedis.commands += 1
+            n = self.commands
+            command = args[0].upper()
+            if command == 'INFO':
+                body = self.INFO % {
+                    'clients': 5 + n % 7, 'memory': 1048576 + n,
+                    'rss': 2097152 + n, 'commands': n * 10,
+                    'net_in': n * 300, 'net_out': n * 900, 'expired': n,
+                    'hits': n * 8, 'misses': n * 2, 'keys': 1000 + n % 50}
+                self.wfile.write('$%d\r\n%s\r\n' % (len(body), body))
+            elif command == 'PING':
+                self.wfile.write('+PONG\r\n')
+            elif command in ('AUTH', 'SELECT'):
+                self.wfile.write('+OK\r\n')
+            else:
+                self.wfile.write("-ERR unknown command '%s'\r\n" % args[0])
+
+
+def start_redis():
+    """Start a FakeRedis server in a thread
+
+    Return:
+    host:port it listens on
+
+    """
+    class Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+        request_queue_size = 128
+    server = Server(('127.0.0.1', 0), FakeRedis)
+    thread = threading.Thread(target=server.serve_forever, name='fake redis')
+    thread.daemon = True
+    thread.start()
+    return '%s:%d' % server.server_address
+
+
+def make_stats(devices, nginx_url, redis_address):
+    """Return one of each stat, with devices disks, interfaces, mounts,
+    nginx endpoints and redis instances
+    """
+    stats = [CPUStat(1), CPUCoreStat(cores=devices), RAMStat(), SwapStat()]
+    for i in xrange(devices):
+        stats.append(NginxStat('%s?%d' % (nginx_url, i), 'bench%d' % i))
+        stats.append(RedisStat('redis://%s/%d' % (redis_address, i % 16),
+                               'bench%d' % i))
+        stats.append(HDDIO('bench%d' % i, 'bench %d' % i))
+        stats.append(NetworkStat('bench%d' % i, 'bench %d' % i))
+        stats.append(HDDUsage('/dev/bench%d' % i, 'bench %d' % i))
+    return stats
+
+
+def create_rrd(s, start):
+    """Create the rrd of a stat starting at start, replacing an old one
+
+    Stat.create_rrd starts rrds at the current time, which would reject
+    samples from the past.
+    """
+    if os.path.isfile(s.rrd_file_name):
+        os.remove(s.rrd_file_name)
+    rrdtool.create(s.rrd_file_name, '--start', str(int(start)),
+                   '--step', str(s.step),
+                   *s.rrd_data_source + s.averages)
+
+
+def fill_history(s, start, end):
+    """Write random samples of a stat from start to end, one per step
+    """
+    sources = [ds.split(':') for ds in s.rrd_data_source]
+    template = ':'.join(ds[1] for ds in sources)
+    counters = [0] * len(sources)
+    samples = []
+    for timestamp in xrange(int(start) + s.step, int(end), s.step):
+        for i, ds in enumerate(sources):
+            if ds[2] == 'GAUGE':
+                counters[i] = random.uniform(0, 100)
+            else:
+                counters[i] += int(random.uniform(0, 1000) * s.step)
+        samples.append('%d:%s' % (timestamp, ':'.join(str(int(x))
+                                                        for x in counters)))
+        if len(samples) == 1000:
+            rrdtool.update(s.rrd_file_name, '-t', template, *samples)
+            samples = []
+    if samples:
+        rrdtool.update(s.rrd_file_name, '-t', template, *samples)
+
+
+def read_async(stats, snapshot):
+    """Read ASYNC stats concurrently. Runs in the reactor
+
+    Return:
+    deferred that fires with a list of (stat, seconds taken or None if
+    the read failed)
+
+    """
+    start = time.time()
+
+    def read(s):
+        d = s.read_stat(snapshot)
+        d.addCallbacks(lambda _: (s, time.time() - start),
+                       lambda _: (s, None))
+        return d
+    d = defer.gatherResults([read(s) for s in stats])
+    d.addCallback(list)
+    return d
+
+
+def bench_collection(work, devices, ticks, nginx_url, redis_address):
+    """Collect ticks samples of every stat from a fixture tree
+
+    Return:
+    dictionary of tick latency, read latency per stat class, and update
+    throughput of rrdtool and of store.Store
+
+    """
+    root = os.path.join(work, 'proc%d' % devices)
+    stats = make_stats(devices, nginx_url, redis_address)
+    # A new connection pool, sized for this many endpoints
+    NginxStat.agent = None
+    NginxStat.endpoints = devices
+    start = int(time.time()) - (ticks + 1) * max(s.step for s in stats)
+    for s in stats:
+        create_rrd(s, start)
+    tick_times = []
+    reads = {}
+    failed = 0
+    samples = []
+    for tick in xrange(ticks):
+        write_fixture(root, devices, tick + 1)
+        snapshot = Snapshot(root)
+        tick_start = time.time()
+        # Like the server, network stats are all read at once in the
+        # reactor, while the rest take turns
+        results = threads.blockingCallFromThread(
+            reactor, read_async, [s for s in stats if s.ASYNC], snapshot)
+        for s in stats:
+            if s.ASYNC:
+                continue
+            read_start = time.time()
+            try:
+                s.read_stat(snapshot)
+            except Exception:
+                results.append((s, None))
+                continue
+            results.append((s, time.time() - read_start))
+        tick_times.append(time.time() - tick_start)
+        for s, seconds in results:
+            if seconds is None:
+                failed += 1
+                continue
+            reads.setdefault(s.__class__.__name__, []).append(seconds)
+            samples.append((s, start + (tick + 1) * s.step, dict(s.stats)))
+    ret = {
+        'devices': devices,
+        'stats': len(stats),
+        'ticks': ticks,
+        'failed_reads': failed,
+        'tick': summary(tick_times),
+        'read': dict((name, summary(times))
+                     for name, times in reads.iteritems()),
+    }
+    for backend in [None, Store()]:
+        Stat.backend = backend
+        if backend is not None:
+            for s in stats:
+                if backend.exists(s.rrd_file_name):
+                    os.remove(backend.path(s.rrd_file_name))
+                s.create_rrd()
+        # Samples are replayed, so both write the same values
+        update_start = time.time()
+        for s, timestamp, values in samples:
+            s.stats = values
+            s.update_stat(timestamp)
+        seconds = time.time() - update_start
+        name = 'rrd_update' if backend is None else 'store_update'
+        ret[name] = {'updates': len(samples), 'seconds': seconds,
+                     'per_second': len(samples) / seconds if seconds else None}
+        if backend is not None:
+            backend.close()
+    Stat.backend = None
+    return ret
+
+
+def bench_processes(work, count, ticks):
+    """Collect ticks samples of ProcessStat from a fixture tree of count
+    processes, a fiftieth of them replaced every tick
+
+    Return:
+    dictionary of read latency, and how many processes are tracked and
+    how many data sources are stored after the last tick
+
+    """
+    root = os.path.join(work, 'processes%d' % count)
+    s = ProcessStat(groups=['python', 'nginx', 'post*'])
+    reads = []
+    for tick in xrange(ticks):
+        write_processes(root, count, tick + 1, max(1, count // 50))
+        snapshot = Snapshot(root)
+        read_start = time.time()
+        s.read_stat(snapshot)
+        reads.append(time.time() - read_start)
+    return {
+        'processes': count,
+        'ticks': ticks,
+        'read': summary(reads),
+        'tracked': len(s.known),
+        'data_sources': len(s.rrd_data_source),
+    }
+
+
+def graph_stats(nginx_url):
+    """Return the stats graphs are benchmarked with, the same as in the
+    config.json written for the server
+    """
+    return [CPUStat(1), CPUCoreStat(top=4), RAMStat(), SwapStat(),
+            NetworkStat('bench0', 'bench'), HDDIO('bench0', 'bench'),
+            HDDUsage('/', 'root'), NginxStat(nginx_url)]
+
+
+def bench_render(stats, periods, repeat):
+    """Render every graph of stats, once cold and repeat times warm
+
+    The first render of a graph reads its rrd from disk and sets up
+    rrdtool's fonts; the warm ones find both cached.
+
+    Return:
+    list of dictionaries of prefix, period, cold seconds and warm latency
+
+    """
+    ret = []
+    for s in stats:
+        for prefix in s.IMAGE_PREFIXES:
+            for period in periods:
+                render_start = time.time()
+                image = s.make_image(prefix, period)
+                cold = time.time() - render_start
+                warm = []
+                for _ in xrange(repeat):
+                    render_start = time.time()
+                    s.make_image(prefix, period)
+                    warm.append(time.time() - render_start)
+                ret.append({'prefix': prefix, 'period': period,
+                            'bytes': len(image), 'cold': cold,
+                            'warm': summary(warm)})
+    return ret
+
+
+def serve(work, port):
+    """Run server.py from work on port, until killed
+    """
+    sys.path.insert(0, HERE)
+    os.chdir(work)
+    from twisted.internet import reactor
+    from twisted.web import server as web
+    import server
+    reactor.listenTCP(port, web.Site(server.root), interface='127.0.0.1')
+    reactor.run()
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def bench_http(work, stats, periods, requests, concurrency, nginx_url):
+    """Request PNGs from a server over keep-alive connections
+
+    Every graph is requested once first, cold, one at a time, then
+    requests are spread over concurrency connections, warm.
+
+    Return:
+    dictionary of cold latency, and warm latency and requests per second
+
+    """
+    config = {'cpu': {'physical': 1}, 'cpu_cores': {'top': 4}, 'swap': True,
+              'network_devices': {'bench0': 'bench'},
+              'hdd_io': {'bench0': 'bench'}, 'hdd_usage': {'/': 'root'},
+              'nginx': nginx_url, 'prerender': False}
+    with open(os.path.join(work, 'config.json'), 'w') as f:
+        json.dump(config, f)
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--serve', work,
+         '--port', str(port)], stdout=open(os.devnull, 'w'),
+        stderr=subprocess.STDOUT)
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), 1).close()
+                break
+            except socket.error:
+                if time.time() > deadline or process.poll() is not None:
+                    raise RuntimeError("Server didn't start")
+                time.sleep(0.1)
+        paths = ['/%s_%s.png' % (prefix, period) for s in stats
+                 for prefix in s.IMAGE_PREFIXES for period in periods]
+        errors = []
+
+        def get(connection, path):
+            request_start = time.time()
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+            return time.time() - request_start
+
+        connection = httplib.HTTPConnection('127.0.0.1', port, timeout=60)
+        cold = [get(connection, path) for path in paths]
+        connection.close()
+        warm = []
+
+        def worker(n):
+            connection = httplib.HTTPConnection('127.0.0.1', port, timeout=60)
+            for i in xrange(n, requests, concurrency):
+                warm.append(get(connection, paths[i % len(paths)]))
+            connection.close()
+
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in xrange(concurrency)]
+        warm_start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.time() - warm_start
+    finally:
+        process.terminate()
+        process.wait()
+    return {
+        'images': len(paths),
+        'cold': summary(cold),
+        'warm': summary(warm),
+        'requests': requests,
+        'concurrency': concurrency,
+        'per_second': requests / seconds if seconds else None,
+        'errors': len(errors),
+    }
+
+
+def flatten(results, path=''):
+    """Return a dictionary of dotted path to number of nested results
+    """
+    ret = {}
+    if isinstance(results, dict):
+        for key, value in results.iteritems():
+            ret.update(flatten(value, '%s.%s' % (path, key) if path else key))
+    elif isinstance(results, list):
+        for i, value in enumerate(results):
+            # Rows are keyed by what they measure, not their position
+            key = '/'.join(str(value[k]) for k in ('devices', 'prefix', 'period')
+                           if isinstance(value, dict) and k in value) or str(i)
+            ret.update(flatten(value, '%s[%s]' % (path, key)))
+    elif isinstance(results, (int, float)) and not isinstance(results, bool):
+        ret[path] = results
+    return ret
+
+
+def compare(old, new):
+    """Print the numbers of two results that changed, as percents
+    """
+    old, new = flatten(old), flatten(new)
+    for key in sorted(set(old) & set(new)):
+        if old[key] and old[key] != new[key]:
+            print '%-60s %12.6g %12.6g %+7.1f%%' % (
+                key, old[key], new[key], 100.0 * (new[key] - old[key]) / old[key])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--devices', default='1,10,100,500',
+                        help='comma separated device counts, default: 1,10,100,500')
+    parser.add_argument('--processes', default='1000,20000',
+                        help='comma separated process counts, default: 1000,20000')
+    parser.add_argument('--ticks', type=int, default=20,
+                        help='samples collected per device count, default: 20')
+    parser.add_argument('--periods', default=','.join(Stat.IMAGE_PERIODS),
+                        help='comma separated graph periods, default: all')
+    parser.add_argument('--history', type=int, default=86400,
+                        help='seconds of samples in the graphed rrds, default: 86400')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='warm renders per graph, default: 5')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='warm HTTP requests, default: 500')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='HTTP connections, default: 10')
+    parser.add_argument('--skip', default='',
+                        help='comma separated parts to skip: collection, processes, render, http')
+    parser.add_argument('--output', help='file to write results to, default: stdout')
+    parser.add_argument('--compare', help='results of another run to compare to')
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        return serve(args.serve, args.port)
+    skip = set(args.skip.split(','))
+    periods = args.periods.split(',')
+    nginx_url = start_nginx()
+    redis_address = start_redis()
+    # Network stats are read in the reactor
+    thread = threading.Thread(target=reactor.run,
+                              kwargs={'installSignalHandlers': False})
+    thread.daemon = True
+    thread.start()
+    work = tempfile.mkdtemp(prefix='bench')
+    os.chdir(work)
+    results = {
+        'time': int(time.time()),
+        'python': platform.python_version(),
+        'rrdtool': getattr(rrdtool, '__version__', None),
+        'machine': platform.machine(),
+        'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+    }
+    try:
+        if 'collection' not in skip:
+            results['collection'] = [
+                bench_collection(work, int(devices), args.ticks, nginx_url,
+                                 redis_address)
+                for devices in args.devices.split(',')]
+        if 'processes' not in skip:
+            results['processes'] = [
+                bench_processes(work, int(count), args.ticks)
+                for count in args.processes.split(',')]
+        if not skip.issuperset(['render', 'http']):
+            stats = graph_stats(nginx_url)
+            now = int(time.time())
+            for s in stats:
+                create_rrd(s, now - args.history - s.step)
+                fill_history(s, now - args.history - s.step, now)
+            if 'render' not in skip:
+                results['render'] = bench_render(stats, periods, args.repeat)
+            if 'http' not in skip:
+                results['http'] = bench_http(work, stats, periods,
+                                             args.requests, args.concurrency,
+                                             nginx_url)
+    finally:
+        reactor.callFromThread(reactor.stop)
+        os.chdir(HERE)
+        shutil.rmtree(work)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print text
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Least recently used cache with a size budget
+
+    Every item has a size, 1 by default, and the least recently used items
+    are evicted once the sizes add up to more than max_size.
+    """
+
+    def __init__(self, max_size):
+        """
+        Arguments:
+        max_size - budget for the sum of item sizes
+
+        """
+        self.max_size = max_size
+        self.size = 0
+        # key -> (value, size), least recently used first
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        """Return the value for key, or default if it isn't cached
+        """
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.items[key] = item
+            return item[0]
+
+    def set(self, key, value, size=1):
+        """Cache a value, evicting least recently used items to fit it
+
+        Items bigger than the whole budget aren't cached.
+        """
+        with self.lock:
+            self._remove(key)
+            if size > self.max_size:
+                return
+            self.items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                self.size -= self.items.popitem(last=False)[1][1]
+
+    def discard(self, key):
+        """Remove key, if it is cached
+        """
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.size -= item[1]
@@ -0,0 +1,92 @@
+"""Copy rrd files into store files, for switching to "storage": "store"
+
+Usage: python import_rrd.py FILE.rrd [FILE.rrd ...]
+
+Each rrd is read with rrdtool and written to a .rrs file next to it, with
+the same step, data sources and archives. Existing .rrs files are left
+alone.
+"""
+import os
+import re
+import sys
+
+import rrdtool
+
+from store import RoundRobinFile, Store
+
+
+def limit(value):
+    """Return an rrd info min or max as a DS string field
+    """
+    return 'U' if value is None or value != value else repr(value)
+
+
+def import_rrd(file_name, store):
+    """Copy an rrd into a store file
+
+    Arguments:
+    file_name - rrd file name
+    store - store.Store giving the store file name
+
+    Return:
+    path of the store file
+
+    """
+    path = store.path(file_name)
+    if os.path.exists(path):
+        raise ValueError("%s exists already" % path)
+    info = rrdtool.info(file_name)
+    step = info['step']
+    names = sorted(set(re.match(r'ds\[(.+)\]\.', key).group(1)
+                       for key in info if key.startswith('ds[')),
+                   key=lambda name: info['ds[%s].index' % name])
+    sources = ['DS:%s:%s:%s:%s:%s' % (
+        name, info['ds[%s].type' % name],
+        info['ds[%s].minimal_heartbeat' % name],
+        limit(info['ds[%s].min' % name]), limit(info['ds[%s].max' % name]))
+        for name in names]
+    archives = []
+    i = 0
+    while 'rra[%d].cf' % i in info:
+        archives.append('RRA:%s:%s:%s:%s' % (
+            info['rra[%d].cf' % i], info['rra[%d].xff' % i],
+            info['rra[%d].pdp_per_row' % i], info['rra[%d].rows' % i]))
+        i += 1
+    RoundRobinFile.create(path, step, sources, archives)
+    f = RoundRobinFile(path)
+    last = info['last_update']
+    raw = []
+    for name in names:
+        try:
+            raw.append(float(info['ds[%s].last_ds' % name]))
+        except ValueError:
+            raw.append(float('nan'))
+    given = []
+    for archive in f.archives:
+        seconds = archive['steps'] * step
+        newest = last - last % seconds
+        (start, end, resolution), fetched, rows = rrdtool.fetch(
+            file_name, archive['cf'], '-r', str(seconds),
+            '-s', str(newest - archive['rows'] * seconds), '-e', str(newest))
+        if resolution != seconds:
+            # rrdtool read another archive, the rows wouldn't fit
+            print '%s: no %s rows of %ss, left unknown' % \
+                (file_name, archive['cf'], seconds)
+            given.append(None)
+            continue
+        order = [fetched.index(name) for name in names]
+        # Rows are stamped with the end of the time they cover
+        given.append((start + resolution,
+                      [[row[j] for j in order] for row in rows]))
+    f.load(last, raw, given)
+    f.close()
+    return path
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+    store = Store()
+    for file_name in sys.argv[1:]:
+        print '%s -> %s' % (file_name, import_rrd(file_name, store))
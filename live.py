@@ -0,0 +1,129 @@
+from collections import OrderedDict
+
+import simplejson
+from twisted.internet import interfaces
+from zope.interface import implementer
+
+
+@implementer(interfaces.IPushProducer)
+class LiveClient(object):
+    """A browser subscribed to the live stream
+
+    Events are written as they come while the connection keeps up. Once
+    the transport pauses it, only the newest event of each stat is kept,
+    and those are written when it resumes, so a slow client skips samples
+    instead of piling them up in memory.
+    """
+
+    def __init__(self, request, prefixes=None):
+        """
+        Arguments:
+        request - twisted request streaming the events
+
+        Keyword Arguments:
+        prefixes - set of image prefixes to send, default: None for all
+
+        """
+        self.request = request
+        self.prefixes = prefixes
+        self.paused = False
+        # Stat -> newest event, while paused
+        self.pending = OrderedDict()
+        self.coalesced = 0
+
+    def wants(self, prefixes):
+        """Return whether any of prefixes is subscribed to
+        """
+        return self.prefixes is None or not self.prefixes.isdisjoint(prefixes)
+
+    def send(self, key, event):
+        """Write an event, or hold it if the connection is backed up
+
+        Arguments:
+        key - stat the event is for, a held event replaces the last one
+        event - text of the event
+
+        """
+        if self.paused:
+            if key in self.pending:
+                self.coalesced += 1
+                del self.pending[key]
+            self.pending[key] = event
+        else:
+            self.request.write(event)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        # Writing can pause us again
+        while self.pending and not self.paused:
+            self.request.write(self.pending.popitem(last=False)[1])
+
+    def stopProducing(self):
+        self.pending.clear()
+
+
+class LiveHub(object):
+    """Fans samples out to the clients of the live stream
+    """
+
+    def __init__(self, max_clients=100):
+        """
+        Keyword Arguments:
+        max_clients - max number of connected clients, default: 100
+
+        """
+        self.max_clients = max_clients
+        self.clients = set()
+        self.sent = 0
+        # Coalesced events of clients that are gone
+        self.coalesced = 0
+
+    def full(self):
+        return len(self.clients) >= self.max_clients
+
+    def add(self, client):
+        self.clients.add(client)
+
+    def remove(self, client):
+        self.clients.discard(client)
+        self.coalesced += client.coalesced
+
+    def publish(self, key, prefixes, data):
+        """Send a sample to the clients subscribed to it
+
+        Arguments:
+        key - stat the sample is from
+        prefixes - image prefixes of the stat
+        data - JSON serializable sample
+
+        """
+        event = None
+        for client in self.clients:
+            if client.wants(prefixes):
+                # Serialized once, and only if someone listens
+                if event is None:
+                    event = 'data: %s\n\n' % simplejson.dumps(data)
+                client.send(key, event)
+                self.sent += 1
+
+    def keepalive(self):
+        """Write a comment to idle clients, so proxies keep them open
+        """
+        for client in self.clients:
+            if not client.paused:
+                client.request.write(':\n\n')
+
+    def status(self):
+        """Return a dictionary of client and event counts
+        """
+        return {
+            'clients': len(self.clients),
+            'max_clients': self.max_clients,
+            'sent': self.sent,
+            'coalesced': self.coalesced +
+            sum(c.coalesced for c in self.clients),
+            'paused': len([c for c in self.clients if c.paused]),
+        }
@@ -0,0 +1,185 @@
+import bisect
+import cProfile
+import pstats
+import threading
+import time
+from cStringIO import StringIO
+
+from twisted.internet import defer
+from twisted.python import failure
+
+# Upper bounds in seconds of the histogram buckets, the last bucket is
+# everything slower
+BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+
+class Histogram(object):
+    """Counts of durations in fixed buckets, with their sum and max
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        """
+        Keyword Arguments:
+        buckets - sorted upper bounds in seconds, default: BUCKETS
+
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def status(self):
+        """Return a dictionary of count, sum, avg, max and buckets, a list
+        of [upper bound, count], None being the bound of the last one
+        """
+        with self.lock:
+            return {
+                'count': self.count,
+                'sum': self.sum,
+                'avg': self.sum / self.count if self.count else 0,
+                'max': self.max,
+                'buckets': [[bound, count] for bound, count
+                            in zip(self.buckets + [None], self.counts)],
+            }
+
+
+class Metrics(object):
+    """Timers, counters and gauges of the monitor itself
+
+    Timers are histograms of how long something took, counters only go up,
+    and gauges are functions returning the current value of something,
+    only called when the metrics are read.
+    """
+
+    def __init__(self):
+        # name -> Histogram
+        self.timers = {}
+        # name -> count
+        self.counters = {}
+        # name -> function
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def timer(self, name):
+        """Return the Histogram of name, made on first use
+        """
+        timer = self.timers.get(name)
+        if timer is None:
+            with self.lock:
+                timer = self.timers.setdefault(name, Histogram())
+        return timer
+
+    def observe(self, name, seconds):
+        self.timer(name).observe(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def value(self, name):
+        """Return the current value of a gauge
+        """
+        return self.gauges[name]()
+
+    def call(self, name, function, *args):
+        """Call function, timing it under name
+
+        If it raises, <name>_errors is counted and the exception passed
+        on.
+        """
+        start = time.time()
+        try:
+            return function(*args)
+        except Exception:
+            self.count(name + '_errors')
+            raise
+        finally:
+            self.observe(name, time.time() - start)
+
+    def call_deferred(self, name, function, *args):
+        """Like call, for a function that returns a deferred, timed until
+        the deferred fires
+
+        Return:
+        deferred of the function
+        """
+        start = time.time()
+
+        def done(result):
+            if isinstance(result, failure.Failure):
+                self.count(name + '_errors')
+            self.observe(name, time.time() - start)
+            return result
+        return defer.maybeDeferred(function, *args).addBoth(done)
+
+    def totals(self, name):
+        """Return the (count, sum of seconds) of a timer
+        """
+        timer = self.timer(name)
+        return timer.count, timer.sum
+
+    def status(self):
+        """Return a dictionary of all timers, counters and gauges
+        """
+        return {
+            'timers': dict((name, timer.status())
+                           for name, timer in self.timers.items()),
+            'counters': dict(self.counters),
+            'gauges': dict((name, function())
+                           for name, function in self.gauges.items()),
+        }
+
+
+class TickProfile(object):
+    """cProfile results of the calls of one collection tick
+
+    cProfile only follows the thread it is enabled in, so every call is
+    profiled on its own, in the thread it runs in, and the results are
+    added up once the tick is done.
+    """
+
+    def __init__(self):
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def call(self, function, *args):
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args)
+        finally:
+            with self.lock:
+                self.profiles.append(profile)
+
+    def report(self, sort='cumulative', limit=40):
+        """Return the pstats text of the profiled calls
+
+        Keyword Arguments:
+        sort - pstats sort key, default: cumulative
+        limit - number of functions listed, default: 40
+
+        """
+        out = StringIO()
+        with self.lock:
+            profiles = list(self.profiles)
+        if not profiles:
+            return 'Nothing was profiled\n'
+        stats = pstats.Stats(profiles[0], stream=out)
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
@@ -0,0 +1,217 @@
+import os
+import re
+import select
+import threading
+import time
+
+
+def parse_meminfo(text):
+    """Parse /proc/meminfo
+
+    Return:
+    dictionary of field name to value, kB values converted to bytes
+
+    """
+    ret = {}
+    for line in text.splitlines():
+        name, _, value = line.partition(':')
+        value = value.split()
+        if not value:
+            continue
+        ret[name] = int(value[0]) * (1024 if value[1:] == ['kB'] else 1)
+    return ret
+
+
+def parse_stat(text):
+    """Parse /proc/stat
+
+    Return:
+    dictionary of first column (cpu, cpu0, intr, ctxt...) to list of ints
+
+    """
+    ret = {}
+    for line in text.splitlines():
+        values = line.split()
+        if values:
+            ret[values[0]] = [int(x) for x in values[1:] if x.isdigit()]
+    return ret
+
+
+def parse_diskstats(text):
+    """Parse /proc/diskstats
+
+    Return:
+    dictionary of device name to list of counters, in the same order as
+    /sys/block/<dev>/stat
+
+    """
+    ret = {}
+    for line in text.splitlines():
+        values = line.split()
+        if len(values) > 3:
+            ret[values[2]] = [int(x) for x in values[3:]]
+    return ret
+
+
+def parse_net_dev(text):
+    """Parse /proc/net/dev
+
+    Return:
+    dictionary of interface name to list of counters, receive counters
+    first (rx bytes is 0, tx bytes is 8)
+
+    """
+    ret = {}
+    # Skip the two header lines
+    for line in text.splitlines()[2:]:
+        name, _, values = line.partition(':')
+        ret[name.strip()] = [int(x) for x in values.split()]
+    return ret
+
+
+def parse_mountinfo(text):
+    """Parse /proc/self/mountinfo
+
+    Return:
+    list of (mount point, filesystem type, source) tuples, in mount order
+
+    """
+    ret = []
+    for line in text.splitlines():
+        fields, _, fs = line.partition(' - ')
+        fields, fs = fields.split(), fs.split()
+        if len(fields) < 5 or len(fs) < 2:
+            continue
+        ret.append((unescape_mount(fields[4]), fs[0], unescape_mount(fs[1])))
+    return ret
+
+
+def scan_processes(root='/proc'):
+    """Read /proc/<pid>/stat of every process
+
+    Only the one file is read per process, the resident pages in it are
+    the same as in statm. Processes that exit during the scan are left
+    out.
+
+    Keyword Arguments:
+    root - where procfs is mounted, default: /proc
+
+    Return:
+    list of (pid, comm, start time, cpu ticks, resident pages) tuples, cpu
+    ticks being user plus system time
+
+    """
+    ret = []
+    for name in os.listdir(root):
+        if not name.isdigit():
+            continue
+        try:
+            fd = os.open('%s/%s/stat' % (root, name), os.O_RDONLY)
+            try:
+                data = os.read(fd, 4096)
+            finally:
+                os.close(fd)
+        except OSError:
+            continue
+        # comm can hold spaces and parentheses, it ends at the last one
+        end = data.rfind(')')
+        if end < 0:
+            continue
+        # Fields after comm, from state (0) up to rss (21)
+        fields = data[end + 2:].split(' ', 22)
+        ret.append((int(name), data[data.find('(') + 1:end], int(fields[19]),
+                    int(fields[11]) + int(fields[12]), int(fields[21])))
+    return ret
+
+
+def read_cmdline(root, pid):
+    """Return the command line of a process with spaces between the
+    arguments, empty for kernel threads and processes that are gone
+    """
+    try:
+        with open('%s/%d/cmdline' % (root, pid), 'r') as f:
+            return f.read().replace('\0', ' ').strip()
+    except IOError:
+        return ''
+
+
+def unescape_mount(path):
+    """Undo the octal escaping of spaces and such in mount paths
+    """
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), path)
+
+
+class MountTable(object):
+    """Mounts from mountinfo, re-read only when they change
+
+    The file is kept open, and the kernel flags it with POLLPRI when the
+    mount table changes, so checking for changes doesn't read anything.
+    """
+
+    def __init__(self, path='/proc/self/mountinfo'):
+        self.file = open(path, 'r')
+        self.poller = select.poll()
+        self.poller.register(self.file, select.POLLPRI | select.POLLERR)
+        self.mounts = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        """Return the list of (mount point, filesystem type, source) tuples
+        """
+        with self.lock:
+            if self.mounts is None or self.poller.poll(0):
+                self.file.seek(0)
+                self.mounts = parse_mountinfo(self.file.read())
+            return self.mounts
+
+
+# Mount tables stay open across snapshots, one per procfs root
+mount_tables = {}
+mount_tables_lock = threading.Lock()
+
+
+class Snapshot(object):
+    """Kernel stat files for one collection cycle
+
+    Each file is read and parsed the first time a stat asks for it, and
+    shared with every other stat of the cycle, so a cycle reads each file
+    at most once no matter how many stats and devices use it.
+    """
+    FILES = {
+        'meminfo': ('meminfo', parse_meminfo),
+        'stat': ('stat', parse_stat),
+        'diskstats': ('diskstats', parse_diskstats),
+        'net_dev': ('net/dev', parse_net_dev),
+    }
+
+    def __init__(self, root='/proc'):
+        """
+        Keyword Arguments:
+        root - where procfs is mounted, default: /proc
+
+        """
+        self.root = root
+        self.time = time.time()
+        self.files = {}
+        self.lock = threading.Lock()
+
+    @property
+    def mounts(self):
+        """List of (mount point, filesystem type, source) tuples
+        """
+        with mount_tables_lock:
+            table = mount_tables.get(self.root)
+            if table is None:
+                table = mount_tables[self.root] = MountTable(
+                    os.path.join(self.root, 'self/mountinfo'))
+        return table.get()
+
+    def __getattr__(self, name):
+        if name not in self.FILES:
+            raise AttributeError(name)
+        with self.lock:
+            if name not in self.files:
+                path, parse = self.FILES[name]
+                with open(os.path.join(self.root, path), 'r') as f:
+                    self.files[name] = parse(f.read())
+            return self.files[name]
@@ -0,0 +1,212 @@
+import heapq
+import itertools
+import multiprocessing
+import signal
+import time
+from collections import deque
+
+from twisted.internet import defer, reactor
+
+try:
+    import rrdtool
+except ImportError:
+    # Only "storage": "store" works without the rrdtool bindings
+    rrdtool = None
+
+# Render priorities, lower goes first
+INTERACTIVE, BACKGROUND = 0, 1
+
+
+class QueueFull(Exception):
+    pass
+
+
+class RenderError(Exception):
+    pass
+
+
+def init_worker():
+    """Undo the signal handlers a worker inherits from the reactor, so
+    terminating the pool stops workers stuck in a render
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Ctrl-C goes to the whole process group, the server stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+
+def render(args):
+    """Render one graph to memory. Runs in a worker process
+
+    Arguments:
+    args - list of rrdtool.graph arguments, without the image file name
+
+    Return:
+    tuple of (seconds spent rendering, error message or None, image data
+    or None)
+
+    """
+    start = time.time()
+    try:
+        # A file name of - makes rrdtool hand back the image
+        image = rrdtool.graphv('-', *args)['image']
+        error = None
+    except Exception as e:
+        image, error = None, str(e)
+    return time.time() - start, error, image
+
+
+class RenderFarm(object):
+    """Renders graphs in a pool of worker processes
+
+    Jobs wait in a bounded priority queue, and only as many jobs as there
+    are workers are handed to the pool, so interactive renders can jump
+    ahead of queued background ones.
+    """
+
+    def __init__(self, processes=None, max_queue=500, history=100,
+                 metrics=None, timeout=60.0):
+        """
+        Keyword Arguments:
+        processes - number of worker processes, default: number of cpus
+        max_queue - max number of queued jobs, default: 500
+        history - number of renders to keep latencies for, default: 100
+        metrics - metrics.Metrics to time renders in, default: None
+        timeout - seconds a job has to render before it fails, default: 60
+
+        """
+        self.processes = processes or multiprocessing.cpu_count()
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.pool = None
+        # Heap of [priority, sequence, queue time, args, deferred], with the
+        # deadline appended once a job is handed to the pool
+        self.queue = []
+        self.jobs = {}
+        self.sequence = itertools.count()
+        self.running = 0
+        self.rendered = 0
+        self.failed = 0
+        self.dropped = 0
+        self.timed_out = 0
+        # (seconds queued, seconds rendering) of the last renders
+        self.latencies = deque(maxlen=history)
+        self.metrics = metrics
+
+    def start(self):
+        self.pool = multiprocessing.Pool(self.processes, init_worker)
+        self._dispatch()
+
+    def stop(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+
+    def submit(self, args, priority=INTERACTIVE):
+        """Queue a graph to be rendered
+
+        If the queue is full, the lowest priority job is dropped to make
+        room, unless it outranks the new job.
+
+        Arguments:
+        args - list of rrdtool.graph arguments, without the image file name
+        priority - one of INTERACTIVE or BACKGROUND, default: INTERACTIVE
+
+        Return:
+        deferred that fires with the image data once it is rendered
+
+        """
+        if len(self.queue) >= self.max_queue:
+            worst = max(self.queue)
+            if worst[0] <= priority:
+                self.dropped += 1
+                return defer.fail(QueueFull("Render queue is full"))
+            self.queue.remove(worst)
+            heapq.heapify(self.queue)
+            del self.jobs[worst[4]]
+            self.dropped += 1
+            worst[4].errback(QueueFull("Dropped from full render queue"))
+        d = defer.Deferred()
+        job = [priority, next(self.sequence), time.time(), args, d]
+        self.jobs[d] = job
+        heapq.heappush(self.queue, job)
+        self._dispatch()
+        return d
+
+    def prioritize(self, d, priority):
+        """Raise the priority of a queued job
+
+        Arguments:
+        d - deferred returned by submit
+        priority - new priority
+
+        """
+        job = self.jobs.get(d)
+        if job is not None and priority < job[0]:
+            job[0] = priority
+            heapq.heapify(self.queue)
+
+    def status(self):
+        """Return a dictionary of queue depth and render latencies
+        """
+        latencies = list(self.latencies)
+        status = {
+            'processes': self.processes,
+            'queued': len(self.queue),
+            'running': self.running,
+            'rendered': self.rendered,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'timed_out': self.timed_out,
+        }
+        for i, name in enumerate(['wait', 'render']):
+            values = [x[i] for x in latencies]
+            status[name] = {
+                'avg': sum(values) / len(values) if values else 0,
+                'max': max(values) if values else 0,
+            }
+        return status
+
+    def _dispatch(self):
+        while self.pool is not None and self.queue and \
+                self.running < self.processes:
+            job = heapq.heappop(self.queue)
+            del self.jobs[job[4]]
+            self.running += 1
+            # apply_async has no error callback on python 2, so a worker
+            # that dies mid-render would never call back. The deadline
+            # frees the slot and fails the job either way
+            job.append(reactor.callLater(self.timeout, self._expired, job))
+            self.pool.apply_async(
+                render, (job[3],),
+                callback=lambda result, job=job: reactor.callFromThread(
+                    self._done, job, result))
+
+    def _expired(self, job):
+        self.running -= 1
+        self.failed += 1
+        self.timed_out += 1
+        if self.metrics is not None:
+            self.metrics.count('render_errors')
+        job[4].errback(RenderError("Not rendered within %ss" % self.timeout))
+        self._dispatch()
+
+    def _done(self, job, result):
+        if not job[5].active():
+            # Too late, the job failed already
+            return
+        job[5].cancel()
+        seconds, error, image = result
+        self.running -= 1
+        self.latencies.append((time.time() - job[2] - seconds, seconds))
+        if self.metrics is not None:
+            self.metrics.observe('render', seconds)
+            if error is not None:
+                self.metrics.count('render_errors')
+        if error is None:
+            self.rendered += 1
+            job[4].callback(image)
+        else:
+            self.failed += 1
+            job[4].errback(RenderError(error))
+        self._dispatch()
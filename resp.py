@@ -0,0 +1,218 @@
+import urlparse
+from collections import deque
+
+from twisted.internet import defer, protocol, reactor
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from twisted.python import failure, log
+
+
+class RedisError(Exception):
+    """Error reply of a Redis server
+    """
+    pass
+
+
+# parse result of a reply that hasn't all arrived yet
+INCOMPLETE = object()
+
+
+def encode(args):
+    """Return a command as a RESP array of bulk strings
+    """
+    args = [str(x) for x in args]
+    return '*%d\r\n%s' % (len(args), ''.join('$%d\r\n%s\r\n' % (len(x), x)
+                                              for x in args))
+
+
+def parse(data, start=0):
+    """Parse the RESP reply at start of data
+
+    Return:
+    tuple of (reply, end of the reply in data), or INCOMPLETE. Error
+    replies are RedisError instances, nil replies None
+
+    """
+    end = data.find('\r\n', start)
+    if end < 0:
+        return INCOMPLETE
+    kind, line = data[start], data[start + 1:end]
+    end += 2
+    if kind == '+':
+        return line, end
+    if kind == '-':
+        return RedisError(line), end
+    if kind == ':':
+        return int(line), end
+    if kind == '$':
+        length = int(line)
+        if length < 0:
+            return None, end
+        if len(data) < end + length + 2:
+            return INCOMPLETE
+        return data[end:end + length], end + length + 2
+    if kind == '*':
+        count = int(line)
+        if count < 0:
+            return None, end
+        items = []
+        for _ in xrange(count):
+            result = parse(data, end)
+            if result is INCOMPLETE:
+                return INCOMPLETE
+            item, end = result
+            items.append(item)
+        return items, end
+    raise ValueError("Bad RESP reply type %r" % kind)
+
+
+class RedisProtocol(protocol.Protocol):
+    """Client end of a Redis connection
+
+    Commands can be sent without waiting for earlier replies, which come
+    back in the order the commands were sent.
+    """
+
+    def connectionMade(self):
+        self.buffer = ''
+        # Deferreds of sent commands, oldest first
+        self.waiting = deque()
+        self.connected = True
+
+    def execute(self, *commands):
+        """Send commands in one write
+
+        Arguments:
+        commands - lists of command arguments
+
+        Return:
+        list of deferreds, one per command, that fire with its reply
+
+        """
+        ret = []
+        for command in commands:
+            d = defer.Deferred()
+            self.waiting.append(d)
+            ret.append(d)
+        self.transport.write(''.join(encode(x) for x in commands))
+        return ret
+
+    def dataReceived(self, data):
+        self.buffer += data
+        start = 0
+        while self.waiting and start < len(self.buffer):
+            try:
+                result = parse(self.buffer, start)
+            except ValueError:
+                self.transport.abortConnection()
+                return
+            if result is INCOMPLETE:
+                break
+            reply, start = result
+            d = self.waiting.popleft()
+            if isinstance(reply, RedisError):
+                d.errback(reply)
+            else:
+                d.callback(reply)
+        self.buffer = self.buffer[start:]
+
+    def connectionLost(self, reason):
+        self.connected = False
+        waiting, self.waiting = self.waiting, deque()
+        for d in waiting:
+            d.errback(reason)
+
+
+class RedisClient(object):
+    """Persistent connection to one Redis server
+
+    Connects on first use, and again on the next use after the connection
+    is lost. A server that doesn't answer in time is disconnected, since
+    later replies could no longer be matched to their commands.
+    """
+
+    def __init__(self, url, timeout=5.0):
+        """
+        Arguments:
+        url - redis://[:password@]host[:port][/db], or host[:port]
+
+        Keyword Arguments:
+        timeout - seconds to connect, and to get the replies of a call,
+        default: 5
+
+        """
+        if '://' not in url:
+            url = 'redis://' + url
+        parsed = urlparse.urlparse(url)
+        self.url = url
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = parsed.path.strip('/') or None
+        self.timeout = timeout
+        self.protocol = None
+
+    def connect(self):
+        """Return a deferred that fires with a connected RedisProtocol
+        """
+        if self.protocol is not None and self.protocol.connected:
+            return defer.succeed(self.protocol)
+        endpoint = TCP4ClientEndpoint(reactor, self.host, self.port,
+                                      timeout=self.timeout)
+        d = connectProtocol(endpoint, RedisProtocol())
+        d.addCallback(self._connected)
+        return d
+
+    def _connected(self, protocol):
+        self.protocol = protocol
+        # Sent ahead of the first command, without waiting for the replies
+        setup = []
+        if self.password:
+            setup.append(['AUTH', self.password])
+        if self.db:
+            setup.append(['SELECT', self.db])
+        if setup:
+            for d in protocol.execute(*setup):
+                d.addErrback(log.err, 'Failed to set up %s' % self.url)
+        return protocol
+
+    def execute(self, *commands):
+        """Send commands in one write, and wait for all their replies
+
+        Arguments:
+        commands - lists of command arguments
+
+        Return:
+        deferred that fires with the list of replies, or fails with the
+        first error
+
+        """
+        timed_out = []
+
+        def send(protocol):
+            d = defer.gatherResults(protocol.execute(*commands),
+                                    consumeErrors=True)
+            timer = reactor.callLater(self.timeout, abort, protocol)
+
+            def done(result):
+                if timer.active():
+                    timer.cancel()
+                if timed_out:
+                    return failure.Failure(IOError(
+                        "%s didn't answer within %ss" %
+                        (self.url, self.timeout)))
+                if isinstance(result, failure.Failure) and \
+                        result.check(defer.FirstError):
+                    return result.value.subFailure
+                return result
+            return d.addBoth(done)
+
+        def abort(protocol):
+            timed_out.append(True)
+            protocol.transport.abortConnection()
+
+        return self.connect().addCallback(send)
+
+    def disconnect(self):
+        if self.protocol is not None and self.protocol.connected:
+            self.protocol.transport.loseConnection()
+        self.protocol = None
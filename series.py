@@ -0,0 +1,99 @@
+import threading
+from array import array
+
+NAN = float('nan')
+
+
+class Series(object):
+    """Ring buffer of the recent samples of a stat
+
+    Sample times, values and rates each live in a preallocated array per
+    field, so a sample costs 8 bytes per column and no python objects.
+    Rates of counter (DERIVE) fields are worked out as samples come in.
+    """
+
+    def __init__(self, fields, counters, capacity):
+        """
+        Arguments:
+        fields - list of field names, the order values are added in
+        counters - list of fields to keep per second rates of
+        capacity - number of samples to keep
+
+        """
+        self.fields = list(fields)
+        self.counters = [f for f in self.fields if f in counters]
+        self.capacity = capacity
+        self.times = array('d', [NAN]) * capacity
+        self.values = [array('d', [NAN]) * capacity for f in self.fields]
+        self.rates = [array('d', [NAN]) * capacity for f in self.counters]
+        self.counter_index = [self.fields.index(f) for f in self.counters]
+        # Next slot to write, and number of samples kept
+        self.next = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, timestamp, values):
+        """Add a sample, replacing the oldest one once full
+
+        Arguments:
+        timestamp - unix time of the sample
+        values - list of values in self.fields order
+
+        """
+        with self.lock:
+            i = self.next
+            last = (i - 1) % self.capacity
+            elapsed = timestamp - self.times[last] if self.count else 0
+            self.times[i] = timestamp
+            for column, value in zip(self.values, values):
+                column[i] = value
+            for column, f in zip(self.rates, self.counter_index):
+                delta = self.values[f][i] - self.values[f][last]
+                # Counters going backwards were reset, the rate is unknown
+                if elapsed > 0 and delta >= 0:
+                    column[i] = delta / elapsed
+                else:
+                    column[i] = NAN
+            self.next = (i + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def latest(self):
+        """Return the newest sample
+
+        Return:
+        tuple of (time, list of values in self.fields order, list of rates
+        in self.counters order), None for unknown values, or None if there
+        are no samples yet
+
+        """
+        with self.lock:
+            if not self.count:
+                return None
+            i = (self.next - 1) % self.capacity
+            return (self.times[i], [clean(column[i]) for column in self.values],
+                    [clean(column[i]) for column in self.rates])
+
+    def since(self, start):
+        """Return the samples taken at or after start, oldest first
+
+        Arguments:
+        start - unix time
+
+        Return:
+        tuple of (list of times, list of value lists in self.fields order,
+        list of rate lists in self.counters order), None for unknown values
+
+        """
+        with self.lock:
+            first = (self.next - self.count) % self.capacity
+            order = [(first + x) % self.capacity for x in xrange(self.count)]
+            order = [i for i in order if self.times[i] >= start]
+            return ([self.times[i] for i in order],
+                    [[clean(column[i]) for i in order] for column in self.values],
+                    [[clean(column[i]) for i in order] for column in self.rates])
+
+
+def clean(value):
+    """Turn NaN into None, which serializes as JSON null
+    """
+    return None if value != value else value
@@ -1,104 +1,1279 @@
+import base64
+import fnmatch
+import gzip
+import hashlib
+import math
+import pstats
+import sys
 import time
 from sys import exit
 import re
-from twisted.internet import reactor
-from twisted.web import static, server
+import socket
+from twisted.internet import defer, reactor, task, threads
+from twisted.python import failure, log
+from twisted.python.threadpool import ThreadPool
+from twisted.web import http, resource, static, server
 from twisted.application import service, internet
+import simplejson
+from cStringIO import StringIO
+try:
+    import rrdtool
+except ImportError:
+    # Not needed with "storage": "store"
+    rrdtool = None
+
+from agent import AgentFactory, AggregatorFactory, Shipper
+from cache import LRUCache
+from live import LiveClient, LiveHub
+from metrics import Metrics, TickProfile
+from procfs import Snapshot
+from render import BACKGROUND, INTERACTIVE, QueueFull, RenderFarm
+from store import Store
+from writeback import WriteBuffer
 
 from stats import get_config
-from stats import Stat, CPUStat, HDDIO, HDDUsage, RAMStat, SwapStat, NetworkStat, NginxStat
+from stats import DS, Stat, CPUStat, CPUCoreStat, HDDIO, HDDUsage, RAMStat, SwapStat, NetworkStat, NginxStat, RedisStat, SelfStat, ProcessStat
 
 # List of stats to monitor
 stats = []
 image_map = {}
-image_gen_times = {}
 
-PNG_MATCHER = re.compile('([\w|\-|_]*)_(%s)\.png' % ('|'.join(Stat.IMAGE_PERIODS)))
+IMAGE_MATCHER = re.compile('([\w|\-|_]*)_(%s)\.(png|svg)$' %
+                           ('|'.join(Stat.IMAGE_PERIODS)))
+
+# Stats are read and written in their own thread pool, so a slow source
+# never blocks the reactor or the other stats
+collect_pool = ThreadPool(minthreads=1, maxthreads=10, name='stats')
+# Seconds a stat has to produce a sample before it is dropped
+collect_timeout = 30.0
+# Stats with a collection still running
+collecting = set()
+# Match device names that should be collected by HDDIO when they show up
+disk_matchers = []
+# Filesystem types whose mounts should be collected by HDDUsage
+usage_fs_types = set()
+# Devices and mount points whose rrds are being created
+discovering = set()
+# Exported rrd data, (file, cf, resolution, start, end, format) -> (last
+# update, ETag, body, gzipped body)
+export_cache = LRUCache(16 * 1024 * 1024)
+# Stat intervals -> LoopingCall collecting them
+loops = {}
+# Stat intervals -> counts of ticks, skipped ticks and late ticks
+ticks = {}
+# Seconds between writes of buffered rrd samples, 0 to write them directly
+flush_interval = 300.0
+# agent.Shipper in agent mode, which ships samples instead of writing rrds
+shipper = None
+# (host, port) of the aggregator in agent mode
+aggregator_address = None
+# agent.AggregatorFactory if samples of agents are taken in
+aggregator = None
+# Port and address agents connect to
+aggregator_port = None
+aggregator_interface = None
+# Stats of agents on other hosts
+remote_stats = []
+# Timings and counts of the monitor itself
+metrics = Metrics()
+# Stat intervals -> (TickProfile, deferreds waiting for it) of the next tick
+profiles = {}
+
+
+def collect_stat(s, snapshot, profile=None):
+    """Read a stat and update its rrd in the collection thread pool
+
+    If read_stat doesn't finish within collect_timeout seconds, or the
+    stat's interval if that is shorter, the sample is dropped. A stat is
+    skipped while its previous collection is still running, so a hung
+    source only ever ties up one thread. Reads and updates are timed in
+    metrics, and failures counted per stat class.
+
+    Arguments:
+    s - Stat to collect
+    snapshot - procfs.Snapshot shared by the stats of this cycle
+
+    Keyword Arguments:
+    profile - metrics.TickProfile to profile the read and update in,
+    default: None
+
+    Return:
+    deferred that fires once the collection thread is done
+
+    """
+    if s in collecting:
+        log.msg('Skipping %s: previous collection still running' %
+                s.rrd_file_name)
+        return None
+    collecting.add(s)
+    timeout = min(collect_timeout, s.step)
+    name = s.__class__.__name__
+
+    def dropped():
+        metrics.count('read_timeouts.%s' % name)
+        log.msg('Dropping %s sample: read took over %ss' %
+                (s.rrd_file_name, timeout))
+
+    timer = reactor.callLater(timeout, dropped)
+
+    def run(timer_name, function, *args):
+        if profile is not None:
+            return profile.call(metrics.call, timer_name, function, *args)
+        return metrics.call(timer_name, function, *args)
+
+    def read_done(result):
+        if not timer.active():
+            # Past the deadline, this sample is lost
+            return None
+        timer.cancel()
+        if isinstance(result, failure.Failure):
+            metrics.count('read_errors.%s' % name)
+            return result
+        d = threads.deferToThreadPool(reactor, collect_pool, run, 'update',
+                                      s.update_stat, snapshot.time)
+        d.addErrback(update_failed)
+        d.addCallback(lambda _: publish_stat(s))
+        return d
+
+    def update_failed(result):
+        metrics.count('update_errors.%s' % name)
+        return result
+
+    if s.ASYNC:
+        # Waits on the network in the reactor, without a thread; only
+        # threads are profiled
+        d = metrics.call_deferred('read', s.read_stat, snapshot)
+    else:
+        d = threads.deferToThreadPool(reactor, collect_pool, run, 'read',
+                                      s.read_stat, snapshot)
+    d.addBoth(read_done)
+    d.addErrback(log.err, 'Failed to collect %s' % s.rrd_file_name)
+    d.addBoth(lambda _: collecting.discard(s))
+    return d
+
+
+# Clients of the live stream of samples
+live = LiveHub()
+# Seconds between keepalive comments to live clients
+LIVE_KEEPALIVE = 15.0
+
+
+def sample_data(s, sample):
+    """Return a sample of a stat as a JSON serializable dictionary
+
+    Arguments:
+    s - Stat the sample is from
+    sample - tuple from Series.latest
+
+    """
+    timestamp, values, rates = sample
+    return {'prefixes': s.IMAGE_PREFIXES, 'time': timestamp,
+            'values': dict(zip(s.series.fields, values)),
+            'rates': dict(zip(s.series.counters, rates))}
+
+
+def publish_stat(s):
+    """Push the newest sample of a stat to the live clients
+    """
+    if not live.clients or s.series is None:
+        return
+    sample = s.series.latest()
+    if sample is not None:
+        live.publish(s, s.IMAGE_PREFIXES, sample_data(s, sample))
+
+
+# Graphs are rendered in a pool of worker processes
+farm = RenderFarm(metrics=metrics)
+# Size in pixels and format of the graphs
+GRAPH_WIDTH = 700
+GRAPH_HEIGHT = 300
+GRAPH_FORMAT = 'PNG'
+# Default size of thumbnails
+THUMB_WIDTH = 200
+THUMB_HEIGHT = 50
+# Smallest and largest width or height that can be asked for
+MIN_GRAPH_SIZE = 10
+MAX_GRAPH_SIZE = 4000
+# Rendered images, (prefix, period, width, height, format, thumb) -> (render
+# start time, image data, gzipped image data or None)
+image_cache = LRUCache(32 * 1024 * 1024)
+# Render every image in the background, so requests don't wait for one
+prerender = True
+# (prefix, period) -> LoopingCall pre-rendering it
+prerenders = {}
+# Renders in progress: image_cache key -> [render deferred, waiting
+# deferreds, priority]
+rendering = {}
+
+
+def image_key(prefix, period, width=GRAPH_WIDTH, height=GRAPH_HEIGHT,
+              fmt=GRAPH_FORMAT, thumb=False):
+    """Return the image_cache key of an image
+    """
+    return (prefix, period, width, height, fmt, thumb)
+
+
+def request_image_key(prefix, period, extension, args):
+    """Return the image_cache key of the variant of an image a request asks for
+
+    Arguments:
+    prefix - image prefix
+    period - one of Stat.IMAGE_PERIODS
+    extension - png or svg
+    args - request arguments, with optional width, height and thumb
+
+    Return:
+    image_cache key, raises ValueError for a bad width or height
+
+    """
+    thumb = args.get('thumb', ['0'])[0] not in ['0', 'false']
+    size = []
+    for name, default in [('width', THUMB_WIDTH if thumb else GRAPH_WIDTH),
+                          ('height', THUMB_HEIGHT if thumb else GRAPH_HEIGHT)]:
+        value = args.get(name, [str(default)])[0]
+        if not value.isdigit() or \
+                not MIN_GRAPH_SIZE <= int(value) <= MAX_GRAPH_SIZE:
+            raise ValueError("%s needs to be %s to %s pixels" %
+                             (name, MIN_GRAPH_SIZE, MAX_GRAPH_SIZE))
+        size.append(int(value))
+    return image_key(prefix, period, size[0], size[1], extension.upper(),
+                     thumb)
+
+
+def render_image(key, priority=INTERACTIVE):
+    """Render a graph in the render farm into image_cache
+
+    Concurrent calls for the same image share one render, which runs at
+    the highest priority any of them asked for. Interactive renders write
+    out the buffered samples of the stat first, so the graph is current;
+    background ones draw what is on disk, at most flush_interval behind.
+
+    Arguments:
+    key - image_cache key of the image
+    priority - render.INTERACTIVE or render.BACKGROUND, default: INTERACTIVE
+
+    Return:
+    deferred that fires with (render start time, image data, gzipped image
+    data or None)
+
+    """
+    waiter = defer.Deferred()
+    if key in rendering:
+        entry = rendering[key]
+        entry[1].append(waiter)
+        entry[2] = min(entry[2], priority)
+        farm.prioritize(entry[0], priority)
+        return waiter
+    entry = rendering[key] = [None, [waiter], priority]
+    started = time.time()
+    s = image_map[key[0]]
+
+    def submit(_):
+        entry[0] = farm.submit(s.image_args(*key), entry[2])
+        return entry[0]
+
+    def done(result):
+        if not isinstance(result, failure.Failure):
+            # SVG is text and shrinks a lot, PNG is compressed already
+            gzipped = gzip_body(result) if key[4] == 'SVG' else None
+            result = (started, result, gzipped)
+            image_cache.set(key, result, len(result[1]) + len(gzipped or ''))
+        for w in rendering.pop(key)[1]:
+            if isinstance(result, failure.Failure):
+                w.errback(result)
+            else:
+                w.callback(result)
+
+    if Stat.write_buffer is None or priority != INTERACTIVE:
+        d = submit(None)
+    else:
+        d = threads.deferToThread(Stat.write_buffer.flush, s.rrd_file_name)
+        d.addErrback(log.err, 'Failed to flush %s' % s.rrd_file_name)
+        d.addCallback(submit)
+    d.addBoth(done)
+    return waiter
+
+
+def cached_image(key):
+    """Return an image from image_cache, and remake it if it is due
+
+    An image older than its refresh_interval is remade in the background,
+    and the cached one returned right away.
+
+    Arguments:
+    key - image_cache key of the image
+
+    Return:
+    tuple of (image_cache value, or None if the image isn't cached,
+    deferred from render_image, or None if the image isn't being remade)
+
+    """
+    cached = image_cache.get(key)
+    rendered = None
+    if cached is None or time.time() - cached[0] >= refresh_interval(*key[:3]):
+        rendered = render_image(key)
+        if cached is not None:
+            rendered.addErrback(log.err, 'Failed to render %s_%s' % key[:2])
+    return cached, rendered
+
+
+def graph_prefixes():
+    """Return the image prefixes of all stats, in page order
+    """
+    return [prefix for s in stats + remote_stats for prefix in s.IMAGE_PREFIXES]
+
+
+def host_stats(host=None):
+    """Return the stats of a host, in page order
+
+    Keyword Arguments:
+    host - name of an agent's host, default: None for the local stats
+
+    """
+    if host is None:
+        return stats
+    return [s for s in remote_stats if s.host == host]
+
+
+def hosts():
+    """Return the sorted names of the hosts agents ship stats of
+    """
+    return sorted(set(s.host for s in remote_stats))
+
+
+class JSONResource(resource.Resource):
+    """Serves the return value of a function as JSON
+    """
+    isLeaf = True
+
+    def __init__(self, function):
+        resource.Resource.__init__(self)
+        self.function = function
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        request.setHeader('Cache-Control', 'no-cache')
+        return simplejson.dumps(self.function())
+
+
+class SeriesResource(resource.Resource):
+    """Serves recent samples of a stat as JSON, from memory
+
+    GET /api/series/<prefix>?period=hour
+    """
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        request.setHeader('Cache-Control', 'no-cache')
+        prefix = request.postpath[0] if request.postpath else ''
+        period = request.args.get('period', ['hour'])[0]
+        if prefix not in image_map:
+            request.setResponseCode(404)
+            return simplejson.dumps({'error': 'Unknown prefix: %s' % prefix})
+        if Stat.PERIOD_SECONDS.get(period, sys.maxint) > Stat.series_window:
+            request.setResponseCode(400)
+            return simplejson.dumps({'error': 'Period needs to be within %ss' %
+                                     Stat.series_window})
+        s = image_map[prefix]
+        ret = {'prefix': prefix, 'step': s.step, 'times': [], 'values': {},
+               'rates': {}}
+        if s.series is not None:
+            times, values, rates = s.series.since(
+                time.time() - Stat.PERIOD_SECONDS[period])
+            ret['times'] = times
+            ret['values'] = dict(zip(s.series.fields, values))
+            ret['rates'] = dict(zip(s.series.counters, rates))
+        return simplejson.dumps(ret)
+
+
+def gzip_body(body):
+    """Return body compressed for Content-Encoding: gzip
+    """
+    out = StringIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        f.write(body)
+    return out.getvalue()
+
+
+def not_modified(request, etag, modified):
+    """Set the ETag and Last-Modified of a response, and check the client's
+    copy against them
+
+    If-Modified-Since is only looked at when there is no If-None-Match,
+    as RFC 7232 section 3.3 has it.
+
+    Arguments:
+    request - twisted.web.http.Request
+    etag - quoted ETag
+    modified - unix time the content last changed
+
+    Return:
+    True if the response code is set to 304 and there is nothing to send
+
+    """
+    if request.setETag(etag) == http.CACHED:
+        return True
+    if request.getHeader('If-None-Match') is not None:
+        request.setHeader('Last-Modified',
+                          http.datetimeToString(int(math.ceil(modified))))
+        return False
+    return request.setLastModified(modified) == http.CACHED
+
+
+class ExportResource(resource.Resource):
+    """Serves the consolidated rrd data of a stat as JSON or CSV
+
+    GET /api/export/<prefix>?period=week&format=csv&cf=AVERAGE&resolution=1800
+
+    The range ends at the last rrd update, so an export is cached and
+    served with the same ETag until new data is written to the rrd.
+    """
+    isLeaf = True
+    CONTENT_TYPES = {'json': 'application/json', 'csv': 'text/csv'}
+
+    def render_GET(self, request):
+        prefix = request.postpath[0] if request.postpath else ''
+        period = request.args.get('period', ['day'])[0]
+        fmt = request.args.get('format', ['json'])[0]
+        cf = request.args.get('cf', [DS.AVERAGE])[0]
+        resolution = request.args.get('resolution', ['0'])[0]
+        if prefix not in image_map:
+            return self.error(request, 404, 'Unknown prefix: %s' % prefix)
+        if period not in Stat.PERIOD_SECONDS:
+            return self.error(request, 400, 'Unknown period: %s' % period)
+        if fmt not in self.CONTENT_TYPES:
+            return self.error(request, 400, 'Unknown format: %s' % fmt)
+        if cf not in image_map[prefix].consolidations():
+            return self.error(request, 400, 'No %s archive, cf needs to be '
+                              'one of %s' % (cf, ', '.join(
+                                  image_map[prefix].consolidations())))
+        if not resolution.isdigit():
+            return self.error(request, 400, 'Resolution needs to be seconds')
+        gone = []
+        request.notifyFinish().addErrback(gone.append)
+
+        def respond(result):
+            if gone:
+                return
+            last, etag, body, gzipped = result
+            request.setHeader('Content-Type', self.CONTENT_TYPES[fmt])
+            request.setHeader('Vary', 'Accept-Encoding')
+            # Each encoding is a representation of its own, with its own ETag
+            if 'gzip' in (request.getHeader('Accept-Encoding') or ''):
+                request.setHeader('Content-Encoding', 'gzip')
+                body = gzipped
+                etag += '_gz'
+            if not_modified(request, '"%s"' % etag, last):
+                request.finish()
+                return
+            request.setHeader('Content-Length', str(len(body)))
+            request.write(body)
+            request.finish()
+
+        def failed(reason):
+            log.err(reason, 'Failed to export %s' % prefix)
+            if not gone:
+                request.setResponseCode(500)
+                request.finish()
+
+        d = threads.deferToThread(self.export, image_map[prefix], prefix, cf,
+                                  fmt, Stat.PERIOD_SECONDS[period],
+                                  int(resolution))
+        d.addCallbacks(respond, failed)
+        return server.NOT_DONE_YET
+
+    def error(self, request, code, message):
+        request.setResponseCode(code)
+        request.setHeader('Content-Type', 'application/json')
+        return simplejson.dumps({'error': message})
+
+    def export(self, s, prefix, cf, fmt, seconds, resolution):
+        """Export from the cache, or from the rrd. Runs in a thread
+
+        Return:
+        tuple of (last update, ETag, body, gzipped body)
+
+        """
+        last = s.last_update()
+        resolution = resolution or s.resolution(seconds)
+        end = last - last % resolution
+        key = (s.rrd_file_name, cf, resolution, end - seconds, end, fmt)
+        cached = export_cache.get(key)
+        if cached is not None:
+            return cached
+        names, rows = s.export(cf, resolution, end - seconds, end)
+        if fmt == 'csv':
+            lines = [','.join(['time'] + names)]
+            for row in rows:
+                lines.append(','.join(['' if x is None else str(x) for x in row]))
+            body = '\n'.join(lines) + '\n'
+        else:
+            body = simplejson.dumps({'prefix': prefix, 'cf': cf,
+                                     'resolution': resolution,
+                                     'start': end - seconds, 'end': end,
+                                     'columns': ['time'] + names,
+                                     'rows': rows})
+        gzipped = gzip_body(body)
+        cached = (last, hashlib.sha1(repr(key)).hexdigest(), body, gzipped)
+        export_cache.set(key, cached, len(body) + len(gzipped))
+        return cached
+
+
+class BundleResource(resource.Resource):
+    """Serves every graph of a period in one JSON response
+
+    GET /api/bundle?period=day&format=svg&thumb=1&host=web1
+
+    Images are embedded as data URIs, in page order. A bundle has the
+    graphs of one host, the local ones unless host names an agent, so a
+    fleet is never rendered all at once. Cached
+    images are served as they are, and the missing ones are rendered in
+    parallel before responding; an image that fails to render is null.
+    Takes the same width, height and thumb arguments as the images.
+
+    With the store backend there are no images, and the response lists
+    a prefix of every stat under exports, to chart from /api/export.
+    """
+    isLeaf = True
+    FORMATS = ['png', 'svg']
+
+    def render_GET(self, request):
+        period = request.args.get('period', ['day'])[0]
+        fmt = request.args.get('format', ['png'])[0]
+        if period not in Stat.IMAGE_PERIODS:
+            return self.error(request, 400, 'Unknown period: %s' % period)
+        if fmt not in self.FORMATS:
+            return self.error(request, 400, 'Unknown format: %s' % fmt)
+        host = request.args.get('host', [''])[0] or None
+        if host is not None and host not in hosts():
+            return self.error(request, 404, 'Unknown host: %s' % host)
+        bundled = host_stats(host)
+        if Stat.backend is not None:
+            # Store data isn't graphed, the page charts the exports instead
+            request.setHeader('Content-Type', 'application/json')
+            return simplejson.dumps({'period': period, 'exports': [
+                s.IMAGE_PREFIXES[0] for s in bundled if s.IMAGE_PREFIXES]})
+        try:
+            keys = [request_image_key(prefix, period, fmt, request.args)
+                    for s in bundled for prefix in s.IMAGE_PREFIXES]
+        except ValueError as e:
+            return self.error(request, 400, str(e))
+        images = []
+        for key in keys:
+            cached, rendered = cached_image(key)
+            images.append(defer.succeed(cached) if cached is not None
+                          else rendered)
+        gone = []
+        request.notifyFinish().addErrback(gone.append)
+
+        def respond(results):
+            for key, (ok, result) in zip(keys, results):
+                # Dropped renders are counted by the farm, the page falls
+                # back to the image url for them
+                if not ok and not result.check(QueueFull):
+                    log.err(result, 'Failed to render %s_%s' % key[:2])
+            if gone:
+                return
+            request.write(self.bundle(request, period, keys,
+                                      [r if ok else None for ok, r in results]))
+            request.finish()
+
+        d = defer.DeferredList(images, consumeErrors=True)
+        d.addCallback(respond)
+        d.addErrback(log.err, 'Failed to serve %s bundle' % period)
+        return server.NOT_DONE_YET
+
+    def error(self, request, code, message):
+        request.setResponseCode(code)
+        request.setHeader('Content-Type', 'application/json')
+        return simplejson.dumps({'error': message})
+
+    def bundle(self, request, period, keys, images):
+        """Return the response body for the images, with headers set
+
+        Arguments:
+        request - request being served
+        period - one of Stat.IMAGE_PERIODS
+        keys - image_cache keys of the images
+        images - image_cache values of the images, None if they failed
 
+        """
+        now = time.time()
+        request.setHeader('Content-Type', 'application/json')
+        request.setHeader('Vary', 'Accept-Encoding')
+        # Cached until the first image is due to be remade
+        request.setHeader('Cache-Control', 'max-age=%d' % max(0, min(
+            [refresh_interval(*key[:3]) - (now - image[0])
+             for key, image in zip(keys, images) if image is not None] or
+            [0])))
+        gzipped = 'gzip' in (request.getHeader('Accept-Encoding') or '')
+        etag = hashlib.sha1(repr([gzipped] + [
+            (key, image and image[0]) for key, image in zip(keys, images)]))
+        if request.setETag('"%s"' % etag.hexdigest()) == http.CACHED:
+            return ''
+        content_type = Image.CONTENT_TYPES[keys[0][4]] if keys else ''
+        body = simplejson.dumps({
+            'period': period,
+            'images': [{
+                'prefix': key[0],
+                'generated': image and image[0],
+                'src': image and 'data:%s;base64,%s' % (
+                    content_type, base64.b64encode(image[1])),
+            } for key, image in zip(keys, images)]})
+        if gzipped:
+            request.setHeader('Content-Encoding', 'gzip')
+            body = gzip_body(body)
+        request.setHeader('Content-Length', str(len(body)))
+        return body
+
+
+class LiveResource(resource.Resource):
+    """Pushes samples of stats as they are taken, as Server-Sent Events
+
+    GET /api/live?prefix=cpu&prefix=ram
+
+    Every event is the JSON of one sample: the stat's prefixes, its time,
+    values, and per second rates of counters. Without a prefix all stats
+    are sent. The newest sample of each stat is sent on connect.
+    """
+    isLeaf = True
+
+    def render_GET(self, request):
+        prefixes = request.args.get('prefix')
+        for prefix in prefixes or []:
+            if prefix not in image_map:
+                request.setResponseCode(404)
+                request.setHeader('Content-Type', 'application/json')
+                return simplejson.dumps({'error': 'Unknown prefix: %s' % prefix})
+        if live.full():
+            request.setResponseCode(503)
+            request.setHeader('Retry-After', str(int(LIVE_KEEPALIVE)))
+            request.setHeader('Content-Type', 'application/json')
+            return simplejson.dumps({'error': 'Too many live clients'})
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.setHeader('Cache-Control', 'no-cache')
+        client = LiveClient(request, prefixes and set(prefixes))
+        # Streams last as long as the client stays, that isn't latency
+        request.timed = False
+        request.registerProducer(client, True)
+        live.add(client)
+        request.notifyFinish().addBoth(lambda _: live.remove(client))
+        # Sends the headers, so the browser knows the stream is open
+        request.write(':\n\n')
+        for s in stats:
+            sample = s.series and s.series.latest()
+            if sample is not None and client.wants(s.IMAGE_PREFIXES):
+                client.send(s, 'data: %s\n\n' %
+                            simplejson.dumps(sample_data(s, sample)))
+        return server.NOT_DONE_YET
+
+
+class ProfileResource(resource.Resource):
+    """Profiles the collection of one tick with cProfile
+
+    GET /debug/profile?step=60&sort=cumulative
+
+    Waits for the next tick of the stats with that interval, the shortest
+    one by default, and serves the pstats report of their reads and
+    updates as text. Nothing is profiled unless asked for.
+    """
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain')
+        request.setHeader('Cache-Control', 'no-cache')
+        step = request.args.get('step', [min(loops) if loops else ''])[0]
+        sort = request.args.get('sort', ['cumulative'])[0]
+        try:
+            step = int(step)
+        except ValueError:
+            step = None
+        if step not in loops:
+            request.setResponseCode(400)
+            return 'step needs to be one of %s\n' % sorted(loops)
+        if sort not in pstats.Stats.sort_arg_dict_default:
+            request.setResponseCode(400)
+            return 'Unknown sort: %s\n' % sort
+        profile, waiting = profiles.setdefault(step, (TickProfile(), []))
+        d = defer.Deferred()
+        waiting.append(d)
+        # Waiting on the tick isn't latency either
+        request.timed = False
+        gone = []
+        request.notifyFinish().addErrback(gone.append)
+
+        def respond(profile):
+            if not gone:
+                request.write(profile.report(sort))
+                request.finish()
+        d.addCallback(respond)
+        d.addErrback(log.err, 'Failed to profile %ss tick' % step)
+        return server.NOT_DONE_YET
+
+
+class TimedRequest(server.Request):
+    """Request that times itself in metrics, from being processed to
+    finished, and counts server errors. Requests with timed set to False
+    aren't timed
+    """
+    timed = True
+
+    def process(self):
+        self.started = time.time()
+        server.Request.process(self)
+
+    def finish(self):
+        if self.timed:
+            metrics.observe('http', time.time() - self.started)
+            if self.code >= 500:
+                metrics.count('http_errors')
+        return server.Request.finish(self)
+
+
+def flush_rrds():
+    """Write all buffered rrd samples in a background thread
+
+    In agent mode, this ships them to the aggregator.
+    """
+    d = threads.deferToThread(Stat.write_buffer.flush)
+    d.addErrback(log.err, 'Failed to flush rrd updates')
+    return d
+
+
+def register_images(s, background=True):
+    """Store the image prefix generators of a stat
+
+    Arguments:
+    s - Stat
+
+    Keyword Arguments:
+    background - whether to pre-render its images if prerender is set,
+    default: True. Otherwise they are only rendered when asked for
+
+    """
+    for prefix in s.IMAGE_PREFIXES:
+        image_map[prefix] = s
+        for period in Stat.IMAGE_PERIODS:
+            # Stats kept in a store.Store have no rrd to draw graphs from
+            if background and prerender and Stat.backend is None:
+                schedule_prerender(prefix, period)
+
+
+def refresh_interval(prefix, period, width=GRAPH_WIDTH):
+    """Return the seconds between renders of an image
+
+    That is the resolution of the rrd archive the image is drawn from, or
+    the time one pixel covers if that is longer, since a render any sooner
+    would look the same.
+
+    Arguments:
+    prefix - image prefix
+    period - one of Stat.IMAGE_PERIODS
+    width - image width in pixels, default: GRAPH_WIDTH
+
+    """
+    seconds = Stat.PERIOD_SECONDS[period]
+    return max(image_map[prefix].resolution(seconds), seconds // width)
+
+
+def prerender_image(prefix, period):
+    """Render an image in the background, unless it was rendered recently
+    """
+    interval = refresh_interval(prefix, period)
+    key = image_key(prefix, period)
+    cached = image_cache.get(key)
+    if cached is not None and time.time() - cached[0] < interval / 2.0:
+        return None
+    d = render_image(key, BACKGROUND)
+    # Dropped when the queue is busy with interactive renders, it's tried
+    # again next time
+    d.addErrback(lambda reason: reason.trap(QueueFull))
+    # Keep the LoopingCall going
+    d.addErrback(log.err, 'Failed to pre-render %s_%s' % (prefix, period))
+    return d
+
+
+def schedule_prerender(prefix, period):
+    """Start rendering an image in the background every refresh_interval
+
+    First renders are spread over the first minute, so their repeats are
+    spread out too.
+
+    Arguments:
+    prefix - image prefix
+    period - one of Stat.IMAGE_PERIODS
 
-def update_stats(*args, **kwargs):
-    """Calls itself every minute to update rrdtool stats
     """
-    reactor.callLater(60.0, update_stats)
+    interval = refresh_interval(prefix, period)
+    # Golden ratio steps spread any number of images evenly
+    offset = min(interval, 60.0) * ((len(prerenders) * 0.618034) % 1)
+    loop = prerenders[(prefix, period)] = task.LoopingCall(
+        prerender_image, prefix, period)
+    reactor.callLater(offset, loop.start, interval)
+
+
+def add_stat(s):
+    """Start collecting a stat and serving its images
+
+    The stat is listed after the last stat of its kind, so their images
+    stay together.
+
+    Arguments:
+    s - Stat with its rrd already created
+
+    """
+    kind = [i for i, x in enumerate(stats) if type(x) is type(s)]
+    stats.insert(kind[-1] + 1 if kind else len(stats), s)
+    if shipper is None:
+        register_images(s)
+    else:
+        shipper.define(s)
+    schedule(s.step)
+
+
+def add_remote_stat(s):
+    """Serve the images of a stat an agent ships, once its rrd exists
+
+    They aren't pre-rendered, a fleet has too many of them: a host's
+    images are rendered when its page is looked at, and kept in
+    image_cache like the rest.
+
+    Arguments:
+    s - agent.RemoteStat
+
+    """
+    remote_stats.append(s)
+    remote_stats.sort(key=lambda x: x.IMAGE_PREFIXES)
+    register_images(s, background=False)
+
+
+def discovered(s):
+    """Create the rrd of a newly found stat, then start collecting it
+
+    Arguments:
+    s - HDDIO or HDDUsage stat
+
+    """
+    log.msg('Discovered %s' % s.device)
+    discovering.add(s.device)
+    if shipper is None:
+        d = threads.deferToThreadPool(reactor, collect_pool, s.create_rrd)
+    else:
+        # Agents have no rrds, the aggregator makes them
+        d = defer.succeed(None)
+    d.addCallback(lambda _: add_stat(s))
+    d.addErrback(log.err, 'Failed to create rrd for %s' % s.device)
+    d.addBoth(lambda _: discovering.discard(s.device))
+
+
+def discover_disks(snapshot):
+    """Start collecting devices in /proc/diskstats that match disk_matchers
+
+    Arguments:
+    snapshot - procfs.Snapshot of this cycle
+
+    """
+    known = set(s.device for s in stats if isinstance(s, HDDIO)) | discovering
+    for dev in sorted(snapshot.diskstats):
+        if dev not in known and any(m(dev) for m in disk_matchers):
+            discovered(HDDIO(dev, dev))
+
+
+def discover_mounts(snapshot):
+    """Start collecting mount points with a type in usage_fs_types
+
+    Arguments:
+    snapshot - procfs.Snapshot of this cycle
+
+    """
+    known = discovering.copy()
     for s in stats:
-        # TODO: make this async
-        s.read_stat()
-        # TODO: make this async
-        s.update_stat()
+        if isinstance(s, HDDUsage):
+            known.add(s.device)
+            known.add(s.mount_point(snapshot))
+    for mount_point, fs_type, source in snapshot.mounts:
+        if mount_point not in known and fs_type in usage_fs_types:
+            known.add(mount_point)
+            discovered(HDDUsage(mount_point, source))
+
+
+def discover():
+    """Called every minute to look for new disks and mounts
+    """
+    snapshot = Snapshot()
+    if disk_matchers:
+        discover_disks(snapshot)
+    if usage_fs_types:
+        discover_mounts(snapshot)
+
+
+def update_stats(step, count=1):
+    """Called every step seconds to update the stats with that interval
+
+    All stats of a tick share the snapshot's read time as their sample
+    time. Skipped ticks, and ticks that ran over a tenth of the interval
+    late, are counted in ticks and logged.
+
+    Arguments:
+    step - seconds between samples
+    count - intervals since the last call, more than 1 if ticks were skipped
+
+    """
+    # Kernel stat files are read once and shared by all stats
+    snapshot = Snapshot()
+    report = ticks.setdefault(step, {'ticks': 0, 'skipped': 0, 'late': 0,
+                                     'max_late': 0.0})
+    report['ticks'] += 1
+    if count > 1:
+        report['skipped'] += count - 1
+        log.msg('Skipped %s ticks of %ss stats' % (count - 1, step))
+    # Seconds past the boundary, negative if the timer fired a bit early
+    late = (snapshot.time + step / 2.0) % step - step / 2.0
+    report['max_late'] = max(report['max_late'], late)
+    if late > step / 10.0:
+        report['late'] += 1
+        log.msg('Tick of %ss stats ran %.3fs late' % (step, late))
+    profile, waiting = profiles.pop(step, (None, []))
+    collected = [collect_stat(s, snapshot, profile) for s in stats
+                 if s.step == step]
+    if waiting:
+        d = defer.DeferredList([x for x in collected if x is not None])
+        d.addCallback(lambda _: [w.callback(profile) for w in waiting])
+
+
+def schedule(step):
+    """Start calling update_stats every step seconds, if it isn't already
+
+    Ticks land on multiples of step in wall clock time, so samples line up
+    with rrd steps, and stats with the same interval are read together.
+
+    Arguments:
+    step - seconds between samples
+
+    """
+    if step not in loops:
+        # LoopingCall keeps to its start time, so it doesn't drift
+        loops[step] = task.LoopingCall.withCount(
+            lambda count: update_stats(step, count))
+        reactor.callLater(step - time.time() % step, loops[step].start, step)
+
+
+class Image(resource.Resource):
+    """Serves a rendered image from memory
+
+    Images are cached by browsers until they are due to be remade, and
+    conditional requests for an unchanged image get a 304.
+    """
+    isLeaf = True
+    CONTENT_TYPES = {'PNG': 'image/png', 'SVG': 'image/svg+xml'}
+
+    def __init__(self, key, generated, image, gzipped=None):
+        """
+        Arguments:
+        key - image_cache key of the image
+        generated - unix time the render of the image started
+        image - image data
+
+        Keyword Arguments:
+        gzipped - image data compressed with gzip_body, default: None
+
+        """
+        resource.Resource.__init__(self)
+        self.key = key
+        self.generated = generated
+        self.image = image
+        self.gzipped = gzipped
+
+    def render_GET(self, request):
+        interval = refresh_interval(*self.key[:3])
+        request.setHeader('Cache-Control', 'max-age=%d' %
+                          max(0, interval - (time.time() - self.generated)))
+        # The render's start time tells its image apart
+        etag = '%s_%x' % ('_'.join(str(x) for x in self.key),
+                          int(self.generated * 1000))
+        body = self.image
+        if self.gzipped is not None:
+            request.setHeader('Vary', 'Accept-Encoding')
+            if 'gzip' in (request.getHeader('Accept-Encoding') or ''):
+                request.setHeader('Content-Encoding', 'gzip')
+                body = self.gzipped
+                etag += '_gz'
+        if not_modified(request, '"%s"' % etag, self.generated):
+            return ''
+        request.setHeader('Content-Type', self.CONTENT_TYPES[self.key[4]])
+        request.setHeader('Content-Length', str(len(body)))
+        return body
+
+
+class PendingImage(resource.Resource):
+    """Serves an image once it has been rendered
+    """
+    isLeaf = True
+
+    def __init__(self, key, rendered):
+        """
+        Arguments:
+        key - image_cache key of the image
+        rendered - deferred from render_image
+
+        """
+        resource.Resource.__init__(self)
+        self.key = key
+        self.rendered = rendered
+
+    def render_GET(self, request):
+        gone = []
+        request.notifyFinish().addErrback(gone.append)
+
+        def serve(result):
+            if gone:
+                return
+            request.write(Image(self.key, *result).render(request))
+            request.finish()
+
+        def failed(reason):
+            log.err(reason, 'Failed to render %s_%s' % self.key[:2])
+            if gone:
+                return
+            request.setResponseCode(500)
+            request.finish()
+
+        self.rendered.addCallbacks(serve, failed)
+        return server.NOT_DONE_YET
 
 
 class DynamicStatFiles(static.File):
     """Extends static.File to dynamically make rrdtool images
     """
+    # The only files of the directory that are served, the rest of it is
+    # config.json with its credentials, journals, rrds and code
+    ASSETS = frozenset(['', 'index.html'])
+
     def __init__(self, *args, **kwargs):
         super(self.__class__, self).__init__(*args, **kwargs)
 
     def getChild(self, path, request):
-        """Overload getChild method to generate rrd images
+        """Overload getChild method to serve rrdtool images
+
+        If a request comes in, the path is checked to match the image regex.
+        If it does and its a prefix in image_map, the image is served from
+        image_cache, without touching the filesystem. An image older than
+        its refresh_interval is remade in the background and the cached
+        one served right away; only a request for an image that isn't
+        cached waits for it.
 
-        If a request comes in, the path is checked to match the png regex.
-        If it does and its a prefix in image_map, then the last rrd image
-        generation time is queried, and the image is only made if its
-        been more than 60 seconds.
+        Images are <prefix>_<period>.png or .svg, with optional width,
+        height and thumb arguments. Every variant is cached and remade on
+        its own. Of the files in the directory only ASSETS are served.
 
         """
-        r = PNG_MATCHER.match(path)
-        if r and r.group(1) in image_map:
-            prefix, period = r.group(1), r.group(2)
-            now = time.time()
-            if now - image_gen_times[prefix][period] >= 60.0:
-                # TODO: make this async with a callback
-                image_map[prefix].make_image(prefix, period)
-                image_gen_times[prefix][period] = now
+        r = IMAGE_MATCHER.match(path)
+        if r and r.group(1) in image_map and Stat.backend is None:
+            try:
+                key = request_image_key(r.group(1), r.group(2), r.group(3),
+                                        request.args)
+            except ValueError as e:
+                return resource.ErrorPage(400, 'Bad Request', str(e))
+            cached, rendered = cached_image(key)
+            if cached is None:
+                return PendingImage(key, rendered)
+            return Image(key, *cached)
+        if path not in self.ASSETS:
+            return self.childNotFound
         return super(self.__class__, self).getChild(path, request)
 
 
 def load_stats():
+    global collect_timeout, flush_interval, prerender, shipper, \
+        aggregator_address, aggregator, aggregator_port, aggregator_interface
     # Read config.json
     config = get_config('config.json')
     if config is None:
         exit(1)
+    # Collection
+    collect_timeout = float(config.get('collect_timeout', collect_timeout))
+    collect_pool.adjustPoolsize(maxthreads=config.get('collect_threads', 10))
+    # Rendering
+    farm.processes = config.get('render_processes', farm.processes)
+    farm.max_queue = config.get('render_queue', farm.max_queue)
+    farm.timeout = float(config.get('render_timeout', farm.timeout))
+    prerender = config.get('prerender', prerender)
+    # Sample intervals
+    Stat.intervals = config.get('intervals', {})
+    Stat.series_window = config.get('series_window', Stat.series_window)
+    export_cache.max_size = config.get('export_cache_bytes', export_cache.max_size)
+    image_cache.max_size = config.get('image_cache_bytes', image_cache.max_size)
+    live.max_clients = config.get('live_clients', live.max_clients)
+    storage = config.get('storage', 'rrdtool')
+    if storage == 'store':
+        Stat.backend = Store()
+    elif storage != 'rrdtool':
+        raise ValueError("storage needs to be rrdtool or store")
+    elif rrdtool is None and 'agent' not in config:
+        raise ImportError('rrdtool is not installed, set "storage": "store" '
+                          'to run without it')
     # Defaults
+    stats.append(SelfStat(metrics))
     stats.append(CPUStat(config['cpu']['physical']))
+    if 'cpu_cores' in config:
+        stats.append(CPUCoreStat(top=config['cpu_cores'].get('top', 4)))
     stats.append(RAMStat())
+    if 'processes' in config:
+        stats.append(ProcessStat(config['processes'].get('top', 5),
+                                 config['processes'].get('groups'),
+                                 config['processes'].get('cmdline', False)))
     # Swap
     if config['swap']:
         stats.append(SwapStat())
-    # Nginx
-    if config['nginx'] != '':
-        stats.append(NginxStat(config['nginx']))
     # Network
     for dev, name in config['network_devices'].iteritems():
         stats.append(NetworkStat(dev, name))
+    # Nginx
+    NginxStat.timeout = float(config.get('nginx_timeout', NginxStat.timeout))
+    if isinstance(config['nginx'], dict):
+        for url, name in config['nginx'].iteritems():
+            stats.append(NginxStat(url, name))
+    elif config['nginx'] != '':
+        stats.append(NginxStat(config['nginx']))
+    # Redis
+    RedisStat.timeout = float(config.get('redis_timeout', RedisStat.timeout))
+    for url, name in config.get('redis', {}).iteritems():
+        stats.append(RedisStat(url, name))
     # Hdd io
     for dev, name in config['hdd_io'].iteritems():
         stats.append(HDDIO(dev, name))
+    for pattern in config.get('hdd_io_discover', []):
+        if pattern.startswith('re:'):
+            disk_matchers.append(re.compile(pattern[3:] + '$').match)
+        else:
+            disk_matchers.append(
+                lambda dev, pattern=pattern: fnmatch.fnmatchcase(dev, pattern))
     # Hdd usage
     for dev, name in config['hdd_usage'].iteritems():
         stats.append(HDDUsage(dev, name))
+    usage_fs_types.update(config.get('hdd_usage_fs_types', []))
+    # Agent mode, samples are shipped to an aggregator in batches
+    if 'agent' in config:
+        agent = config['agent']
+        host, _, port = agent['aggregator'].rpartition(':')
+        aggregator_address = (host, int(port))
+        flush_interval = float(agent.get('interval', 10))
+        shipper = Shipper(agent.get('host', socket.gethostname()),
+                          agent.get('spool_batches', 1000),
+                          agent.get('window', 4),
+                          agent.get('spool', 'agent.spool'),
+                          agent.get('secret'))
+        shipper.open()
+        Stat.write_buffer = shipper
+        for s in stats:
+            shipper.define(s)
+        return
+    # Take in samples from agents
+    if 'aggregator' in config:
+        aggregator_port = config['aggregator'].get('port', 8125)
+        aggregator_interface = config['aggregator'].get('interface',
+                                                        '127.0.0.1')
+        aggregator = AggregatorFactory(
+            config['aggregator'].get('directory', 'hosts'), collect_pool,
+            add_remote_stat, config['aggregator'].get('secret'))
     # Run all
     for s in stats:
         # Create rrds
         s.create_rrd()
-        # Store the image prefix generators
-        for prefix in s.IMAGE_PREFIXES:
-            image_map[prefix] = s
-            image_gen_times[prefix] = {}
-            # Cache the last creation time (0)
-            for period in Stat.IMAGE_PERIODS:
-                image_gen_times[prefix][period] = 0
+        register_images(s)
+    # Buffer rrd updates, once the rrds exist to replay the journal into
+    rrd_buffer = config.get('rrd_buffer', {})
+    flush_interval = float(rrd_buffer.get('flush_interval', flush_interval))
+    # Store writes only touch the page cache, there is nothing to batch
+    if flush_interval > 0 and Stat.backend is None:
+        Stat.write_buffer = WriteBuffer(rrd_buffer.get('journal', 'rrd.journal'),
+                                        rrd_buffer.get('fsync', 'flush'))
+        Stat.write_buffer.open()
 
 # Common code
 load_stats()
 # Serve http web directory
 root = DynamicStatFiles("./")
+debug = resource.Resource()
+debug.putChild('render', JSONResource(farm.status))
+debug.putChild('ticks', JSONResource(lambda: ticks))
+debug.putChild('metrics', JSONResource(metrics.status))
+debug.putChild('profile', ProfileResource())
+debug.putChild('live', JSONResource(live.status))
+if shipper is not None:
+    debug.putChild('agent', JSONResource(shipper.status))
+if aggregator is not None:
+    debug.putChild('aggregator', JSONResource(aggregator.status))
+root.putChild('debug', debug)
+api = resource.Resource()
+api.putChild('series', SeriesResource())
+api.putChild('export', ExportResource())
+api.putChild('bundle', BundleResource())
+api.putChild('live', LiveResource())
+api.putChild('hosts', JSONResource(hosts))
+for s in stats:
+    if isinstance(s, ProcessStat):
+        api.putChild('processes', JSONResource(s.status))
+root.putChild('api', api)
+root.putChild('graphs.json', JSONResource(graph_prefixes))
+# Collection threads live as long as the reactor
+reactor.callWhenRunning(collect_pool.start)
+reactor.addSystemEventTrigger('during', 'shutdown', collect_pool.stop)
+# Render workers are forked once running, so they outlive twistd daemonizing.
+# Store data isn't graphed, so they would have nothing to do
+if shipper is None and Stat.backend is None:
+    reactor.callWhenRunning(farm.start)
+    reactor.addSystemEventTrigger('during', 'shutdown', farm.stop)
 # Bootstrap crontab calling
-reactor.callLater(1, update_stats)
+reactor.callWhenRunning(lambda: [schedule(s.step) for s in stats])
+task.LoopingCall(live.keepalive).start(LIVE_KEEPALIVE, now=False)
+# Requests are timed in metrics
+site = server.Site(root)
+site.requestFactory = TimedRequest
+# Queues and caches are read as metrics gauges
+metrics.gauge('render_queue', lambda: len(farm.queue))
+metrics.gauge('collect_queue', lambda: collect_pool.q.qsize())
+metrics.gauge('collect_threads', lambda: len(collect_pool.working))
+metrics.gauge('image_cache', lambda: {'items': len(image_cache),
+                                      'bytes': image_cache.size,
+                                      'hits': image_cache.hits,
+                                      'misses': image_cache.misses})
+metrics.gauge('export_cache', lambda: {'items': len(export_cache),
+                                       'bytes': export_cache.size,
+                                       'hits': export_cache.hits,
+                                       'misses': export_cache.misses})
+metrics.gauge('live_clients', lambda: len(live.clients))
+if disk_matchers or usage_fs_types:
+    # Right away, so their graphs are there from the start
+    reactor.callWhenRunning(task.LoopingCall(discover).start, 60.0)
+# Write buffered rrd samples periodically and on the way out
+if Stat.write_buffer is not None:
+    task.LoopingCall(flush_rrds).start(flush_interval, now=False)
+    reactor.addSystemEventTrigger('before', 'shutdown', Stat.write_buffer.close)
+if Stat.backend is not None:
+    reactor.addSystemEventTrigger('before', 'shutdown', Stat.backend.close)
 
 if __name__ == '__main__':  # Called directly
-    reactor.listenTCP(8080, server.Site(root))
+    if shipper is not None:
+        # Agents only collect, and don't serve anything
+        reactor.connectTCP(aggregator_address[0], aggregator_address[1],
+                           AgentFactory(shipper))
+    else:
+        reactor.listenTCP(8080, site)
+    if aggregator is not None:
+        reactor.listenTCP(aggregator_port, aggregator,
+                          interface=aggregator_interface)
     # Run!
     reactor.run()
 else:  # Invoked through twistd
     application = service.Application("SSSSUP Server")
-    internet.TCPServer(8080, server.Site(root)).setServiceParent(application)
+    if shipper is not None:
+        internet.TCPClient(aggregator_address[0], aggregator_address[1],
+                           AgentFactory(shipper)).setServiceParent(application)
+    else:
+        internet.TCPServer(8080, site).setServiceParent(application)
+    if aggregator is not None:
+        internet.TCPServer(aggregator_port, aggregator,
+                           interface=aggregator_interface).setServiceParent(
+            application)
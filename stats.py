@@ -1,8 +1,30 @@
+import fnmatch
+import heapq
 import os
-import rrdtool
+import re
 import simplejson
-import subprocess
-import urllib2
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from itertools import izip
+
+try:
+    import rrdtool
+except ImportError:
+    # Only "storage": "store" works without the rrdtool bindings
+    rrdtool = None
+
+from twisted.internet import reactor
+from twisted.python import failure
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
+
+from procfs import read_cmdline, scan_processes
+from resp import RedisClient
+from series import NAN, Series
+from store import CONSOLIDATIONS
+from writeback import rrd_sample
 
 
 def get_config(file_path):
@@ -22,9 +44,17 @@ def get_config(file_path):
         return None
 
 
+def safe_name(name):
+    """Return name with anything but letters, digits, _ and - replaced by
+    -, to go in file names and image prefixes
+    """
+    return re.sub(r'[^\w\-]', '-', name)
+
+
 class DS(object):
     GAUGE, DERIVE = "GAUGE", "DERIVE"
-    AVERAGE, MINIMUM, MAXIMUM, LAST = "AVERAGE", "MINIMUM", "MAXIMUM", "LAST"
+    # The rrdtool names, which store.RoundRobinFile uses too
+    AVERAGE, MINIMUM, MAXIMUM, LAST = CONSOLIDATIONS
 
     @staticmethod
     def ds(names=None, dstype=None, interval=120, llimit=0, ulimit="U"):
@@ -51,6 +81,25 @@ class DS(object):
                                               ulimit))
         return ret
 
+    @staticmethod
+    def heartbeat(sources, interval):
+        """Return a copy of DS strings with a different stat timeout
+
+        Arguments:
+        sources - list of DS strings
+        interval - stat timeout
+
+        Return:
+        list of DS strings
+
+        """
+        ret = []
+        for source in sources:
+            parts = source.split(':')
+            parts[3] = str(interval)
+            ret.append(':'.join(parts))
+        return ret
+
     @staticmethod
     def rra(cf=None, steps=None, rows=None):
         """Return a list of rrdtool RRA strings
@@ -67,7 +116,7 @@ class DS(object):
         """
         ret = []
         for step, row in zip(steps, rows):
-            if cf not in [DS.AVERAGE, DS.MINIMUM, DS.MAXIMUM, DS.LAST]:
+            if cf not in CONSOLIDATIONS:
                 raise ValueError("Need a proper cf value")
             if not isinstance(step, int):
                 raise ValueError("Step needs to be an int")
@@ -80,21 +129,63 @@ class DS(object):
 class Stat(object):
     """Generic stat collection class.
     Must implement read and write data
-    TODO: abstract rrd data sources
-    TODO: subprocess calls for rrdtool in twisted for async
     """
-    AVERAGES = DS.rra(DS.AVERAGE, [1, 30, 120, 720], [2880, 672, 732, 1460])
+    # Seconds kept at full resolution, then (seconds per row, rows) of each
+    # consolidated archive: 2 days, then 30 minutes for 2 weeks, 2 hours for
+    # 2 months and 12 hours for 2 years
+    FULL_RESOLUTION = 172800
+    CONSOLIDATED = [(1800, 672), (7200, 732), (43200, 1460)]
     IMAGE_PREFIXES = []
     IMAGE_PERIODS = ['hour', 'day', 'week', 'month', 'year']
+    PERIOD_SECONDS = {'hour': 3600, 'day': 86400, 'week': 604800,
+                      'month': 2678400, 'year': 31536000}
+    IMAGE_FORMATS = ['PNG', 'SVG']
+    # Seconds of recent samples kept in memory
+    series_window = 3600
+    # Config section of the stat, used to look up its interval
+    CONFIG_KEY = None
+    # Seconds between samples by config section, default: 60
+    intervals = {}
+    # writeback.WriteBuffer shared by all stats, None to update directly
+    write_buffer = None
+    # store.Store to keep data in instead of rrds, None for rrdtool
+    backend = None
+    # If True, read_stat is called in the reactor thread and returns a
+    # deferred, for stats that wait on the network instead of reading files
+    ASYNC = False
 
     def __init__(self, file_name, rrd_data_source, averages=None):
+        self.step = Stat.intervals.get(self.CONFIG_KEY, 60)
+        if self.step < 1 or Stat.CONSOLIDATED[0][0] % self.step:
+            raise ValueError("Interval of %s needs to divide %s seconds" %
+                             (file_name, Stat.CONSOLIDATED[0][0]))
         self.rrd_file_name = file_name
-        self.rrd_data_source = rrd_data_source
+        # Data is unknown once two samples in a row are missing
+        self.rrd_data_source = DS.heartbeat(rrd_data_source, 2 * self.step)
         if averages is None:
-            self.averages = Stat.AVERAGES
+            self.averages = Stat.averages_for(self.step)
         else:
             self.averages = averages
         self.stats = {}
+        # series.Series of recent samples, made on the first update
+        self.series = None
+
+    @staticmethod
+    def averages_for(step):
+        """Return RRA strings for a stat sampled every step seconds.
+        The archives cover the same time whatever the step
+
+        Arguments:
+        step - seconds between samples
+
+        Return:
+        list of RRA strings
+
+        """
+        steps = [1] + [seconds // step for seconds, rows in Stat.CONSOLIDATED]
+        rows = [Stat.FULL_RESOLUTION // step] + \
+            [rows for seconds, rows in Stat.CONSOLIDATED]
+        return DS.rra(DS.AVERAGE, steps, rows)
 
     def create_rrd(self):
         """Create RRD file if it doesn't already exist
@@ -103,29 +194,199 @@ class Stat(object):
         self.rrd_data_source - array of rrd data definitions
 
         """
-        # TODO: check for matching data sources
-        if not os.path.isfile(self.rrd_file_name):
-            rrdtool.create(self.rrd_file_name, *self.rrd_data_source + self.averages)
+        if Stat.backend is not None:
+            if not Stat.backend.exists(self.rrd_file_name):
+                Stat.backend.create(self.rrd_file_name, self.step,
+                                    self.rrd_data_source, self.averages)
+                return
+            f = Stat.backend.open(self.rrd_file_name)
+            info = dict(('ds[%s].type' % name, None) for name in f.names)
+            info['step'] = f.step
+        elif not os.path.isfile(self.rrd_file_name):
+            rrdtool.create(self.rrd_file_name, "--step", str(self.step),
+                           *self.rrd_data_source + self.averages)
+            return
+        else:
+            info = rrdtool.info(self.rrd_file_name)
+        if info['step'] != self.step:
+            print '%s has a %ss step instead of %ss, remove it to change it' % \
+                (self.rrd_file_name, info['step'], self.step)
+        # Add data sources that rrds made by older versions don't have yet
+        missing = [ds for ds in self.rrd_data_source
+                   if 'ds[%s].type' % ds.split(':')[1] not in info]
+        if missing and Stat.backend is not None:
+            print '%s has no %s, remove it to add them' % \
+                (Stat.backend.path(self.rrd_file_name),
+                 ', '.join(ds.split(':')[1] for ds in missing))
+        elif missing:
+            rrdtool.tune(self.rrd_file_name, *missing)
+
+    def last_update(self):
+        """Return the unix time of the newest sample written
+        """
+        if Stat.backend is not None:
+            return Stat.backend.last(self.rrd_file_name)
+        return rrdtool.last(self.rrd_file_name)
 
-    def update_stat(self):
+    def update_stat(self, timestamp=None):
         """Update RRD file with key value pairs from self.stats
+        If Stat.write_buffer is set, the sample is buffered there and
+        written later in a batch, if Stat.backend is, it is written there
+        instead of the rrd. The sample is also kept in self.series
         Uses:
         self.stats
 
+        Keyword Arguments:
+        timestamp - unix time the values were read at, default: now
+
         """
-        # TODO: check for matching data sources
+        if timestamp is None:
+            timestamp = time.time()
+        template = ":".join(self.stats.keys())
+        values = [self.stats[x] for x in self.stats]
+        if self.series is None:
+            counters = [ds.split(':')[1] for ds in self.rrd_data_source
+                        if ds.split(':')[2] == DS.DERIVE]
+            self.series = Series(self.stats.keys(), counters,
+                                 max(1, Stat.series_window // self.step))
+        self.series.add(timestamp, values)
+        if Stat.write_buffer is not None:
+            Stat.write_buffer.add(self.rrd_file_name, template, timestamp,
+                                  values)
+            return
+        if Stat.backend is not None:
+            Stat.backend.update(self.rrd_file_name, template,
+                                int(round(timestamp)), values)
+            return
         # Update RRD values
         rrdtool.update(
             self.rrd_file_name,
             "-t",
-            ":".join(self.stats.keys()),
-            "N:%s" % (":".join([str(self.stats[x]) for x in self.stats]))
+            template,
+            rrd_sample(timestamp, values)
         )
 
-    def read_stat(self):
-        raise NotImplemented("Read Stat not implemented")
+    def resolution(self, seconds):
+        """Return the seconds per row of the finest archive that covers
+        seconds, the one rrdtool reads a graph of that range from
+
+        Arguments:
+        seconds - length of the time range
+
+        """
+        for rra in self.averages:
+            steps, rows = [int(x) for x in rra.split(':')[3:5]]
+            if steps * rows * self.step >= seconds:
+                break
+        return steps * self.step
+
+    def consolidations(self):
+        """Return the sorted consolidation functions of the archives, the
+        cf values export takes
+        """
+        return sorted(set(rra.split(':')[1] for rra in self.averages))
+
+    def export(self, cf, resolution, start, end):
+        """Export the consolidated values of all data sources
+
+        Arguments:
+        cf - one of DS.AVERAGE, DS.MINIMUM, DS.MAXIMUM, DS.LAST
+        resolution - seconds per row
+        start - unix time of the start of the range
+        end - unix time of the end of the range
+
+        Return:
+        tuple of (list of data source names, list of rows), each row being
+        a list of the row's time followed by the values, None if unknown
+
+        """
+        if Stat.backend is not None:
+            names, first, step, rows = Stat.backend.fetch(
+                self.rrd_file_name, cf, resolution, start, end)
+            return names, [[first + i * step] +
+                           [None if x != x else x for x in row]
+                           for i, row in enumerate(rows)]
+        names = [ds.split(':')[1] for ds in self.rrd_data_source]
+        args = ["-s", str(start), "-e", str(end), "--step", str(resolution)]
+        for name in names:
+            args.append("DEF:%s=%s:%s:%s" % (name, self.rrd_file_name, name, cf))
+            args.append("XPORT:%s:%s" % (name, name))
+        ret = rrdtool.xport(*args)
+        start, step = ret['meta']['start'], ret['meta']['step']
+        # Rows are stamped with the end of the time they cover
+        rows = [[start + (i + 1) * step] + list(row)
+                for i, row in enumerate(ret['data'])]
+        return names, rows
+
+    def read_stat(self, snapshot):
+        """Read current values into self.stats. Runs in a collection
+        thread, or in the reactor if ASYNC is set
+
+        Arguments:
+        snapshot - procfs.Snapshot shared by all stats of this cycle
+
+        Return:
+        None, or if ASYNC is set a deferred that fires once self.stats is
+        read
+
+        """
+        raise NotImplementedError("Read Stat not implemented")
 
     def make_image(self, prefix, period):
+        """Render the image for prefix over period
+
+        Return:
+        image data
+
+        """
+        return rrdtool.graphv('-', *self.graph_args(prefix, period))['image']
+
+    def image_args(self, prefix, period, width, height, fmt, thumb=False):
+        """Return the rrdtool.graph arguments for a variant of an image
+
+        Thumbnails draw only the graph, without title, axes and legend, and
+        leave out the GPRINTs, so rrdtool doesn't work them out either.
+
+        Arguments:
+        prefix - one of self.IMAGE_PREFIXES
+        period - one of self.IMAGE_PERIODS
+        width - image width in pixels
+        height - image height in pixels
+        fmt - one of self.IMAGE_FORMATS
+        thumb - whether to draw a thumbnail, default: False
+
+        Return:
+        list of rrdtool.graph arguments, without the image file name
+
+        """
+        if fmt not in self.IMAGE_FORMATS:
+            raise Exception("Format: %s not in image formats" % (fmt))
+        options = {'-w': str(width), '-h': str(height), '-a': fmt}
+        args = iter(self.graph_args(prefix, period))
+        ret = []
+        for arg in args:
+            if arg in options:
+                # Replace the option's value, which follows it
+                next(args)
+                ret.extend([arg, options[arg]])
+            elif not (thumb and arg.startswith(('GPRINT:', 'COMMENT:'))):
+                ret.append(arg)
+        if thumb:
+            ret.append('--only-graph')
+        return ret
+
+    def graph_args(self, prefix, period):
+        """Return the rrdtool.graph arguments for an image.
+        Subclasses extend this with their graph definitions
+
+        Arguments:
+        prefix - one of self.IMAGE_PREFIXES
+        period - one of self.IMAGE_PERIODS
+
+        Return:
+        list of rrdtool.graph arguments, without the image file name
+
+        """
         if prefix not in self.IMAGE_PREFIXES:
             raise Exception("Prefix: %s not in image prefixes" % (prefix))
         if period not in self.IMAGE_PERIODS:
@@ -135,6 +396,7 @@ class Stat(object):
 class CPUStat(Stat):
     """Collect CPU usage information
     """
+    CONFIG_KEY = 'cpu'
     FILE_NAME = 'cpu.rrd'
     RRD_DATA_SOURCES = DS.ds(["user", "nice", "system", "idle", "wait", 'irq', 'softirq'],
                              DS.DERIVE)
@@ -156,8 +418,8 @@ class CPUStat(Stat):
         self.stats['irq'] = 0
         self.stats['softirq'] = 0
 
-    def read_stat(self):
-        stats = [int(x) for x in open("/proc/stat", 'r').readline().split()[1:8]]
+    def read_stat(self, snapshot):
+        stats = snapshot.stat['cpu'][0:7]
         self.stats['user'] = stats[0]
         self.stats['nice'] = stats[1]
         self.stats['system'] = stats[2]
@@ -166,13 +428,11 @@ class CPUStat(Stat):
         self.stats['irq'] = stats[5]
         self.stats['softirq'] = stats[6]
 
-    def make_image(self, prefix, period):
-        super(CPUStat, self).make_image(prefix, period)
-        rrdtool.graph(
-            "%s_%s.png" % (prefix, period),
+    def graph_args(self, prefix, period):
+        super(CPUStat, self).graph_args(prefix, period)
+        return [
             "-s -1%s" % period,
             "-t Cpu usage",
-            "--lazy",
             "-h", "300", "-w", "700", "--full-size-mode", "-T", "10",
             "-r",
             "-l 0",
@@ -234,15 +494,315 @@ class CPUStat(Stat):
             # this is particularly usefull if you have hyperthreading
             # or if you change processor count
             "HRULE:%s#000000:Max Usage" % (self.pcpu * 100),
-        )
+        ]
+
+
+class CPUCoreStat(Stat):
+    """Collect the usage of every cpu core, in one rrd
+
+    The busy percent of each core is worked out from the cpuN lines of the
+    shared /proc/stat snapshot, against arrays of the previous totals.
+    Next to a data source per core, the average over the cores and the
+    busiest cores of each sample, ranked, are stored too. The graph only
+    draws those, so it is the same size whatever the core count.
+    """
+    CONFIG_KEY = 'cpu_cores'
+    FILE_NAME = 'cpu_cores.rrd'
+    IMAGE_PREFIXES = ['cpu_cores']
+    # Fields of a cpu line up to steal, the guest fields are in user already
+    FIELDS = 8
+    TOP_COLORS = ['#FF0000', '#FF9C0F', '#FFCC00', '#000099', '#FF00D0',
+                  '#00E4FF', '#000000', '#999999']
+
+    def __init__(self, cores=None, top=4):
+        """
+        Keyword Arguments:
+        cores - number of cpu cores, default: the number configured
+        top - number of busiest cores to keep, default: 4
+
+        """
+        self.cores = cores or os.sysconf('SC_NPROCESSORS_CONF')
+        self.top = min(top, self.cores)
+        self.lines = ['cpu%d' % i for i in xrange(self.cores)]
+        self.top_names = ['top%d' % (i + 1) for i in xrange(self.top)]
+        self.core_names = ['core%d' % i for i in xrange(self.cores)]
+        names = ['avg'] + self.top_names + self.core_names
+        super(CPUCoreStat, self).__init__(
+            self.FILE_NAME, DS.ds(names, DS.GAUGE, ulimit=100))
+        # Same order as the data sources, so the template matches
+        self.stats = OrderedDict((name, NAN) for name in names)
+        # Totals and idle times of the cores at the last reading
+        self.totals = array('d', [NAN]) * self.cores
+        self.idles = array('d', [NAN]) * self.cores
+
+    def read_stat(self, snapshot):
+        cpus = snapshot.stat
+        totals = array('d', [NAN]) * self.cores
+        idles = array('d', [NAN]) * self.cores
+        for i, line in enumerate(self.lines):
+            # Offline cores have no line, and stay unknown
+            fields = cpus.get(line)
+            if fields is not None:
+                totals[i] = sum(fields[:self.FIELDS])
+                # idle and iowait
+                idles[i] = fields[3] + fields[4]
+        busy = [100.0 - 100.0 * (idle - last_idle) / (total - last_total)
+                if total > last_total else NAN
+                for total, idle, last_total, last_idle
+                in izip(totals, idles, self.totals, self.idles)]
+        # iowait can go backwards, keep within 0 to 100
+        busy = [min(100.0, max(0.0, x)) if x == x else NAN for x in busy]
+        self.totals, self.idles = totals, idles
+        known = sorted([x for x in busy if x == x], reverse=True)
+        self.stats['avg'] = sum(known) / len(known) if known else NAN
+        self.stats.update(izip(self.top_names,
+                               known[:self.top] + [NAN] * self.top))
+        self.stats.update(izip(self.core_names, busy))
+
+    def graph_args(self, prefix, period):
+        super(CPUCoreStat, self).graph_args(prefix, period)
+        ret = [
+            "-s -1%s" % period,
+            "-t Busiest of %s cpu cores" % self.cores,
+            "-h", "300", "-w", "700", "--full-size-mode", "-T", "10",
+            "-r",
+            "-l 0",
+            "-u 100",
+            "-a", "PNG",
+            "-v percent busy",
+            "DEF:avg=%s:avg:AVERAGE" % self.FILE_NAME,
+
+            "AREA:avg#32CD32:Average  ",
+            "GPRINT:avg:MIN:Min\\: %3.0lf ",
+            "GPRINT:avg:AVERAGE:\\tAvg\\: %3.0lf ",
+            "GPRINT:avg:MAX:\\tMax\\: %3.0lf ",
+            "GPRINT:avg:LAST:\\tCurrent\\: %3.0lf \\n",
+        ]
+        for i in xrange(self.top):
+            name = 'top%d' % (i + 1)
+            ret += [
+                "DEF:%s=%s:%s:AVERAGE" % (name, self.FILE_NAME, name),
+                "LINE1:%s%s:Busiest %-2d" % (
+                    name, self.TOP_COLORS[i % len(self.TOP_COLORS)], i + 1),
+                "GPRINT:%s:MIN:Min\\: %%3.0lf " % name,
+                "GPRINT:%s:AVERAGE:\\tAvg\\: %%3.0lf " % name,
+                "GPRINT:%s:MAX:\\tMax\\: %%3.0lf " % name,
+                "GPRINT:%s:LAST:\\tCurrent\\: %%3.0lf \\n" % name,
+            ]
+        return ret
+
+
+class ProcessStat(Stat):
+    """Collect the processes using the most cpu and memory
+
+    Every sample scans /proc/<pid>/stat of all processes, and works out
+    the cpu time used since the last scan against a dictionary of the
+    previous totals, keyed by pid and start time so reused pids count as
+    new processes. What is stored is only the top consumers, ranked, the
+    totals and the totals of configured groups of process names, so the
+    rrd keeps the same data sources however many processes come and go.
+    Which processes the top ones were is kept in memory, see status.
+    Command lines can hold passwords, so they're only read if asked for.
+    """
+    CONFIG_KEY = 'processes'
+    FILE_NAME = 'processes.rrd'
+    TOP_COLORS = CPUCoreStat.TOP_COLORS
+    GROUP_COLORS = ['#0022FF', '#32CD32', '#FF9C0F', '#FF00D0', '#00E4FF',
+                    '#FFCC00', '#000099', '#FF0000']
+    CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+    def __init__(self, top=5, groups=None, cmdline=False):
+        """
+        Keyword Arguments:
+        top - number of processes kept, by cpu and by memory, default: 5
+        groups - list of fnmatch patterns of process names, each summed
+        up on its own, the first match counting, default: none
+        cmdline - whether status has the command lines of the top
+        processes, default: False
+
+        """
+        self.top = top
+        self.groups = list(groups or [])
+        self.cmdline = cmdline
+        self.cpu_names = ['cpu_top%d' % (i + 1) for i in xrange(top)]
+        self.rss_names = ['rss_top%d' % (i + 1) for i in xrange(top)]
+        # By index, so patterns don't have to make valid data source names
+        self.group_names = [('group%d_cpu' % (i + 1), 'group%d_rss' % (i + 1))
+                            for i in xrange(len(self.groups))]
+        names = ['procs', 'cpu', 'rss'] + self.cpu_names + self.rss_names + \
+            [name for pair in self.group_names for name in pair]
+        super(ProcessStat, self).__init__(
+            self.FILE_NAME, DS.ds(names, DS.GAUGE))
+        self.IMAGE_PREFIXES = ['processes_cpu', 'processes_rss']
+        if self.groups:
+            self.IMAGE_PREFIXES += ['processes_groups_cpu',
+                                    'processes_groups_rss']
+        # Same order as the data sources, so the template matches
+        self.stats = OrderedDict((name, NAN) for name in names)
+        # (pid, start time) -> cpu ticks at the last scan, None before the
+        # first one
+        self.ticks = None
+        self.time = None
+        # (pid, start time) -> [comm, group index, command line], read once
+        # per process, the command line only once it makes the top
+        self.known = {}
+        self.current = {'time': None, 'cpu': [], 'rss': []}
+
+    def group(self, comm):
+        """Return the index of the first group matching a process name, or
+        None
+        """
+        for i, pattern in enumerate(self.groups):
+            if fnmatch.fnmatchcase(comm, pattern):
+                return i
+        return None
+
+    def read_stat(self, snapshot):
+        processes = scan_processes(snapshot.root)
+        keys = [(pid, start) for pid, comm, start, ticks, pages in processes]
+        ticks = [x[3] for x in processes]
+        rss = [x[4] * self.PAGE_SIZE for x in processes]
+        if self.ticks is None or snapshot.time <= self.time:
+            cpu = None
+        else:
+            # Processes missing from the last scan started since, so all
+            # of their time is new
+            last = self.ticks
+            scale = 100.0 / (self.CLOCK_TICKS * (snapshot.time - self.time))
+            cpu = [(total - last.get(key, 0)) * scale
+                   for key, total in izip(keys, ticks)]
+        self.ticks = dict(izip(keys, ticks))
+        self.time = snapshot.time
+        # Only live processes are kept, so churn doesn't pile up
+        known = self.known
+        infos = []
+        for key, process in izip(keys, processes):
+            info = known.get(key)
+            # A process that execs keeps its pid and start time
+            if info is None or info[0] != process[1]:
+                info = [process[1], self.group(process[1]), None]
+            infos.append(info)
+        self.known = dict(izip(keys, infos))
+
+        self.stats['procs'] = len(processes)
+        self.stats['rss'] = sum(rss)
+        by_rss = heapq.nlargest(self.top, xrange(len(rss)),
+                                key=rss.__getitem__)
+        self.stats.update(izip(self.rss_names,
+                               [rss[i] for i in by_rss] + [NAN] * self.top))
+        group_cpu = [0.0] * len(self.groups)
+        group_rss = [0] * len(self.groups)
+        if cpu is None:
+            self.stats['cpu'] = NAN
+            self.stats.update((name, NAN) for name in self.cpu_names)
+            by_cpu = []
+        else:
+            self.stats['cpu'] = sum(cpu)
+            by_cpu = heapq.nlargest(self.top, xrange(len(cpu)),
+                                    key=cpu.__getitem__)
+            self.stats.update(izip(self.cpu_names,
+                                   [cpu[i] for i in by_cpu] + [NAN] * self.top))
+        if self.groups:
+            for i, info in enumerate(infos):
+                if info[1] is not None:
+                    group_rss[info[1]] += rss[i]
+                    if cpu is not None:
+                        group_cpu[info[1]] += cpu[i]
+            for (cpu_name, rss_name), used, resident in \
+                    izip(self.group_names, group_cpu, group_rss):
+                self.stats[cpu_name] = used if cpu is not None else NAN
+                self.stats[rss_name] = resident
+
+        def describe(i):
+            info = infos[i]
+            ret = {'pid': processes[i][0], 'name': info[0], 'rss': rss[i],
+                   'cpu': cpu[i] if cpu is not None else None}
+            if self.cmdline:
+                if info[2] is None:
+                    info[2] = read_cmdline(snapshot.root, processes[i][0]) \
+                        or '[%s]' % info[0]
+                ret['command'] = info[2]
+            return ret
+        self.current = {'time': snapshot.time,
+                        'cpu': [describe(i) for i in by_cpu],
+                        'rss': [describe(i) for i in by_rss]}
+
+    def status(self):
+        """Return the processes of the latest sample: a dictionary of time
+        and lists cpu and rss of the top processes by each, as
+        dictionaries of pid, name, cpu (percent of one core), rss (bytes)
+        and, if cmdline is set, command
+        """
+        return self.current
+
+    def graph_args(self, prefix, period):
+        super(ProcessStat, self).graph_args(prefix, period)
+        kind = prefix.rpartition('_')[2]
+        if kind == 'cpu':
+            title, label, fmt = "cpu", "percent of a core", "%6.1lf"
+            ret = ["-l 0"]
+        else:
+            title, label, fmt = "memory", "resident", "%8.2lf %S"
+            ret = ["-l 0", "-b", "1024"]
+        ret += [
+            "-s -1%s" % period,
+            "-h", "300", "-w", "700", "--full-size-mode", "-T", "10",
+            "-a", "PNG",
+            "-v %s" % label,
+            "DEF:total=%s:%s:AVERAGE" % (self.FILE_NAME, kind),
+        ]
+        if prefix.startswith('processes_groups'):
+            ret.append("-t Process %s by group" % title)
+            other = "CDEF:other=total"
+            for i, pattern in enumerate(self.groups):
+                name = 'group%d' % (i + 1)
+                color = self.GROUP_COLORS[i % len(self.GROUP_COLORS)]
+                ret += [
+                    "DEF:%s=%s:%s_%s:AVERAGE" % (name, self.FILE_NAME, name,
+                                                 kind),
+                    "%s:%s%s:%-16s" % ("AREA" if i == 0 else "STACK", name,
+                                       color, pattern[:16]),
+                    "GPRINT:%s:AVERAGE:Avg\\: %s" % (name, fmt),
+                    "GPRINT:%s:MAX:\\tMax\\: %s" % (name, fmt),
+                    "GPRINT:%s:LAST:\\tCurrent\\: %s \\n" % (name, fmt),
+                ]
+                other += ",%s,-" % name
+            return ret + [
+                other,
+                "STACK:other#999999:%-16s" % "Other",
+                "GPRINT:other:AVERAGE:Avg\\: %s" % fmt,
+                "GPRINT:other:MAX:\\tMax\\: %s" % fmt,
+                "GPRINT:other:LAST:\\tCurrent\\: %s \\n" % fmt,
+            ]
+        ret += [
+            "-t Top %s processes by %s" % (self.top, title),
+            "AREA:total#32CD32:All      ",
+            "GPRINT:total:AVERAGE:Avg\\: %s" % fmt,
+            "GPRINT:total:MAX:\\tMax\\: %s" % fmt,
+            "GPRINT:total:LAST:\\tCurrent\\: %s \\n" % fmt,
+        ]
+        for i in xrange(self.top):
+            name = '%s_top%d' % (kind, i + 1)
+            ret += [
+                "DEF:%s=%s:%s:AVERAGE" % (name, self.FILE_NAME, name),
+                "LINE1:%s%s:Top %-5d" % (
+                    name, self.TOP_COLORS[i % len(self.TOP_COLORS)], i + 1),
+                "GPRINT:%s:AVERAGE:Avg\\: %s" % (name, fmt),
+                "GPRINT:%s:MAX:\\tMax\\: %s" % (name, fmt),
+                "GPRINT:%s:LAST:\\tCurrent\\: %s \\n" % (name, fmt),
+            ]
+        return ret
 
 
 class HDDIO(Stat):
     """Collect HDD IO usage information
     """
+    CONFIG_KEY = 'hdd_io'
     FILE_NAME = 'hdd_io_%s.rrd'
     RRD_DATA_SOURCES = DS.ds(["rrequests", "wrequests", "rsectors", "wsectors",
-                              "rticks", "wticks"], DS.DERIVE)
+                              "rticks", "wticks", "ioticks", "queueticks"],
+                             DS.DERIVE) + DS.ds(["inflight"], DS.GAUGE)
 
     def __init__(self, device, name):
         """
@@ -260,39 +820,37 @@ class HDDIO(Stat):
         self.stats['wsectors'] = 0
         self.stats['rticks'] = 0
         self.stats['wticks'] = 0
+        self.stats['inflight'] = 0
+        self.stats['ioticks'] = 0
+        self.stats['queueticks'] = 0
         self.IMAGE_PREFIXES = ['hdd_io_requests_%s' % self.device,
                                 'hdd_io_sectors_%s' % self.device,
-                                'hdd_io_ticks_%s' % self.device]
+                                'hdd_io_ticks_%s' % self.device,
+                                'hdd_io_queue_%s' % self.device]
 
-    def read_stat(self):
-        self.stats['rrequests'] = 0
-        self.stats['wrequests'] = 0
-        self.stats['rsectors'] = 0
-        self.stats['wsectors'] = 0
-        self.stats['rticks'] = 0
-        self.stats['wticks'] = 0
-        try:
-            values = open('/sys/block/%s/stat' % self.device, 'r').readlines()
-            values = values[0].rstrip().split()
+    def read_stat(self, snapshot):
+        values = snapshot.diskstats.get(self.device)
+        if values is None:
+            raise IOError("No %s in /proc/diskstats" % self.device)
 
-            self.stats['rrequests'] = int(values[0])
-            self.stats['rsectors'] = int(values[2])
-            self.stats['rticks'] = int(values[3])
+        self.stats['rrequests'] = values[0]
+        self.stats['rsectors'] = values[2]
+        self.stats['rticks'] = values[3]
 
-            self.stats['wrequests'] = int(values[4])
-            self.stats['wsectors'] = int(values[6])
-            self.stats['wticks'] = int(values[7])
-        except:
-            pass
+        self.stats['wrequests'] = values[4]
+        self.stats['wsectors'] = values[6]
+        self.stats['wticks'] = values[7]
 
-    def make_image(self, prefix, period):
-        super(HDDIO, self).make_image(prefix, period)
+        self.stats['inflight'] = values[8]
+        self.stats['ioticks'] = values[9]
+        self.stats['queueticks'] = values[10]
+
+    def graph_args(self, prefix, period):
+        super(HDDIO, self).graph_args(prefix, period)
         if prefix == 'hdd_io_requests_%s' % self.device:
-            rrdtool.graph(
-                "hdd_io_requests_%s_%s.png" % (self.device, period),
+            return [
                 "-s -1%s" % period,
                 "-t requests on %s :: %s" % (self.device, self.name),
-                "--lazy",
                 "-h", "300", "-w", "700", "--full-size-mode", "-T", "10",
                 "-l 0", "-b", "1000",
                 "-a", "PNG",
@@ -310,13 +868,11 @@ class HDDIO(Stat):
                 "GPRINT:wrequests:AVERAGE: Avg\\: %5.1lf %S",
                 "GPRINT:wrequests:LAST: Current\\: %5.1lf %S requests/sec",
                 "HRULE:0#000000"
-            )
+            ]
         elif prefix == 'hdd_io_sectors_%s' % self.device:
-            rrdtool.graph(
-                "hdd_io_sectors_%s_%s.png" % (self.device, period),
+            return [
                 "-s -1%s" % period,
                 "-t sectors on %s :: %s" % (self.device, self.name),
-                "--lazy",
                 "-h", "300", "-w", "700", "--full-size-mode", "-T", "10",
                 "-l 0", "-b", "1000",
                 "-a", "PNG",
@@ -334,13 +890,11 @@ class HDDIO(Stat):
                 "GPRINT:wsectors:AVERAGE: Avg\\: %5.1lf %S",
                 "GPRINT:wsectors:LAST: Current\\: %5.1lf %S sectors/sec",
                 "HRULE:0#000000"
-            )
+            ]
         elif prefix == 'hdd_io_ticks_%s' % self.device:
-            rrdtool.graph(
-                "hdd_io_ticks_%s_%s.png" % (self.device, period),
+            return [
                 "-s -1%s" % period,
                 "-t wait on %s :: %s" % (self.device, self.name),
-                "--lazy",
                 "-h", "300", "-w", "700", "--full-size-mode", "-T", "10",
                 "-l 0", "-b", "1000",
                 "-a", "PNG",
@@ -358,19 +912,53 @@ class HDDIO(Stat):
                 "GPRINT:wticks:AVERAGE: Avg\\: %5.1lf %S",
                 "GPRINT:wticks:LAST: Current\\: %5.1lf %S ms",
                 "HRULE:0#000000"
-            )
+            ]
+        elif prefix == 'hdd_io_queue_%s' % self.device:
+            return [
+                "-s -1%s" % period,
+                "-t queue on %s :: %s" % (self.device, self.name),
+                "-h", "300", "-w", "700", "--full-size-mode", "-T", "10",
+                "-l 0",
+                "-a", "PNG",
+                "-v requests / % busy",
+                "DEF:inflight=%s:inflight:AVERAGE" % self.FILE_NAME % self.device,
+                "DEF:ioticks=%s:ioticks:AVERAGE" % self.FILE_NAME % self.device,
+                "DEF:queueticks=%s:queueticks:AVERAGE" % self.FILE_NAME % self.device,
+                # ms spent doing io per second -> % of time busy
+                "CDEF:busy=ioticks,10,/",
+                # weighted ms per second -> average queue size
+                "CDEF:queue=queueticks,1000,/",
+                "TEXTALIGN:left",
+                "AREA:busy#FFCC66:Busy %     ",
+                "GPRINT:busy:MAX:  Max\\: %5.1lf",
+                "GPRINT:busy:AVERAGE: Avg\\: %5.1lf",
+                "GPRINT:busy:LAST: Current\\: %5.1lf %%\\n",
+                "LINE2:queue#FF0000:Avg queue  ",
+                "GPRINT:queue:MAX:  Max\\: %5.1lf",
+                "GPRINT:queue:AVERAGE: Avg\\: %5.1lf",
+                "GPRINT:queue:LAST: Current\\: %5.1lf requests\\n",
+                "LINE1:inflight#000099:In flight  ",
+                "GPRINT:inflight:MAX:  Max\\: %5.1lf",
+                "GPRINT:inflight:AVERAGE: Avg\\: %5.1lf",
+                "GPRINT:inflight:LAST: Current\\: %5.1lf requests",
+                "HRULE:0#000000"
+            ]
 
 
 class HDDUsage(Stat):
     """Collect HDD disk usage information
     """
+    CONFIG_KEY = 'hdd_usage'
     FILE_NAME = 'hdd_usage_%s.rrd'
-    RRD_DATA_SOURCES = DS.ds(["used", "free"], DS.GAUGE)
+    RRD_DATA_SOURCES = DS.ds(["used", "free", "inodes_used", "inodes_free"],
+                             DS.GAUGE)
+    # Seconds statvfs gets before a mount is considered hung
+    STATVFS_TIMEOUT = 5.0
 
     def __init__(self, device, name):
         """
         Arguments:
-        device - device name
+        device - device name, or mount point
         name - human name of device
 
         """
@@ -381,30 +969,88 @@ class HDDUsage(Stat):
                                        self.RRD_DATA_SOURCES)
         self.stats['used'] = 0
         self.stats['free'] = 0
-        self.IMAGE_PREFIXES = ['hdd_usage_%s' % self.clean_device]
-
-    def read_stat(self):
-        try:
-            lines = subprocess.check_output(['df', self.device]).split('\n')
-            if len(lines) < 2:
-                return
-            # Do this instead of assinging to vars, in case the last one
-            # has spaces...hopefully the device doesnt...
-            info = lines[1].split()
-            if info[0] != self.device:
-                return
-            self.stats['used'] = int(info[2]) * 1024
-            self.stats['free'] = int(info[3]) * 1024
-        except:
-            pass
+        self.stats['inodes_used'] = 0
+        self.stats['inodes_free'] = 0
+        self.IMAGE_PREFIXES = ['hdd_usage_%s' % self.clean_device,
+                               'hdd_inodes_%s' % self.clean_device]
+        # Thread of a statvfs call that never returned
+        self.hung = None
+
+    def mount_point(self, snapshot):
+        """Return where self.device is mounted, or None if it isn't
+        """
+        for mount_point, fs_type, source in snapshot.mounts:
+            if self.device in (mount_point, source):
+                return mount_point
+        return None
 
-    def make_image(self, prefix, period):
-        super(HDDUsage, self).make_image(prefix, period)
-        rrdtool.graph(
-            "%s_%s.png" % (prefix, period),
+    def read_stat(self, snapshot):
+        mount_point = self.mount_point(snapshot)
+        if mount_point is None:
+            raise IOError("%s is not mounted" % self.device)
+        # statvfs can block forever on a dead network mount, so run it in a
+        # watchdog thread, and don't start another while one is stuck
+        if self.hung is not None and self.hung.is_alive():
+            raise IOError("%s is still hung" % mount_point)
+        self.hung = None
+        result = []
+
+        def statvfs():
+            try:
+                result.append(os.statvfs(mount_point))
+            except OSError as e:
+                result.append(e)
+
+        thread = threading.Thread(target=statvfs, name='statvfs %s' % mount_point)
+        thread.daemon = True
+        thread.start()
+        thread.join(self.STATVFS_TIMEOUT)
+        if thread.is_alive():
+            self.hung = thread
+            raise IOError("statvfs on %s timed out" % mount_point)
+        if isinstance(result[0], OSError):
+            raise result[0]
+        vfs = result[0]
+        self.stats['used'] = (vfs.f_blocks - vfs.f_bfree) * vfs.f_frsize
+        self.stats['free'] = vfs.f_bavail * vfs.f_frsize
+        self.stats['inodes_used'] = vfs.f_files - vfs.f_ffree
+        self.stats['inodes_free'] = vfs.f_favail
+
+    def graph_args(self, prefix, period):
+        super(HDDUsage, self).graph_args(prefix, period)
+        if prefix == 'hdd_inodes_%s' % self.clean_device:
+            return [
+                "-s -1%s" % period,
+                "-t inodes on %s :: %s" % (self.device, self.name),
+                "-h", "300", "-w", "700", "--full-size-mode", "-T", "10",
+                "-l 0",
+                "-a", "PNG",
+                "-v inodes",
+                "DEF:used=%s:inodes_used:AVERAGE" % self.FILE_NAME % self.clean_device,
+                "DEF:free=%s:inodes_free:AVERAGE" % self.FILE_NAME % self.clean_device,
+                "CDEF:total=used,free,+",
+
+                "AREA:free#000099:Free",
+                "GPRINT:free:MIN:     Min\\: %6.2lf %S",
+                "GPRINT:free:AVERAGE:\\tAvg\\: %6.2lf %S",
+                "GPRINT:free:MAX:\\tMax\\: %6.2lf %S",
+                "GPRINT:free:LAST:\\tCurrent\\: %6.2lf %S \\n",
+
+                "STACK:used#FF9C0F:Used",
+                "GPRINT:used:MIN:     Min\\: %6.2lf %S",
+                "GPRINT:used:AVERAGE:\\tAvg\\: %6.2lf %S",
+                "GPRINT:used:MAX:\\tMax\\: %6.2lf %S",
+                "GPRINT:used:LAST:\\tCurrent\\: %6.2lf %S \\n",
+
+                "LINE2:total#FF0000:Total",
+                "GPRINT:total:MIN:    Min\\: %6.2lf %S",
+                "GPRINT:total:AVERAGE:\\tAvg\\: %6.2lf %S",
+                "GPRINT:total:MAX:\\tMax\\: %6.2lf %S",
+                "GPRINT:total:LAST:\\tCurrent\\: %6.2lf %S \\n",
+            ]
+        return [
             "-s -1%s" % period,
             "-t usage on %s :: %s" % (self.device, self.name),
-            "--lazy",
             "-h", "300", "-w", "700", "--full-size-mode", "-T", "10",
             "-l 0",
             "-b", "1024",
@@ -431,12 +1077,13 @@ class HDDUsage(Stat):
             "GPRINT:total:AVERAGE:\\tAvg\\: %6.2lf %S",
             "GPRINT:total:MAX:\\tMax\\: %6.2lf %S",
             "GPRINT:total:LAST:\\tCurrent\\: %6.2lf %S \\n",
-        )
+        ]
 
 
 class RAMStat(Stat):
     """Collect RAM usage information
     """
+    CONFIG_KEY = 'ram'
     FILE_NAME = 'ram.rrd'
     RRD_DATA_SOURCES = DS.ds(["total", "free", "buffers", "cached"], DS.GAUGE)
     IMAGE_PREFIXES = ['ram']
@@ -448,30 +1095,19 @@ class RAMStat(Stat):
         self.stats['buffers'] = 0
         self.stats['cached'] = 0
 
-    def read_stat(self):
+    def read_stat(self, snapshot):
         # Get current memory usage
-        mem = open('/proc/meminfo', 'r').readlines()
-
-        # Search for these headers
-        headers = ['MemTotal', 'MemFree', 'Buffers', 'Cached']
-        stats = {}
-        for m in mem:
-            header = m.split(':')[0]
-            # Convert to bytes
-            if header in headers:
-                stats[header] = 1024 * int(m.split()[1])
+        stats = snapshot.meminfo
         self.stats['total'] = stats['MemTotal']
         self.stats['free'] = stats['MemFree']
         self.stats['buffers'] = stats['Buffers']
         self.stats['cached'] = stats['Cached']
 
-    def make_image(self, prefix, period):
-        super(RAMStat, self).make_image(prefix, period)
-        rrdtool.graph(
-            "%s_%s.png" % (prefix, period),
+    def graph_args(self, prefix, period):
+        super(RAMStat, self).graph_args(prefix, period)
+        return [
             "-s -1%s" % period,
             "-t Memory usage",
-            "--lazy",
             "-h", "300", "-w", "700", "--full-size-mode", "-T", "10",
             "-l 0",
             "-b", "1024",
@@ -512,12 +1148,13 @@ class RAMStat(Stat):
             "GPRINT:total:AVERAGE:\\tAvg\\: %8.2lf %S",
             "GPRINT:total:MAX:\\tMax\\: %8.2lf %S",
             "GPRINT:total:LAST:\\tCurrent\\: %8.2lf %S \\n",
-        )
+        ]
 
 
 class SwapStat(Stat):
     """Collect swap usage information
     """
+    CONFIG_KEY = 'swap'
     FILE_NAME = 'swap.rrd'
     RRD_DATA_SOURCES = DS.ds(["total", "free", "cached"], DS.GAUGE)
     IMAGE_PREFIXES = ['swap']
@@ -528,28 +1165,18 @@ class SwapStat(Stat):
         self.stats['free'] = 0
         self.stats['cached'] = 0
 
-    def read_stat(self):
-        # Get current memory usage
-        mem = open('/proc/meminfo', 'r').readlines()
-        # Search for these headers
-        headers = ['SwapTotal', 'SwapFree', 'SwapCached']
-        stats = {}
-        for m in mem:
-            header = m.split(':')[0]
-            # Convert to bytes
-            if header in headers:
-                stats[header] = 1024 * int(m.split()[1])
+    def read_stat(self, snapshot):
+        # Get current swap usage
+        stats = snapshot.meminfo
         self.stats['total'] = stats['SwapTotal']
         self.stats['free'] = stats['SwapFree']
         self.stats['cached'] = stats['SwapCached']
 
-    def make_image(self, prefix, period):
-        super(SwapStat, self).make_image(prefix, period)
-        rrdtool.graph(
-            "%s_%s.png" % (prefix, period),
+    def graph_args(self, prefix, period):
+        super(SwapStat, self).graph_args(prefix, period)
+        return [
             "-s -1%s" % period,
             "-t Swap usage",
-            "--lazy",
             "-h", "300", "-w", "700", "--full-size-mode", "-T", "10",
             "-l 0",
             "-b", "1024",
@@ -583,12 +1210,13 @@ class SwapStat(Stat):
             "GPRINT:total:AVERAGE:\\tAvg\\: %8.2lf %S",
             "GPRINT:total:MAX:\\tMax\\: %8.2lf %S",
             "GPRINT:total:LAST:\\tCurrent\\: %8.2lf %S \\n"
-        )
+        ]
 
 
 class NetworkStat(Stat):
     """Collect RAM usage information
     """
+    CONFIG_KEY = 'network_devices'
     FILE_NAME = 'traffic_%s.rrd'
     RRD_DATA_SOURCES = DS.ds(["in", "out"], DS.DERIVE)
 
@@ -606,23 +1234,19 @@ class NetworkStat(Stat):
         self.stats['out'] = 0
         self.IMAGE_PREFIXES = ['traffic_%s' % (self.device)]
 
-    def read_stat(self):
+    def read_stat(self, snapshot):
         # Get current byte count
-        self.stats['in'] = 0
-        self.stats['out'] = 0
-        try:
-            self.stats['in'] = int(open('/sys/class/net/%s/statistics/rx_bytes' % self.device, 'r').readlines()[0].rstrip())
-            self.stats['out'] = int(open('/sys/class/net/%s/statistics/tx_bytes' % self.device, 'r').readlines()[0].rstrip())
-        except:
-            pass
-
-    def make_image(self, prefix, period):
-        super(NetworkStat, self).make_image(prefix, period)
-        rrdtool.graph(
-            "%s_%s.png" % (prefix, period),
+        values = snapshot.net_dev.get(self.device)
+        if values is None:
+            raise IOError("No %s in /proc/net/dev" % self.device)
+        self.stats['in'] = values[0]
+        self.stats['out'] = values[8]
+
+    def graph_args(self, prefix, period):
+        super(NetworkStat, self).graph_args(prefix, period)
+        return [
             "-s -1%s" % period,
             "-t traffic on %s :: %s" % (self.device, self.name),
-            "--lazy",
             "-h", "300", "-w", "700", "--full-size-mode", "-T", "10",
             "-l 0", "-b", "1024",
             "-a", "PNG",
@@ -642,69 +1266,150 @@ class NetworkStat(Stat):
             "GPRINT:out:AVERAGE: Avg\\: %5.1lf %S",
             "GPRINT:out:LAST: Current\\: %5.1lf %Sbytes/sec",
             "HRULE:0#000000"
-        )
+        ]
 
 
 class NginxStat(Stat):
     """Collect Nginx usage information
+
+    The stub_status page is fetched in the reactor, over keep-alive
+    connections from a pool shared by all nginx stats, so many endpoints
+    are polled at once without tying up collection threads.
     """
+    CONFIG_KEY = 'nginx'
     FILE_NAME = 'nginx.rrd'
     RRD_DATA_SOURCES = DS.ds(["requests"], DS.DERIVE) + \
         DS.ds(["total", "reading", "writing", "waiting"], DS.GAUGE)
-    IMAGE_PREFIXES = ['nginx_requests', 'nginx_connections']
+    ASYNC = True
+    # Seconds to connect and get a status page
+    timeout = 10.0
+    # Agent on an HTTPConnectionPool shared by all nginx stats
+    agent = None
+    # Number of nginx stats, several can be on one host
+    endpoints = 0
+    STATUS_PATTERNS = {
+        'total': r'Active connections:\s*(\d+)',
+        'requests': r'accepts\s+handled\s+requests\s+\d+\s+\d+\s+(\d+)',
+        'reading': r'Reading:\s*(\d+)',
+        'writing': r'Writing:\s*(\d+)',
+        'waiting': r'Waiting:\s*(\d+)',
+    }
+
+    def __init__(self, url, name=None):
+        """
+        Arguments:
+        url - url of the stub_status page
+
+        Keyword Arguments:
+        name - name of the endpoint, in its file name and image prefixes,
+        default: None for the single endpoint of older configs
 
-    def __init__(self, url):
-        super(NginxStat, self).__init__(self.FILE_NAME, self.RRD_DATA_SOURCES)
+        """
+        if name is None:
+            file_name, suffix, self.title = self.FILE_NAME, '', ''
+        else:
+            name = safe_name(name)
+            file_name = 'nginx_%s.rrd' % name
+            suffix, self.title = '_' + name, ' ' + name
+        super(NginxStat, self).__init__(file_name, self.RRD_DATA_SOURCES)
         self.url = url
+        self.name = name
+        NginxStat.endpoints += 1
+        self.IMAGE_PREFIXES = ['nginx_requests' + suffix,
+                               'nginx_connections' + suffix]
         self.stats['requests'] = 0
         self.stats['total'] = 0
         self.stats['reading'] = 0
         self.stats['writing'] = 0
         self.stats['waiting'] = 0
 
-    def read_stat(self):
-        # Ask nginx for current stats
-        text = urllib2.urlopen(self.url).readlines()
-        self.stats['requests'] = int(text[2].rstrip().split()[2])
-        self.stats['total'] = int(text[0].rstrip().split(':')[1])
-        rww = [int(x) for x in text[3].rstrip().split() if x.isdigit()]
-        self.stats['reading'] = rww[0]
-        self.stats['writing'] = rww[1]
-        self.stats['waiting'] = rww[2]
+    @staticmethod
+    def parse(text):
+        """Parse a stub_status page
 
-    def make_image(self, prefix, period):
-        super(NginxStat, self).make_image(prefix, period)
-        if prefix == 'nginx_requests':
-            rrdtool.graph(
-                "nginx_requests_%s.png" % period,
+        Fields are found wherever they are, and missing ones are unknown,
+        so extra lines or another layout don't break it.
+
+        Return:
+        dictionary of data source name to value, NaN if unknown
+
+        """
+        ret = {}
+        for name, pattern in NginxStat.STATUS_PATTERNS.iteritems():
+            match = re.search(pattern, text)
+            ret[name] = int(match.group(1)) if match else NAN
+        if all(x != x for x in ret.values()):
+            raise ValueError("Not an nginx status page")
+        return ret
+
+    def read_stat(self, snapshot):
+        """Ask nginx for current stats. Runs in the reactor
+
+        Return:
+        deferred that fires once self.stats is read
+
+        """
+        if NginxStat.agent is None:
+            pool = HTTPConnectionPool(reactor, persistent=True)
+            # Every endpoint keeps its connection, even if they are all on
+            # one host. Ones idle for more than a few ticks are closed
+            pool.maxPersistentPerHost = max(2, NginxStat.endpoints)
+            pool.cachedConnectionTimeout = 300
+            NginxStat.agent = Agent(reactor, connectTimeout=self.timeout,
+                                    pool=pool)
+        d = NginxStat.agent.request('GET', self.url,
+                                    Headers({'User-Agent': ['ssssup']}))
+        timer = reactor.callLater(self.timeout, d.cancel)
+
+        def body(response):
+            if response.code != 200:
+                # The body still has to be read for the connection to be
+                # reused
+                drained = readBody(response)
+                drained.addBoth(lambda _: failure.Failure(IOError(
+                    "%s answered %s" % (self.url, response.code))))
+                return drained
+            return readBody(response)
+
+        def done(result):
+            if timer.active():
+                timer.cancel()
+            return result
+
+        d.addCallback(body)
+        d.addBoth(done)
+        d.addCallback(lambda text: self.stats.update(self.parse(text)))
+        return d
+
+    def graph_args(self, prefix, period):
+        super(NginxStat, self).graph_args(prefix, period)
+        if prefix == self.IMAGE_PREFIXES[0]:
+            return [
                 "-s -1%s" % period,
-                "-t Requests on nginx",
-                "--lazy",
+                "-t Requests on nginx%s" % self.title,
                 "-h", "300", "-w", "700", "--full-size-mode", "-T", "10",
                 "-l 0",
                 "-a", "PNG",
                 "-v requests/sec",
-                "DEF:requests=%s:requests:AVERAGE" % self.FILE_NAME,
+                "DEF:requests=%s:requests:AVERAGE" % self.rrd_file_name,
                 "AREA:requests#336600:Requests",
                 "GPRINT:requests:MAX:Max\\: %5.1lf %S",
                 "GPRINT:requests:AVERAGE:\\tAvg\\: %5.1lf %S",
                 "GPRINT:requests:LAST:\\tCurrent\\: %5.1lf %S",
                 "HRULE:0#000000"
-            )
-        elif prefix == 'nginx_connections':
-            rrdtool.graph(
-                "nginx_connections_%s.png" % period,
+            ]
+        elif prefix == self.IMAGE_PREFIXES[1]:
+            return [
                 "-s -1%s" % period,
-                "-t Requests on nginx",
-                "--lazy",
+                "-t Connections on nginx%s" % self.title,
                 "-h", "300", "-w", "700", "--full-size-mode", "-T", "20",
                 "-l 0",
                 "-a", "PNG",
                 "-v requests",
-                "DEF:total=%s:total:AVERAGE" % self.FILE_NAME,
-                "DEF:reading=%s:reading:AVERAGE" % self.FILE_NAME,
-                "DEF:writing=%s:writing:AVERAGE" % self.FILE_NAME,
-                "DEF:waiting=%s:waiting:AVERAGE" % self.FILE_NAME,
+                "DEF:total=%s:total:AVERAGE" % self.rrd_file_name,
+                "DEF:reading=%s:reading:AVERAGE" % self.rrd_file_name,
+                "DEF:writing=%s:writing:AVERAGE" % self.rrd_file_name,
+                "DEF:waiting=%s:waiting:AVERAGE" % self.rrd_file_name,
 
                 "AREA:reading#0022FF:Reading",
                 "GPRINT:reading:LAST: Current\\: %5.1lf %S",
@@ -730,34 +1435,292 @@ class NginxStat(Stat):
                 "GPRINT:total:MIN:  Min\\: %5.1lf %S",
                 "GPRINT:total:AVERAGE: Avg\\: %5.1lf %S",
                 "GPRINT:total:MAX:  Max\\: %5.1lf %S\\n"
-            )
+            ]
+
+
+class SelfStat(Stat):
+    """Collect timings of the monitor itself
+
+    Reads the timers, counters and gauges of a metrics.Metrics: the
+    average time of the reads, updates, renders and HTTP requests since
+    the last sample, how many there were and how many failed, and how
+    deep the render and collection queues are.
+    """
+    CONFIG_KEY = 'self'
+    FILE_NAME = 'self.rrd'
+    TIMERS = ['read', 'update', 'render', 'http']
+    GAUGES = ['render_queue', 'collect_queue']
+    RRD_DATA_SOURCES = DS.ds(['%s_time' % x for x in TIMERS], DS.GAUGE) + \
+        DS.ds(TIMERS + ['%s_errors' % x for x in TIMERS], DS.DERIVE) + \
+        DS.ds(GAUGES, DS.GAUGE)
+    IMAGE_PREFIXES = ['self_latency', 'self_activity', 'self_queues']
+    COLORS = {'read': '#0022FF', 'update': '#32CD32', 'render': '#FF9C0F',
+              'http': '#FF0000'}
+
+    def __init__(self, metrics):
+        """
+        Arguments:
+        metrics - metrics.Metrics of this process
+
+        """
+        super(SelfStat, self).__init__(self.FILE_NAME, self.RRD_DATA_SOURCES)
+        self.metrics = metrics
+        # Timer -> (count, sum) at the last reading
+        self.totals = {}
+        for name in self.TIMERS:
+            self.stats['%s_time' % name] = NAN
+            self.stats[name] = 0
+            self.stats['%s_errors' % name] = 0
+        for name in self.GAUGES:
+            self.stats[name] = 0
+
+    def read_stat(self, snapshot):
+        for name in self.TIMERS:
+            count, total = self.metrics.totals(name)
+            last_count, last_total = self.totals.get(name, (count, total))
+            self.totals[name] = (count, total)
+            self.stats['%s_time' % name] = \
+                (total - last_total) / (count - last_count) \
+                if count > last_count else NAN
+            self.stats[name] = count
+            self.stats['%s_errors' % name] = \
+                self.metrics.counters.get('%s_errors' % name, 0)
+        for name in self.GAUGES:
+            self.stats[name] = self.metrics.value(name) \
+                if name in self.metrics.gauges else NAN
+
+    def graph_args(self, prefix, period):
+        super(SelfStat, self).graph_args(prefix, period)
+        if prefix == 'self_latency':
+            ret = [
+                "-s -1%s" % period,
+                "-t Time taken by ssssup",
+                "-h", "300", "-w", "700", "--full-size-mode", "-T", "10",
+                "-l 0",
+                "-a", "PNG",
+                "-v milliseconds",
+            ]
+            for name in self.TIMERS:
+                ret += [
+                    "DEF:%s=%s:%s_time:AVERAGE" % (name, self.FILE_NAME, name),
+                    "CDEF:%s_ms=%s,1000,*" % (name, name),
+                    "LINE1:%s_ms%s:%-7s" % (name, self.COLORS[name],
+                                            name.capitalize()),
+                    "GPRINT:%s_ms:MAX:Max\\: %%7.2lf" % name,
+                    "GPRINT:%s_ms:AVERAGE:\\tAvg\\: %%7.2lf" % name,
+                    "GPRINT:%s_ms:LAST:\\tCurrent\\: %%7.2lf ms\\n" % name,
+                ]
+            return ret
+        elif prefix == 'self_activity':
+            ret = [
+                "-s -1%s" % period,
+                "-t Work done by ssssup",
+                "-h", "300", "-w", "700", "--full-size-mode", "-T", "10",
+                "-l 0",
+                "-a", "PNG",
+                "-v per sec",
+            ]
+            for name in self.TIMERS:
+                ret += [
+                    "DEF:%s=%s:%s:AVERAGE" % (name, self.FILE_NAME, name),
+                    "LINE1:%s%s:%-7s" % (name, self.COLORS[name],
+                                         name.capitalize()),
+                    "GPRINT:%s:MAX:Max\\: %%6.2lf" % name,
+                    "GPRINT:%s:AVERAGE:\\tAvg\\: %%6.2lf\\n" % name,
+                ]
+            for name in self.TIMERS:
+                ret += [
+                    "DEF:%s_errors=%s:%s_errors:AVERAGE" % (
+                        name, self.FILE_NAME, name),
+                    "LINE2:%s_errors%s:%-7s errors" % (
+                        name, self.COLORS[name], name.capitalize()),
+                    "GPRINT:%s_errors:MAX:Max\\: %%6.2lf" % name,
+                    "GPRINT:%s_errors:AVERAGE:\\tAvg\\: %%6.2lf\\n" % name,
+                ]
+            return ret + ["HRULE:0#000000"]
+        elif prefix == 'self_queues':
+            return [
+                "-s -1%s" % period,
+                "-t Queues of ssssup",
+                "-h", "300", "-w", "700", "--full-size-mode", "-T", "10",
+                "-l 0",
+                "-a", "PNG",
+                "-v jobs",
+                "DEF:render_queue=%s:render_queue:AVERAGE" % self.FILE_NAME,
+                "DEF:collect_queue=%s:collect_queue:AVERAGE" % self.FILE_NAME,
+                "LINE2:render_queue#FF9C0F:Render queue ",
+                "GPRINT:render_queue:MAX:Max\\: %5.1lf",
+                "GPRINT:render_queue:AVERAGE:\\tAvg\\: %5.1lf",
+                "GPRINT:render_queue:LAST:\\tCurrent\\: %5.1lf\\n",
+                "LINE2:collect_queue#0022FF:Collect queue",
+                "GPRINT:collect_queue:MAX:Max\\: %5.1lf",
+                "GPRINT:collect_queue:AVERAGE:\\tAvg\\: %5.1lf",
+                "GPRINT:collect_queue:LAST:\\tCurrent\\: %5.1lf",
+                "HRULE:0#000000",
+            ]
 
 
 class RedisStat(Stat):
     """Collect Redis usage information
+
+    INFO is fetched in the reactor over a persistent connection per
+    instance. Counters are stored as rates, and the keyspace hit ratio is
+    worked out from the hits and misses since the last sample.
     """
-    FILE_NAME = 'redis.rrd'
-    RRD_DATA_SOURCES = DS.ds(["total_commands_processed"], DS.DERIVE) + \
-        DS.ds(["used_memory", "rdb_changes_since_last_save", "keys"], DS.GAUGE)
+    CONFIG_KEY = 'redis'
+    FILE_NAME = 'redis_%s.rrd'
+    # Data source -> INFO field
+    COUNTERS = OrderedDict([
+        ('commands', 'total_commands_processed'),
+        ('hits', 'keyspace_hits'),
+        ('misses', 'keyspace_misses'),
+        ('expired', 'expired_keys'),
+        ('evicted', 'evicted_keys'),
+        ('net_in', 'total_net_input_bytes'),
+        ('net_out', 'total_net_output_bytes'),
+    ])
+    GAUGES = OrderedDict([
+        ('clients', 'connected_clients'),
+        ('blocked', 'blocked_clients'),
+        ('memory', 'used_memory'),
+        ('rss', 'used_memory_rss'),
+        ('changes', 'rdb_changes_since_last_save'),
+    ])
+    RRD_DATA_SOURCES = DS.ds(COUNTERS.keys(), DS.DERIVE) + \
+        DS.ds(GAUGES.keys() + ['keys', 'expires'], DS.GAUGE) + \
+        DS.ds(['hit_ratio'], DS.GAUGE, ulimit=100)
+    ASYNC = True
+    # Seconds to connect and get the replies
+    timeout = 5.0
+
+    def __init__(self, url, name):
+        """
+        Arguments:
+        url - redis://[:password@]host[:port][/db], or host[:port]
+        name - name of the instance, in its file name and image prefixes
 
-    def __init__(self):
-        super(RedisStat, self).__init__(self.FILE_NAME, self.DATA_SOURCES)
-        self.stats['used_memory'] = 0
-        self.stats['rdb_changes_since_last_save'] = 0
-        self.stats['total_commands_processed'] = 0
-        # sum(db1, db2)....
-        self.stats['keys'] = 0
-        self.redis = redis.StrictRedis()
-
-    def read_stat(self):
-        rs = self.redis.info()
-        for x in ['connected_clients', 'used_memory', 'used_memory_lua',
-                  'rdb_changes_since_last_save', 'total_commands_processed',
-                  'keyspace_hits', 'keyspace_misses']:
-            redis.stats[x] = rs[x]
-        self.stats['keys'] = sum([rs[db]['keys'] for db in
-                                  filter(lambda x: x.startswith('db'),
-                                         rs.keys())])
-
-    def make_image(self, period):
-        pass
+        """
+        self.name = safe_name(name)
+        super(RedisStat, self).__init__(self.FILE_NAME % self.name,
+                                        self.RRD_DATA_SOURCES)
+        self.url = url
+        self.client = RedisClient(url, self.timeout)
+        self.IMAGE_PREFIXES = ['redis_%s_%s' % (graph, self.name) for graph
+                               in ['commands', 'hits', 'memory', 'clients',
+                                   'keys']]
+        # Same order as the data sources, so the template matches
+        self.stats = OrderedDict((ds.split(':')[1], NAN)
+                                 for ds in self.rrd_data_source)
+        # (hits, misses) at the last reading
+        self.last_hits = None
+
+    @staticmethod
+    def parse_info(text):
+        """Parse the reply of INFO
+
+        Return:
+        dictionary of field to value, as an int or float if it is one.
+        Keyspace fields (db0...) are dictionaries of keys, expires...
+
+        """
+        ret = {}
+        for line in text.splitlines():
+            if not line or line.startswith('#') or ':' not in line:
+                continue
+            name, _, value = line.partition(':')
+            if name.startswith('db') and '=' in value:
+                value = dict(x.split('=', 1) for x in value.split(','))
+                ret[name] = dict((k, int(v)) for k, v in value.iteritems()
+                                 if v.isdigit())
+                continue
+            for kind in (int, float):
+                try:
+                    value = kind(value)
+                    break
+                except ValueError:
+                    pass
+            ret[name] = value
+        return ret
+
+    def read_stat(self, snapshot):
+        """Ask redis for current stats. Runs in the reactor
+
+        Return:
+        deferred that fires once self.stats is read
+
+        """
+        d = self.client.execute(['INFO'])
+        d.addCallback(lambda replies: self.read_info(
+            self.parse_info(replies[0])))
+        return d
+
+    def read_info(self, info):
+        """Set self.stats from parsed INFO
+        """
+        for name, field in self.COUNTERS.items() + self.GAUGES.items():
+            value = info.get(field)
+            self.stats[name] = value if isinstance(value, (int, float)) \
+                else NAN
+        databases = [v for k, v in info.iteritems()
+                     if k.startswith('db') and isinstance(v, dict)]
+        self.stats['keys'] = sum(x.get('keys', 0) for x in databases)
+        self.stats['expires'] = sum(x.get('expires', 0) for x in databases)
+        hits = (self.stats['hits'], self.stats['misses'])
+        ratio = NAN
+        if self.last_hits is not None:
+            new_hits = hits[0] - self.last_hits[0]
+            lookups = new_hits + hits[1] - self.last_hits[1]
+            # Counters go back to 0 when redis restarts
+            if lookups > 0 and new_hits >= 0:
+                ratio = min(100.0, 100.0 * new_hits / lookups)
+        self.stats['hit_ratio'] = ratio
+        self.last_hits = hits
+
+    def graph_args(self, prefix, period):
+        super(RedisStat, self).graph_args(prefix, period)
+        ret = [
+            "-s -1%s" % period,
+            "-h", "300", "-w", "700", "--full-size-mode", "-T", "10",
+            "-l 0",
+            "-a", "PNG",
+        ]
+        graph = prefix[len('redis_'):-len(self.name) - 1]
+        lines = {
+            'commands': ("Commands on", "per sec", [
+                ('commands', 'AREA', '#336600', 'Commands'),
+                ('hits', 'LINE1', '#0022FF', 'Hits'),
+                ('misses', 'LINE1', '#FF0000', 'Misses'),
+            ]),
+            'hits': ("Keyspace hit ratio of", "percent", [
+                ('hit_ratio', 'AREA', '#32CD32', 'Hit ratio'),
+            ]),
+            'memory': ("Memory of", "bytes", [
+                ('rss', 'AREA', '#FF9C0F', 'RSS'),
+                ('memory', 'LINE2', '#0022FF', 'Used'),
+            ]),
+            'clients': ("Clients of", "clients", [
+                ('clients', 'AREA', '#00AAAA', 'Connected'),
+                ('blocked', 'LINE2', '#FF0000', 'Blocked'),
+            ]),
+            'keys': ("Keys in", "keys", [
+                ('keys', 'AREA', '#336600', 'Keys'),
+                ('expires', 'LINE2', '#0022FF', 'With expiry'),
+                ('expired', 'LINE1', '#FF9C0F', 'Expired/sec'),
+                ('evicted', 'LINE1', '#FF0000', 'Evicted/sec'),
+            ]),
+        }
+        title, unit, sources = lines[graph]
+        if graph == 'hits':
+            ret += ["-u 100", "-r"]
+        elif graph == 'memory':
+            ret += ["-b", "1024"]
+        ret += ["-t %s redis %s" % (title, self.name), "-v %s" % unit]
+        for name, kind, color, legend in sources:
+            ret += [
+                "DEF:%s=%s:%s:AVERAGE" % (name, self.rrd_file_name, name),
+                "%s:%s%s:%-12s" % (kind, name, color, legend),
+                "GPRINT:%s:MAX:Max\\: %%6.1lf %%S" % name,
+                "GPRINT:%s:AVERAGE:\\tAvg\\: %%6.1lf %%S" % name,
+                "GPRINT:%s:LAST:\\tCurrent\\: %%6.1lf %%S\\n" % name,
+            ]
+        return ret + ["HRULE:0#000000"]
@@ -0,0 +1,478 @@
+import ctypes
+import mmap
+import os
+import struct
+import threading
+from array import array
+from itertools import izip
+
+import simplejson
+
+NAN = float('nan')
+
+# Consolidation functions, named as in rrdtool
+AVERAGE, MIN, MAX, LAST = CONSOLIDATIONS = ('AVERAGE', 'MIN', 'MAX', 'LAST')
+
+MAGIC = 'SSSUPRR1'
+# Fields of each data source in the state block: last raw value, sum of
+# rate * seconds and known seconds of the step being filled
+DS_STATE = 3
+# Fields of each archive, then of each of its data sources: newest row,
+# then consolidated value and known steps of the row being filled
+ARCHIVE_STATE = 1
+ARCHIVE_DS_STATE = 2
+
+
+def parse_sources(sources):
+    """Parse rrdtool DS strings
+
+    Return:
+    list of dictionaries of name, type, heartbeat, min and max, None for
+    no limit
+
+    """
+    ret = []
+    for source in sources:
+        _, name, dstype, heartbeat, low, high = source.split(':')
+        ret.append({'name': name, 'type': dstype, 'heartbeat': int(heartbeat),
+                    'min': None if low == 'U' else float(low),
+                    'max': None if high == 'U' else float(high)})
+    return ret
+
+
+def parse_archives(archives):
+    """Parse rrdtool RRA strings
+
+    Return:
+    list of dictionaries of cf, xff, steps and rows
+
+    """
+    ret = []
+    for archive in archives:
+        _, cf, xff, steps, rows = archive.split(':')
+        if cf not in CONSOLIDATIONS:
+            raise ValueError("Unknown consolidation function %s" % cf)
+        ret.append({'cf': cf, 'xff': float(xff), 'steps': int(steps),
+                    'rows': int(rows)})
+    return ret
+
+
+class RoundRobinFile(object):
+    """Round robin archives of one stat in a memory mapped file
+
+    Works like an rrd: samples become per second rates, which are averaged
+    into one primary value per step, and those are consolidated into the
+    rows of each archive. The file holds a JSON header, then doubles:
+    the last update time, the state of each data source, the state of
+    each archive, and the rows of each archive, newest row wrapping
+    around. The doubles are ctypes arrays over the map, so updates write
+    straight into the page cache, and reads can hand out views.
+    """
+
+    def __init__(self, path):
+        """
+        Arguments:
+        path - file made by RoundRobinFile.create
+
+        """
+        self.path = path
+        self.file = open(path, 'r+b')
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a round robin file" % path)
+        length, = struct.unpack('<I', self.file.read(4))
+        header = simplejson.loads(self.file.read(length))
+        self.step = header['step']
+        self.sources = header['sources']
+        # NaN limits compare false, so they never reject a rate
+        self.limits = [(NAN if ds['min'] is None else ds['min'],
+                        NAN if ds['max'] is None else ds['max'])
+                       for ds in self.sources]
+        self.archives = header['archives']
+        self.names = [ds['name'] for ds in self.sources]
+        self.counters = [ds['type'] != 'GAUGE' for ds in self.sources]
+        self.heartbeats = [ds['heartbeat'] for ds in self.sources]
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        offset = self.data_offset(length)
+        n = len(self.sources)
+        self.state = (ctypes.c_double * (1 + DS_STATE * n)).from_buffer(
+            self.map, offset)
+        offset += ctypes.sizeof(self.state)
+        self.archive_state = []
+        for archive in self.archives:
+            state = (ctypes.c_double * (ARCHIVE_STATE + ARCHIVE_DS_STATE * n)
+                     ).from_buffer(self.map, offset)
+            self.archive_state.append(state)
+            offset += ctypes.sizeof(state)
+        self.rows = []
+        for archive in self.archives:
+            rows = ((ctypes.c_double * n) * archive['rows']).from_buffer(
+                self.map, offset)
+            self.rows.append(rows)
+            offset += ctypes.sizeof(rows)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def data_offset(length):
+        """Return where the doubles start, after a header of length bytes
+        """
+        offset = len(MAGIC) + 4 + length
+        return offset + -offset % 8
+
+    @staticmethod
+    def create(path, step, sources, archives, start=0):
+        """Create a file with every value unknown
+
+        Arguments:
+        path - file to create
+        step - seconds per primary value
+        sources - list of rrdtool DS strings
+        archives - list of rrdtool RRA strings
+
+        Keyword Arguments:
+        start - unix time of the last update, default: 0 for none yet
+
+        """
+        sources, archives = parse_sources(sources), parse_archives(archives)
+        header = simplejson.dumps({'step': step, 'sources': sources,
+                                   'archives': archives})
+        n = len(sources)
+        offset = RoundRobinFile.data_offset(len(header))
+        doubles = 1 + DS_STATE * n + \
+            sum(ARCHIVE_STATE + ARCHIVE_DS_STATE * n + a['rows'] * n
+                for a in archives)
+        state = array('d', [start])
+        state += array('d', [NAN, 0.0, 0.0]) * n
+        for archive in archives:
+            state += array('d', [0.0]) + array('d', [NAN, 0.0]) * n
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            f.write('\0' * (offset - f.tell()))
+            state.tofile(f)
+            # Rows are written a chunk at a time, all unknown
+            chunk = array('d', [NAN]) * 65536
+            left = doubles - len(state)
+            while left > 0:
+                chunk[min(left, len(chunk)):] = array('d')
+                chunk.tofile(f)
+                left -= len(chunk)
+
+    def close(self):
+        self.flush()
+        # ctypes views pin the map, drop them first
+        self.state = self.archive_state = self.rows = None
+        self.map.close()
+        self.file.close()
+
+    def flush(self):
+        self.map.flush()
+
+    @property
+    def last_update(self):
+        return int(self.state[0])
+
+    def update(self, timestamp, values, names=None):
+        """Add a sample
+
+        Arguments:
+        timestamp - unix time of the sample
+        values - list of raw values
+
+        Keyword Arguments:
+        names - data source names of values, default: all, in file order
+
+        Return:
+        False if the sample was dropped because it isn't newer than the
+        last one, True otherwise
+
+        """
+        with self.lock:
+            return self._update(timestamp, values, names)
+
+    def _update(self, timestamp, values, names):
+        if names is not None:
+            given = dict(zip(names, values))
+            values = [given.get(name, NAN) for name in self.names]
+        values = [float(x) for x in values]
+        state = self.state
+        last = state[0]
+        if timestamp <= last:
+            return False
+        elapsed = timestamp - last
+        # Every data source at once, through strided slices of the state:
+        # raw values at 1, sums at 2 and known seconds at 3, every DS_STATE
+        raw, sums, known = slice(1, None, DS_STATE), \
+            slice(2, None, DS_STATE), slice(3, None, DS_STATE)
+        # Counters: the change since the last sample, per second
+        rates = [(value - old) / elapsed if counter else value
+                 for value, old, counter
+                 in izip(values, state[raw], self.counters)]
+        rates = [NAN if elapsed > heartbeat or rate < low or rate > high
+                 else rate for rate, heartbeat, (low, high)
+                 in izip(rates, self.heartbeats, self.limits)]
+        state[raw] = values
+        state[0] = timestamp
+        if not last:
+            # The first sample only has a value to count from
+            return True
+        step = self.step
+        zeros = [0.0] * len(rates)
+        start = last
+        boundary = last - last % step + step
+        while start < timestamp:
+            end = min(boundary, timestamp)
+            seconds = end - start
+            state[sums] = [total + rate * seconds if rate == rate else total
+                           for total, rate in izip(state[sums], rates)]
+            state[known] = [k + seconds if rate == rate else k
+                            for k, rate in izip(state[known], rates)]
+            if end < boundary:
+                break
+            # A step is done: its primary value is known if over half of it
+            # is, and steps the sample jumps over all get its rate
+            primary = [total / k if k * 2 >= step else NAN
+                       for total, k in izip(state[sums], state[known])]
+            state[sums] = zeros
+            state[known] = zeros
+            full = int((timestamp - boundary) // step)
+            self._consolidate(int(boundary // step), primary, 1)
+            if full:
+                self._consolidate(int(boundary // step) + 1, rates, full)
+            start = boundary + full * step
+            boundary = start + step
+        return True
+
+    def _consolidate(self, index, values, count):
+        """Consolidate count steps that all have the same primary values
+
+        Arguments:
+        index - number of the first step since the epoch, (index - 1) *
+        step to index * step
+        values - primary value of each data source
+        count - number of steps
+
+        """
+        # Consolidated values and known steps of every data source, through
+        # strided slices of an archive's state
+        current = slice(ARCHIVE_STATE, None, ARCHIVE_DS_STATE)
+        known = slice(ARCHIVE_STATE + 1, None, ARCHIVE_DS_STATE)
+        for archive, state, rows in izip(self.archives, self.archive_state,
+                                         self.rows):
+            steps, cf = archive['steps'], archive['cf']
+            # Rows of unknown values can't have any known value, and
+            # known values fill every row, so more rows than the archive
+            # has can be skipped
+            remaining = count
+            i = index
+            while remaining > 0:
+                take = min(remaining, (steps - i % steps) % steps + 1)
+                if cf == AVERAGE:
+                    state[current] = [
+                        c if v != v else v * take + (0.0 if c != c else c)
+                        for v, c in izip(values, state[current])]
+                elif cf == MIN:
+                    state[current] = [
+                        c if v != v else v if c != c else min(c, v)
+                        for v, c in izip(values, state[current])]
+                elif cf == MAX:
+                    state[current] = [
+                        c if v != v else v if c != c else max(c, v)
+                        for v, c in izip(values, state[current])]
+                else:
+                    state[current] = [c if v != v else v for v, c
+                                      in izip(values, state[current])]
+                state[known] = [k if v != v else k + take
+                                for v, k in izip(values, state[known])]
+                i += take
+                remaining -= take
+                if i % steps == 1 or steps == 1:
+                    self._write_row(archive, state, rows)
+                    # Whole rows more than the archive holds are skipped
+                    skip = (remaining // steps - archive['rows']) * steps
+                    if skip > 0:
+                        i += skip
+                        remaining -= skip
+
+    def _write_row(self, archive, state, rows):
+        steps = archive['steps']
+        current = slice(ARCHIVE_STATE, None, ARCHIVE_DS_STATE)
+        known = slice(ARCHIVE_STATE + 1, None, ARCHIVE_DS_STATE)
+        pointer = (int(state[0]) + 1) % archive['rows']
+        state[0] = pointer
+        # Known if no more than xff of the steps are unknown
+        unknown = archive['xff'] * steps
+        if archive['cf'] == AVERAGE:
+            rows[pointer][:] = [c / k if k and steps - k <= unknown else NAN
+                                for c, k in izip(state[current], state[known])]
+        else:
+            rows[pointer][:] = [c if k and steps - k <= unknown else NAN
+                                for c, k in izip(state[current], state[known])]
+        n = len(self.sources)
+        state[current] = [NAN] * n
+        state[known] = [0.0] * n
+
+    def load(self, timestamp, raw, archives):
+        """Fill the file with data read from elsewhere, an rrd say
+
+        Rows of each archive not given, or older than it holds, stay
+        unknown, and so does the row being consolidated.
+
+        Arguments:
+        timestamp - unix time of the last update
+        raw - list of last raw values of the data sources
+        archives - list with, for each archive, a tuple of (end time of the
+        first row, list of rows) or None
+
+        """
+        with self.lock:
+            self.state[0] = timestamp
+            for i, value in enumerate(raw):
+                self.state[1 + DS_STATE * i] = value
+            for a, given in enumerate(archives):
+                if given is None:
+                    continue
+                first, values = given
+                archive, rows = self.archives[a], self.rows[a]
+                seconds = archive['steps'] * self.step
+                count = archive['rows']
+                newest = timestamp - timestamp % seconds
+                # The newest row goes last in the ring
+                self.archive_state[a][0] = count - 1
+                for i, row in enumerate(values):
+                    back = (newest - first) // seconds - i
+                    if 0 <= back < count:
+                        rows[int(count - 1 - back)][:] = \
+                            [NAN if x is None else x for x in row]
+
+    def fetch(self, cf, resolution, start, end):
+        """Return the rows of an archive between start and end
+
+        The archive is the one with the cf whose rows are closest to
+        resolution seconds without being finer, among those that reach
+        back to start.
+
+        Arguments:
+        cf - consolidation function
+        resolution - seconds per row wanted
+        start - unix time
+        end - unix time
+
+        Return:
+        tuple of (end time of the first row, seconds per row, list of one
+        or two ctypes arrays of rows, each row an array of values in
+        self.names order). The arrays are views of the file, not copies;
+        they are only valid until the next update or close.
+
+        """
+        last = self.state[0]
+        candidates = []
+        for a, archive in enumerate(self.archives):
+            if archive['cf'] != cf:
+                continue
+            seconds = archive['steps'] * self.step
+            newest = last - last % seconds
+            covers = newest - archive['rows'] * seconds <= start
+            candidates.append((not covers, seconds < resolution,
+                               abs(seconds - resolution), a))
+        if not candidates:
+            raise ValueError("No %s archive in %s" % (cf, self.path))
+        a = min(candidates)[3]
+        archive, rows = self.archives[a], self.rows[a]
+        seconds = archive['steps'] * self.step
+        count = archive['rows']
+        newest = last - last % seconds
+        # Rows stamped with the end of the time they cover, in range
+        first = max(start - start % seconds + seconds, newest - (count - 1) * seconds)
+        final = min(end - end % seconds, newest)
+        if final < first:
+            return first, seconds, []
+        pointer = int(self.archive_state[a][0])
+        begin = (pointer - int((newest - first) // seconds)) % count
+        length = int((final - first) // seconds) + 1
+        row_type = ctypes.c_double * len(self.sources)
+        size = ctypes.sizeof(row_type)
+        base = ctypes.addressof(rows)
+        views = []
+        while length > 0:
+            take = min(length, count - begin)
+            views.append((row_type * take).from_address(base + begin * size))
+            length -= take
+            begin = 0
+        return first, seconds, views
+
+
+class Store(object):
+    """Storage backend keeping stats in RoundRobinFile files
+
+    Stands in for rrdtool: stats call it with their rrd file names, and
+    the data goes in a .rrs file next to where the rrd would be.
+    """
+    EXTENSION = '.rrs'
+
+    def __init__(self):
+        # path -> RoundRobinFile
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def path(self, file_name):
+        """Return the store file of an rrd file name
+        """
+        return os.path.splitext(file_name)[0] + self.EXTENSION
+
+    def exists(self, file_name):
+        return os.path.isfile(self.path(file_name))
+
+    def create(self, file_name, step, sources, archives):
+        RoundRobinFile.create(self.path(file_name), step, sources, archives)
+
+    def open(self, file_name):
+        """Return the RoundRobinFile of an rrd file name, kept open
+        """
+        path = self.path(file_name)
+        with self.lock:
+            f = self.files.get(path)
+            if f is None:
+                f = self.files[path] = RoundRobinFile(path)
+            return f
+
+    def update(self, file_name, template, timestamp, values):
+        """Add a sample, like rrdtool.update with a template
+        """
+        return self.open(file_name).update(timestamp, values,
+                                           template.split(':'))
+
+    def last(self, file_name):
+        return self.open(file_name).last_update
+
+    def fetch(self, file_name, cf, resolution, start, end):
+        """Return rows like RoundRobinFile.fetch, with the data source names
+
+        The rows are copied out of the file while it is locked, so updates
+        made meanwhile can't change them.
+
+        Return:
+        tuple of (list of data source names, end time of the first row,
+        seconds per row, list of rows, each a list of values in names
+        order)
+
+        """
+        f = self.open(file_name)
+        with f.lock:
+            first, seconds, views = f.fetch(cf, resolution, start, end)
+            rows = [row[:] for view in views for row in view]
+        return f.names, first, seconds, rows
+
+    def flush(self):
+        """Write dirty pages of all files to disk
+        """
+        with self.lock:
+            files = self.files.values()
+        for f in files:
+            f.flush()
+
+    def close(self):
+        with self.lock:
+            files, self.files = self.files.values(), {}
+        for f in files:
+            f.close()
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+
+from twisted.trial import unittest
+
+import procfs
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_meminfo(self):
+        self.assertEqual(procfs.parse_meminfo(
+            'MemTotal:        2048 kB\nHugePages_Total:       4\nEmpty:\n'),
+            {'MemTotal': 2048 * 1024, 'HugePages_Total': 4})
+
+    def test_stat(self):
+        stat = procfs.parse_stat(
+            'cpu  10 20 30 40 50 0 0 0 0 0\ncpu0 1 2 3 4 5 0 0 0 0 0\n'
+            'ctxt 1234\nprocs_running 2\n')
+        self.assertEqual(stat['cpu'], [10, 20, 30, 40, 50, 0, 0, 0, 0, 0])
+        self.assertEqual(stat['cpu0'][:5], [1, 2, 3, 4, 5])
+        self.assertEqual(stat['ctxt'], [1234])
+
+    def test_diskstats(self):
+        self.assertEqual(procfs.parse_diskstats(
+            '   8       0 sda 1 2 3 4 5 6 7 8 0 9 10\n'
+            '   8       1 sda1 11 12 13 14\n'),
+            {'sda': [1, 2, 3, 4, 5, 6, 7, 8, 0, 9, 10],
+             'sda1': [11, 12, 13, 14]})
+
+    def test_net_dev(self):
+        devices = procfs.parse_net_dev(
+            'Inter-|   Receive    |  Transmit\n'
+            ' face |bytes packets |bytes packets\n'
+            '    lo:  100 2 0 0 0 0 0 0  100 2 0 0 0 0 0 0\n'
+            '  eth0: 5000 40 1 0 0 0 0 0 7000 50 0 0 0 0 0 0\n')
+        self.assertEqual(sorted(devices), ['eth0', 'lo'])
+        self.assertEqual((devices['eth0'][0], devices['eth0'][8]),
+                         (5000, 7000))
+
+    def test_mountinfo(self):
+        self.assertEqual(procfs.parse_mountinfo(
+            '22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw\n'
+            '40 22 8:2 / /mnt/my\\040disk rw - vfat /dev/sdb\\0401 rw\n'
+            'broken line\n'),
+            [('/', 'ext4', '/dev/sda1'),
+             ('/mnt/my disk', 'vfat', '/dev/sdb 1')])
+
+
+class ProcessTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def process(self, pid, comm, utime, stime, start, rss, cmdline=None):
+        os.mkdir(os.path.join(self.root, str(pid)))
+        fields = [str(i) for i in xrange(40)]
+        fields[0] = 'S'
+        fields[11], fields[12] = str(utime), str(stime)
+        fields[19], fields[21] = str(start), str(rss)
+        with open(os.path.join(self.root, str(pid), 'stat'), 'w') as f:
+            f.write('%d (%s) %s\n' % (pid, comm, ' '.join(fields)))
+        if cmdline is not None:
+            with open(os.path.join(self.root, str(pid), 'cmdline'), 'w') as f:
+                f.write('\0'.join(cmdline) + '\0')
+
+    def test_scan(self):
+        self.process(1, 'init', 10, 5, 100, 42)
+        # comm ends at the last parenthesis
+        self.process(22, 'a (b) c', 1, 2, 300, 7)
+        os.mkdir(os.path.join(self.root, 'self'))
+        # A process that exited between listing and reading
+        os.mkdir(os.path.join(self.root, '33'))
+        self.assertEqual(sorted(procfs.scan_processes(self.root)),
+                         [(1, 'init', 100, 15, 42), (22, 'a (b) c', 300, 3, 7)])
+
+    def test_cmdline(self):
+        self.process(5, 'python', 0, 0, 0, 0, ['python', '-m', 'server'])
+        self.process(6, 'kthreadd', 0, 0, 0, 0, [])
+        self.assertEqual(procfs.read_cmdline(self.root, 5), 'python -m server')
+        self.assertEqual(procfs.read_cmdline(self.root, 6), '')
+        self.assertEqual(procfs.read_cmdline(self.root, 7), '')
@@ -0,0 +1,136 @@
+from twisted.internet import defer, protocol, reactor
+from twisted.trial import unittest
+
+import resp
+from stats import RedisStat
+from writeback import rrd_sample
+
+NAN = float('nan')
+INFO = ('# Clients\r\n'
+        'connected_clients:%(clients)d\r\n'
+        'blocked_clients:0\r\n'
+        '\r\n# Memory\r\n'
+        'used_memory:%(memory)d\r\n'
+        'used_memory_human:1.00M\r\n'
+        'used_memory_rss:%(rss)d\r\n'
+        '\r\n# Persistence\r\n'
+        'rdb_changes_since_last_save:%(commands)d\r\n'
+        '\r\n# Stats\r\n'
+        'total_commands_processed:%(commands)d\r\n'
+        'total_net_input_bytes:%(net_in)d\r\n'
+        'total_net_output_bytes:%(net_out)d\r\n'
+        'expired_keys:%(expired)d\r\n'
+        'evicted_keys:0\r\n'
+        'keyspace_hits:%(hits)d\r\n'
+        'keyspace_misses:%(misses)d\r\n'
+        '\r\n# Keyspace\r\n'
+        'db0:keys=%(keys)d,expires=10,avg_ttl=3600\r\n'
+        'db1:keys=5,expires=0,avg_ttl=0\r\n')
+
+
+class FakeRedis(protocol.Protocol):
+    """Answers INFO, AUTH and SELECT like a Redis server, with counters
+    growing by the INFO
+    """
+
+    def connectionMade(self):
+        self.buffer = ''
+        self.factory.connections.append(self)
+
+    def dataReceived(self, data):
+        self.buffer += data
+        while True:
+            result = resp.parse(self.buffer)
+            if result is resp.INCOMPLETE:
+                return
+            args, end = result
+            self.buffer = self.buffer[end:]
+            self.factory.commands.append(args)
+            command = args[0].upper()
+            if command == 'INFO':
+                n = len([x for x in self.factory.commands if x == ['INFO']])
+                body = INFO % {
+                    'clients': 5 + n, 'memory': 1048576 + n,
+                    'rss': 2097152 + n, 'commands': n * 10,
+                    'net_in': n * 300, 'net_out': n * 900, 'expired': n,
+                    'hits': n * 8, 'misses': n * 2, 'keys': 1000 + n}
+                self.transport.write('$%d\r\n%s\r\n' % (len(body), body))
+            elif command in ('AUTH', 'SELECT'):
+                self.transport.write('+OK\r\n')
+            else:
+                self.transport.write("-ERR unknown command '%s'\r\n" %
+                                     args[0])
+
+    def connectionLost(self, reason):
+        self.factory.closed.callback(None)
+
+
+class RedisStatTest(unittest.TestCase):
+
+    def setUp(self):
+        factory = protocol.Factory.forProtocol(FakeRedis)
+        factory.commands, factory.connections = [], []
+        factory.closed = defer.Deferred()
+        self.factory = factory
+        self.port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+        self.stat = RedisStat('redis://:secret@127.0.0.1:%d/1' %
+                              self.port.getHost().port, 'local:6379')
+
+    def disconnect(self):
+        self.stat.client.disconnect()
+        return self.factory.closed
+
+    def check(self, n, ratio):
+        wanted = {
+            'commands': n * 10, 'hits': n * 8, 'misses': n * 2,
+            'expired': n, 'evicted': 0, 'net_in': n * 300,
+            'net_out': n * 900, 'clients': 5 + n, 'blocked': 0,
+            'memory': 1048576 + n, 'rss': 2097152 + n, 'changes': n * 10,
+            'keys': 1000 + n + 5, 'expires': 10, 'hit_ratio': ratio,
+        }
+        self.assertEqual(sorted(self.stat.stats), sorted(wanted))
+        for name, value in wanted.iteritems():
+            got = self.stat.stats[name]
+            if value != value:
+                self.assertNotEqual(got, got, name)
+            else:
+                self.assertEqual(got, value, name)
+
+    @defer.inlineCallbacks
+    def test_read(self):
+        self.addCleanup(self.disconnect)
+        self.assertEqual(self.stat.name, 'local-6379')
+        yield self.stat.read_stat(None)
+        # AUTH and SELECT go out ahead of the first command
+        self.assertEqual(self.factory.commands,
+                         [['AUTH', 'secret'], ['SELECT', '1'], ['INFO']])
+        # The hit ratio is known from the second sample, hits and misses
+        # growing 8 to 2
+        self.check(1, NAN)
+        yield self.stat.read_stat(None)
+        self.check(2, 80.0)
+        # One connection is kept for every sample
+        self.assertEqual(len(self.factory.connections), 1)
+
+    def test_missing_fields(self):
+        # Fields an older redis doesn't have are unknown, and written as U
+        self.stat.read_info(RedisStat.parse_info(
+            '# Stats\r\ntotal_commands_processed:7\r\nkeyspace_hits:9\r\n'))
+        self.assertEqual(self.stat.stats['commands'], 7)
+        self.assertEqual(self.stat.stats['keys'], 0)
+        misses, ratio = self.stat.stats['misses'], self.stat.stats['hit_ratio']
+        self.assertNotEqual(misses, misses)
+        self.assertNotEqual(ratio, ratio)
+        self.assertNotIn('nan', rrd_sample(0, self.stat.stats.values()))
+
+    def test_parse_info(self):
+        info = RedisStat.parse_info(
+            '# Server\r\nredis_version:6.0.9\r\nuptime_in_seconds:42\r\n'
+            'mem_fragmentation_ratio:1.25\r\n'
+            'db0:keys=3,expires=1,avg_ttl=10\r\n')
+        self.assertEqual(info, {'redis_version': '6.0.9',
+                                'uptime_in_seconds': 42,
+                                'mem_fragmentation_ratio': 1.25,
+                                'db0': {'keys': 3, 'expires': 1,
+                                        'avg_ttl': 10}})
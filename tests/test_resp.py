@@ -0,0 +1,36 @@
+from twisted.trial import unittest
+
+import resp
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_replies(self):
+        for data, wanted in [('+OK\r\n', 'OK'), (':42\r\n', 42),
+                             ('$3\r\nfoo\r\n', 'foo'), ('$0\r\n\r\n', ''),
+                             ('$-1\r\n', None), ('*-1\r\n', None),
+                             ('*2\r\n$1\r\na\r\n*1\r\n:1\r\n', ['a', [1]])]:
+            # Whatever follows a reply is left for the next parse
+            self.assertEqual(resp.parse(data + '+next\r\n'),
+                             (wanted, len(data)))
+
+    def test_start(self):
+        data = '+OK\r\n:7\r\n'
+        self.assertEqual(resp.parse(data, 5), (7, len(data)))
+
+    def test_incomplete(self):
+        for data in ['', '+OK', '$3\r\nfo', '*2\r\n$1\r\na\r\n']:
+            self.assertIs(resp.parse(data), resp.INCOMPLETE)
+
+    def test_error(self):
+        error, end = resp.parse('-ERR wrong\r\n')
+        self.assertIsInstance(error, resp.RedisError)
+        self.assertEqual((str(error), end), ('ERR wrong', 12))
+
+    def test_bad_type(self):
+        self.assertRaises(ValueError, resp.parse, '?\r\n')
+
+    def test_encode(self):
+        command = resp.encode(['SELECT', 2])
+        self.assertEqual(command, '*2\r\n$6\r\nSELECT\r\n$1\r\n2\r\n')
+        self.assertEqual(resp.parse(command), (['SELECT', '2'], len(command)))
@@ -0,0 +1,122 @@
+import os
+import shutil
+import tempfile
+
+from twisted.trial import unittest
+
+from store import RoundRobinFile, Store
+
+NAN = float('nan')
+SOURCES = ['DS:g:GAUGE:20:0:U', 'DS:d:DERIVE:20:0:U']
+ARCHIVES = ['RRA:AVERAGE:0.5:1:5', 'RRA:AVERAGE:0.5:3:4', 'RRA:MIN:0.5:3:4',
+            'RRA:MAX:0.5:3:4', 'RRA:LAST:0.5:3:4']
+
+
+def same(a, b):
+    """Return whether two lists of rows are equal, NaN matching NaN
+    """
+    return len(a) == len(b) and all(
+        len(x) == len(y) and all(u == v or u != u and v != v
+                                 for u, v in zip(x, y))
+        for x, y in zip(a, b))
+
+
+class RoundRobinFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        path = os.path.join(self.directory, 'test.rrs')
+        RoundRobinFile.create(path, 10, SOURCES, ARCHIVES, start=100)
+        self.file = RoundRobinFile(path)
+        self.addCleanup(self.file.close)
+        # One sample a step, the counter growing 30, 50, 70...
+        for i in xrange(1, 10):
+            self.assertTrue(self.file.update(100 + 10 * i, [i, 100 * i * i]))
+
+    def fetch(self, cf, resolution, start, end):
+        first, seconds, views = self.file.fetch(cf, resolution, start, end)
+        return first, seconds, [list(row) for view in views for row in view]
+
+    def assertRows(self, fetched, wanted):
+        self.assertEqual(fetched[:2], wanted[:2])
+        self.assertTrue(same(fetched[2], wanted[2]),
+                        '%r != %r' % (fetched[2], wanted[2]))
+
+    def test_old_samples(self):
+        self.assertFalse(self.file.update(190, [1, 1]))
+        self.assertFalse(self.file.update(150, [1, 1]))
+        self.assertEqual(self.file.last_update, 190)
+
+    def test_primary(self):
+        # Rows are stamped with the end of the step they cover, and the
+        # first sample of a counter has no rate
+        self.assertRows(self.fetch('AVERAGE', 10, 150, 190),
+                        (160, 10, [[6, 110], [7, 130], [8, 150], [9, 170]]))
+
+    def test_consolidate(self):
+        # Older than the primary archive reaches, so the 30s ones answer.
+        # The first row has 2 of 3 gauge steps known but only one rate
+        for cf, rows in [('AVERAGE', [[1.5, NAN], [4, 70], [7, 130]]),
+                         ('MIN', [[1, NAN], [3, 50], [6, 110]]),
+                         ('MAX', [[2, NAN], [5, 90], [8, 150]]),
+                         ('LAST', [[2, NAN], [5, 90], [8, 150]])]:
+            self.assertRows(self.fetch(cf, 10, 100, 190), (120, 30, rows))
+
+    def test_unknown_cf(self):
+        self.assertRaises(ValueError, self.file.fetch, 'MINIMUM', 10, 100, 190)
+
+    def test_heartbeat(self):
+        # Samples further apart than the heartbeat leave the time unknown
+        self.file.update(300, [7, 0])
+        self.assertRows(self.fetch('AVERAGE', 10, 250, 300),
+                        (260, 10, [[NAN, NAN]] * 5))
+
+    def test_wrap(self):
+        # The primary archive has 5 rows, so these wrap around its end
+        for i in xrange(10, 13):
+            self.file.update(100 + 10 * i, [i, 100 * i * i])
+        first, seconds, views = self.file.fetch('AVERAGE', 10, 170, 220)
+        self.assertEqual(len(views), 2)
+        self.assertRows(self.fetch('AVERAGE', 10, 170, 220),
+                        (180, 10, [[8, 150], [9, 170], [10, 190], [11, 210],
+                                   [12, 230]]))
+
+    def test_reopen(self):
+        self.file.flush()
+        other = RoundRobinFile(self.file.path)
+        self.addCleanup(other.close)
+        self.assertEqual(other.last_update, 190)
+        self.assertEqual(other.fetch('AVERAGE', 10, 180, 190)[:2], (190, 10))
+
+
+class StoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.store = Store()
+        self.addCleanup(self.store.close)
+        self.name = os.path.join(self.directory, 'test.rrd')
+
+    def test_paths(self):
+        self.assertFalse(self.store.exists(self.name))
+        self.store.create(self.name, 10, SOURCES, ARCHIVES)
+        self.assertTrue(self.store.exists(self.name))
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.directory, 'test.rrs')))
+
+    def test_fetch(self):
+        self.store.create(self.name, 10, SOURCES, ARCHIVES)
+        # Data sources left out of the template are unknown
+        for t in xrange(110, 150, 10):
+            self.store.update(self.name, 'g', t, [t])
+        self.assertEqual(self.store.last(self.name), 140)
+        names, first, seconds, rows = self.store.fetch(
+            self.name, 'AVERAGE', 10, 120, 140)
+        self.assertEqual((names, first, seconds), (['g', 'd'], 130, 10))
+        self.assertTrue(same(rows, [[130, NAN], [140, NAN]]))
+        # The rows are copies, later updates don't change them
+        for t in xrange(150, 200, 10):
+            self.store.update(self.name, 'g:d', t, [0, t])
+        self.assertTrue(same(rows, [[130, NAN], [140, NAN]]))
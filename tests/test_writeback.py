@@ -0,0 +1,134 @@
+import os
+import shutil
+import tempfile
+
+from twisted.trial import unittest
+
+import writeback
+from writeback import WriteBuffer, rrd_sample
+
+
+class FakeRRDTool(object):
+    """Stands in for the rrdtool module, keeping the samples written
+    """
+
+    class error(Exception):
+        pass
+
+    def __init__(self):
+        # file name -> list of samples written
+        self.written = {}
+        # Files whose updates fail
+        self.broken = set()
+
+    def update(self, file_name, _, template, *samples):
+        if file_name in self.broken:
+            raise self.error("%s is broken" % file_name)
+        for sample in samples:
+            if int(sample.split(':')[0]) <= self.last(file_name):
+                raise self.error("illegal attempt to update using time %s" %
+                                 sample.split(':')[0])
+        self.written.setdefault(file_name, []).extend(samples)
+
+    def last(self, file_name):
+        samples = self.written.get(file_name)
+        return int(samples[-1].split(':')[0]) if samples else 0
+
+
+class SampleTest(unittest.TestCase):
+
+    def test_unknown(self):
+        self.assertEqual(rrd_sample(9.6, [1, 2.5, None, float('nan')]),
+                         '10:1:2.5:U:U')
+
+
+class WriteBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.rrdtool = FakeRRDTool()
+        self.patch(writeback, 'rrdtool', self.rrdtool)
+        self.journal = os.path.join(self.directory, 'rrd.journal')
+        self.files = []
+        for name in ('a.rrd', 'b.rrd'):
+            self.files.append(os.path.join(self.directory, name))
+            open(self.files[-1], 'w').close()
+
+    def lines(self):
+        with open(self.journal) as f:
+            return f.read().splitlines()
+
+    def test_batches(self):
+        buf = WriteBuffer(self.journal, 'never')
+        buf.open()
+        a = self.files[0]
+        for t in (1, 2, 3):
+            self.assertTrue(buf.add(a, 'x:y', t, [t, None]))
+        # rrdtool only takes increasing times
+        self.assertFalse(buf.add(a, 'x:y', 3, [0, 0]))
+        self.assertEqual(len(self.lines()), 3)
+        buf.flush()
+        self.assertEqual(self.rrdtool.written[a], ['1:1:U', '2:2:U', '3:3:U'])
+        self.assertEqual(self.lines(), [])
+        buf.close()
+
+    def test_last(self):
+        # Samples older than what the rrd has are dropped as they come
+        a = self.files[0]
+        self.rrdtool.written[a] = ['5:0']
+        buf = WriteBuffer()
+        self.assertFalse(buf.add(a, 'x', 5, [1]))
+        self.assertTrue(buf.add(a, 'x', 6, [1]))
+
+    def test_replay(self):
+        a, b = self.files
+        self.rrdtool.written[a] = ['2:0']
+        with open(self.journal, 'w') as f:
+            for t in (1, 2, 3, 4):
+                f.write('%s x %d:%d\n' % (a, t, t))
+            f.write('%s x 1:1\n' % b)
+            f.write('%s x 1:1\n' % os.path.join(self.directory, 'gone.rrd'))
+            f.write('half a line\n')
+        buf = WriteBuffer(self.journal, 'flush')
+        buf.open()
+        # Only what the rrds don't have yet is written again
+        self.assertEqual(self.rrdtool.written[a], ['2:0', '3:3', '4:4'])
+        self.assertEqual(self.rrdtool.written[b], ['1:1'])
+        self.assertEqual(self.lines(), [])
+        buf.close()
+
+    def test_bad_sample(self):
+        # One rejected sample doesn't cost the rest of its batch
+        a = self.files[0]
+        buf = WriteBuffer()
+        buf.add(a, 'x', 1, [1])
+        buf.add(a, 'x', 2, [2])
+        self.rrdtool.written[a] = ['1:0']
+        self.assertRaises(IOError, buf.flush)
+        self.assertEqual(self.rrdtool.written[a], ['1:0', '2:2'])
+        self.assertEqual(buf.pending, {})
+
+    def test_broken_file(self):
+        a, b = self.files
+        buf = WriteBuffer(self.journal, 'flush')
+        buf.open()
+        for t in (1, 2):
+            buf.add(a, 'x', t, [t])
+            buf.add(b, 'x', t, [t])
+        self.rrdtool.broken.add(b)
+        self.assertRaises(IOError, buf.flush)
+        # Only the samples still buffered are left in the journal
+        self.assertEqual(self.lines(), ['%s x 1:1' % b, '%s x 2:2' % b])
+        buf.add(a, 'x', 3, [3])
+        buf.add(b, 'x', 3, [3])
+        self.assertEqual(len(self.lines()), 4)
+        self.rrdtool.broken.clear()
+        buf.flush()
+        self.assertEqual(self.rrdtool.written[a], ['1:1', '2:2', '3:3'])
+        self.assertEqual(self.rrdtool.written[b], ['1:1', '2:2', '3:3'])
+        self.assertEqual(self.lines(), [])
+        buf.close()
+
+    def test_fsync(self):
+        self.assertRaises(ValueError, WriteBuffer, self.journal, 'sometimes')
@@ -0,0 +1,243 @@
+import os
+import threading
+
+try:
+    import rrdtool
+except ImportError:
+    # Only "storage": "store" works without the rrdtool bindings
+    rrdtool = None
+
+
+def rrd_sample(timestamp, values):
+    """Return an rrdtool update argument "timestamp:value:value..."
+
+    NaN and None are written as U, the unknown value, which every data
+    source type takes, where DERIVE and COUNTER sources reject "nan".
+
+    Arguments:
+    timestamp - unix time, rounded to seconds
+    values - list of numbers
+
+    """
+    return "%d:%s" % (round(timestamp), ":".join(
+        ["U" if x is None or x != x else str(x) for x in values]))
+
+
+class WriteBuffer(object):
+    """Buffers rrd updates in memory and writes them in batches
+
+    Every sample is also appended to a journal file, so samples that were
+    buffered but not yet written survive a crash and are replayed on the
+    next start. After every flush the journal is rewritten with only the
+    samples still buffered, so it never holds more than one flush worth.
+
+    fsync policies:
+    never - leave it to the OS
+    flush - fsync rrd files and the rewritten journal after each flush,
+    before the old journal is replaced
+    always - like flush, and also fsync the journal after every sample
+    """
+    FSYNC_POLICIES = ['never', 'flush', 'always']
+
+    def __init__(self, journal=None, fsync='flush'):
+        """
+        Keyword Arguments:
+        journal - path of the journal file, default: no journal
+        fsync - one of FSYNC_POLICIES, default: flush
+
+        """
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError("fsync needs to be one of %s" %
+                             ", ".join(self.FSYNC_POLICIES))
+        self.fsync = fsync
+        self.journal_path = journal
+        self.journal = None
+        # rrd file name -> [template, list of "timestamp:values" strings]
+        self.pending = {}
+        # rrd file name -> last buffered timestamp
+        self.last = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def open(self):
+        """Replay samples left in the journal, then start a new one
+        """
+        if self.journal_path is None:
+            return
+        if os.path.isfile(self.journal_path):
+            with open(self.journal_path, 'r') as journal:
+                for line in journal:
+                    parts = line.split()
+                    if len(parts) != 3:
+                        continue
+                    file_name, template, sample = parts
+                    if not os.path.isfile(file_name):
+                        continue
+                    # Skip samples that made it into the rrd already
+                    if int(sample.split(':')[0]) <= rrdtool.last(file_name):
+                        continue
+                    self._buffer(file_name, template, sample)
+        # Samples that still fail to write are kept in it by the flush
+        self.journal = open(self.journal_path, 'a')
+        self.flush()
+
+    def close(self):
+        """Flush all samples and close the journal
+        """
+        self.flush()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def add(self, file_name, template, timestamp, values):
+        """Buffer one sample
+
+        Arguments:
+        file_name - rrd file name
+        template - ':' separated data source names
+        timestamp - unix time of the sample
+        values - list of values in template order
+
+        Return:
+        False if the sample was dropped because it isn't newer than the
+        last one for that file, True otherwise
+
+        """
+        timestamp = int(round(timestamp))
+        sample = rrd_sample(timestamp, values)
+        if file_name not in self.last:
+            # Samples the rrd has already, from before a restart say, would
+            # fail the whole batch they are written in
+            last = self._last(file_name)
+            with self.lock:
+                self.last.setdefault(file_name, last)
+        with self.lock:
+            # rrdtool only accepts increasing timestamps
+            if timestamp <= self.last.get(file_name, 0):
+                return False
+            self._buffer(file_name, template, sample)
+            if self.journal is not None:
+                self.journal.write("%s %s %s\n" % (file_name, template, sample))
+                self.journal.flush()
+                if self.fsync == 'always':
+                    os.fsync(self.journal.fileno())
+        return True
+
+    def flush(self, file_name=None):
+        """Write buffered samples to their rrd files, one update per file
+
+        Keyword Arguments:
+        file_name - only flush this rrd file, default: flush all
+
+        """
+        with self.flush_lock:
+            with self.lock:
+                if file_name is None:
+                    batches, self.pending = self.pending, {}
+                elif file_name in self.pending:
+                    batches = {file_name: self.pending.pop(file_name)}
+                else:
+                    batches = {}
+            errors = []
+            for name, (template, samples) in batches.iteritems():
+                try:
+                    self._write(name, template, samples)
+                except rrdtool.error as e:
+                    # One bad sample fails the whole update, so the rest
+                    # are written one at a time
+                    failed = []
+                    for sample in samples:
+                        try:
+                            self._write(name, template, [sample])
+                        except rrdtool.error as e:
+                            failed.append(sample)
+                    if failed and len(failed) < len(samples):
+                        errors.append("%s: dropped %d samples: %s" %
+                                      (name, len(failed), e))
+                    elif failed:
+                        # Nothing went in, so it's the file that fails.
+                        # The samples are kept, and so is the journal
+                        kept = self._requeue(name, template, samples)
+                        errors.append("%s: %s, kept %d samples" %
+                                      (name, e, kept))
+                        continue
+                if self.fsync != 'never':
+                    fd = os.open(name, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+            with self.lock:
+                self._compact()
+        if errors:
+            raise IOError("Failed to update %s" % ", ".join(errors))
+
+    def _buffer(self, file_name, template, sample):
+        entry = self.pending.get(file_name)
+        if entry is not None and entry[0] != template:
+            # A batch shares one template, so write out the old one first
+            self._write(file_name, *self.pending.pop(file_name))
+            entry = None
+        if entry is None:
+            entry = self.pending[file_name] = [template, []]
+        entry[1].append(sample)
+        self.last[file_name] = int(sample.split(':')[0])
+
+    def _requeue(self, file_name, template, samples):
+        """Put samples that failed to write back in front of the ones
+        buffered since, dropping those the rrd has already
+
+        Return:
+        number of samples put back
+
+        """
+        last = self._last(file_name)
+        samples = [x for x in samples if int(x.split(':')[0]) > last]
+        with self.lock:
+            entry = self.pending.get(file_name)
+            if entry is None:
+                self.pending[file_name] = [template, samples]
+            elif entry[0] == template:
+                entry[1][:0] = samples
+            else:
+                # The newer samples have another template, and a batch
+                # only has one
+                return 0
+        return len(samples)
+
+    def _compact(self):
+        """Replace the journal with one of the samples still buffered,
+        called with lock held
+
+        The new journal is written next to the old one and renamed over
+        it, so a crash leaves one or the other whole.
+        """
+        if self.journal is None:
+            return
+        if not self.pending:
+            self.journal.seek(0)
+            self.journal.truncate()
+            return
+        path = self.journal_path + '.new'
+        with open(path, 'w') as journal:
+            for name, (template, samples) in self.pending.iteritems():
+                for sample in samples:
+                    journal.write("%s %s %s\n" % (name, template, sample))
+            journal.flush()
+            if self.fsync != 'never':
+                os.fsync(journal.fileno())
+        os.rename(path, self.journal_path)
+        self.journal.close()
+        self.journal = open(self.journal_path, 'a')
+
+    def _last(self, file_name):
+        """Return the time of the newest sample in an rrd, 0 if it can't
+        be read
+        """
+        try:
+            return rrdtool.last(file_name)
+        except rrdtool.error:
+            return 0
+
+    def _write(self, file_name, template, samples):
+        rrdtool.update(file_name, "-t", template, *samples)